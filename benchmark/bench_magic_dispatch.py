@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (sos), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Micro-benchmark of the per-cell overhead of dispatching cell magics. It
+# compares the sequential regular expressions that were used to identify
+# magics with the MagicRegistry of the kernel, and the creation of argument
+# parsers for each magic with cached parsers.
+#
+#     python benchmark/bench_magic_dispatch.py
+#
+
+import re
+import timeit
+from types import SimpleNamespace
+
+from sos_notebook.kernel import SoS_Kernel
+from sos_notebook.magics import MagicRegistry
+
+NAMES = sorted(SoS_Kernel.ALL_MAGICS | SoS_Kernel.HIDDEN_MAGICS)
+REGEXES = [re.compile(f'^%{name}(\\s|$)') for name in NAMES]
+
+CELLS = {
+    'plain cell': 'a = 1\n' * 50,
+    'subkernel magic': '%capture\nprint(1)\n',
+    'stacked magics': '%get a b c\n%put d\n%with R\n%preview -n d\nd <- a + 1\n',
+}
+
+def regex_chain(code):
+    # the last magic in the chain has to be checked for non-magic cells
+    for regex in REGEXES:
+        if regex.match(code):
+            return regex
+    return None
+
+def magic_lines(code):
+    # magics of the cell, each of which is dispatched once by _do_execute
+    lines = code.split('\n')
+    return ['\n'.join(lines[i:]) for i, x in enumerate(lines) if x.startswith('%')] or [code]
+
+def report(title, func, number=20000):
+    t = timeit.timeit(func, number=number)
+    print(f'    {title:<24}{t / number * 1e6:8.2f} us')
+
+if __name__ == '__main__':
+    registry = MagicRegistry(None, {name: None for name in NAMES})
+    for title, cell in CELLS.items():
+        codes = magic_lines(cell)
+        print(f'{title} ({len(codes)} dispatch):')
+        report('regex chain', lambda: [regex_chain(x) for x in codes])
+        report('registry', lambda: [registry.match(x) for x in codes])
+
+    kernel = SimpleNamespace(_parse_error=print, _parsers={})
+    kernel.get_use_parser = lambda: SoS_Kernel.get_use_parser(kernel)
+    print('argument parser of %use:')
+    report('create', kernel.get_use_parser, number=2000)
+    report('cached', lambda: SoS_Kernel.get_parser(kernel, 'use'), number=2000)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (sos), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Benchmark of the synchronization of the SoS dictionary with the namespace
+# of the IPython shell after each cell, with a namespace of 100k variables.
+# It compares copying the entire dictionary with NamespaceSync, which pushes
+# only variables that might have been changed by the cell.
+#
+#     python benchmark/bench_namespace_sync.py
+#
+
+import timeit
+from types import SimpleNamespace
+
+from sos_notebook.namespace import NamespaceSync, TrackedWorkflowDict
+
+SIZE = 100000
+
+CELLS = {
+    'empty cell': '',
+    'assignment': 'a = 1\nb = [a] * 10\n',
+    'loop over variables': 'for i in range(10):\n    total = sum(x for x in range(i))\n',
+}
+
+def report(title, func, number=200):
+    t = timeit.timeit(func, number=number)
+    print(f'    {title:<24}{t / number * 1e3:8.3f} ms')
+
+def run_cell(sync, sos_dict, code):
+    sync.add_code(code)
+    exec(code, sos_dict._dict)
+    sync.sync(sos_dict)
+
+if __name__ == '__main__':
+    sos_dict = TrackedWorkflowDict({f'var_{i}': i for i in range(SIZE)})
+    shell = SimpleNamespace(user_ns={})
+    sync = NamespaceSync(shell)
+    sync.sync(sos_dict)
+    print(f'namespace of {len(sos_dict._dict)} variables:')
+    for title, code in CELLS.items():
+        print(f'{title}:')
+        report('full copy', lambda: (exec(code, sos_dict._dict), shell.user_ns.update(sos_dict._dict)))
+        report('incremental', lambda: run_cell(sync, sos_dict, code))
+    print('delete a variable (%dict --del):')
+    report('incremental', lambda: (sos_dict.set('tmp', 1), sos_dict.pop('tmp'), sync.sync(sos_dict)))
+    assert 'tmp' not in shell.user_ns
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (sos), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Benchmark of finding the previewers of many output files, comparing the
+# loop over previewers that matches each pattern with fnmatch, loads the entry
+# point of the previewer and calls content detectors with the filename, with
+# the PreviewerDispatcher used by the kernel.
+#
+#     python benchmark/bench_preview_dispatch.py
+#
+
+import fnmatch
+import os
+import tarfile
+import tempfile
+import timeit
+import zipfile
+
+from sos_notebook.preview import get_previewers, PreviewerDispatcher
+
+def create_files(dirname, count=100):
+    files = []
+    for idx in range(count):
+        name = os.path.join(dirname, f'output_{idx}')
+        if idx % 4 == 0:
+            name += '.csv'
+            with open(name, 'w') as out:
+                out.write('a,b\n1,2\n')
+        elif idx % 4 == 1:
+            name += '.zip'
+            with zipfile.ZipFile(name, 'w') as out:
+                out.writestr('a.txt', 'a')
+        elif idx % 4 == 2:
+            name += '.tgz'
+            with tarfile.open(name, 'w:gz') as out:
+                out.add(files[0], arcname='a.csv')
+        else:
+            name += '.log'
+            with open(name, 'w') as out:
+                out.write('line\n' * 1000)
+        files.append(name)
+    return files
+
+def find_by_loop(previewers, filename):
+    # the loop of SoS_Kernel.preview_file before PreviewerDispatcher
+    for x, y, _ in previewers:
+        if isinstance(x, str):
+            if fnmatch.fnmatch(os.path.basename(filename), x):
+                return y.load()
+        elif x(filename):
+            return y.load()
+
+if __name__ == '__main__':
+    previewers = get_previewers()
+    dispatcher = PreviewerDispatcher(previewers)
+    with tempfile.TemporaryDirectory() as dirname:
+        files = create_files(dirname)
+        for title, func in (
+                ('loop', lambda: [find_by_loop(previewers, x) for x in files]),
+                ('dispatcher', lambda: [dispatcher.find(x) for x in files])):
+            t = timeit.timeit(func, number=20)
+            print(f'{title:<24}{t / 20 / len(files) * 1e6:8.2f} us per file')
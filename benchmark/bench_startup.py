@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (sos), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Cold-start benchmark of the SoS kernel. It reports the time to import
+# sos_notebook.kernel with the modules taking most of it, and the time it
+# takes for a freshly started kernel to reply to kernel_info_request and to
+# execute its first cell. No network access is needed.
+#
+#     python benchmark/bench_startup.py [--kernel sos] [--repeat 3] [--json result.json]
+#
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+
+def import_times(module):
+    '''Import module in a new interpreter and return a list of (module,
+    self time, cumulative time) in seconds, in the order of import.'''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    result = []
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        result.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return result
+
+
+def time_to_ready(kernel_name, timeout=60):
+    '''Start a kernel and return the time to the reply of kernel_info_request
+    and the time of executing its first cell, in seconds.'''
+    from jupyter_client import manager
+    start = time.time()
+    km = manager.KernelManager(kernel_name=kernel_name)
+    km.start_kernel()
+    kc = km.client()
+    kc.start_channels()
+    try:
+        kc.wait_for_ready(timeout=timeout)
+        ready = time.time() - start
+        start = time.time()
+        kc.execute_interactive('a = 1', timeout=timeout, output_hook=lambda msg: None)
+        first_cell = time.time() - start
+    finally:
+        kc.stop_channels()
+        km.shutdown_kernel(now=True)
+    return ready, first_cell
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('bench_startup',
+        description='Measure the cold start time of the SoS kernel')
+    parser.add_argument('--kernel', default='sos', help='name of the kernel to start')
+    parser.add_argument('--repeat', type=int, default=3, help='number of kernels to start')
+    parser.add_argument('--top', type=int, default=15,
+        help='number of modules with the longest import time to report')
+    parser.add_argument('--json', help='save the results to a json file')
+    args = parser.parse_args()
+
+    times = import_times('sos_notebook.kernel')
+    total = times[-1][2]
+    print(f'import sos_notebook.kernel: {total:.3f}s')
+    for name, self_time, cumulative in sorted(times, key=lambda x: -x[1])[:args.top]:
+        print(f'    {name:<48}{self_time:8.3f}s {cumulative:8.3f}s')
+
+    ready, first_cell = zip(*[time_to_ready(args.kernel) for i in range(args.repeat)])
+    print(f'{args.kernel} kernel ({args.repeat} starts, median):')
+    print(f'    {"kernel_info_reply":<48}{statistics.median(ready):8.3f}s')
+    print(f'    {"first cell":<48}{statistics.median(first_cell):8.3f}s')
+
+    if args.json:
+        with open(args.json, 'w') as result:
+            json.dump({
+                'import': total,
+                'modules': {name: [s, c] for name, s, c in times},
+                'kernel_info_reply': list(ready),
+                'first_cell': list(first_cell),
+                }, result, indent=2)
@@ -132,9 +132,30 @@ setup(name = "sos-notebook",
 *.pdf,1 = sos_notebook.preview:preview_pdf
 *.html,1 = sos_notebook.preview:preview_html
 *.csv,1 = sos_notebook.preview:preview_csv
+*.tsv,1 = sos_notebook.preview:preview_csv
+*.tab,1 = sos_notebook.preview:preview_csv
+*.csv.gz,2 = sos_notebook.preview:preview_csv
+*.csv.bz2,2 = sos_notebook.preview:preview_csv
+*.csv.xz,2 = sos_notebook.preview:preview_csv
+*.tsv.gz,2 = sos_notebook.preview:preview_csv
+*.tsv.bz2,2 = sos_notebook.preview:preview_csv
+*.tsv.xz,2 = sos_notebook.preview:preview_csv
+*.tab.gz,2 = sos_notebook.preview:preview_csv
+*.tab.bz2,2 = sos_notebook.preview:preview_csv
+*.tab.xz,2 = sos_notebook.preview:preview_csv
 *.xls,1 = sos_notebook.preview:preview_xls
 *.xlsx,1 = sos_notebook.preview:preview_xls
 *.gz,1 = sos_notebook.preview:preview_gz
+*.vcf,1 = sos_notebook.preview:preview_vcf
+*.vcf.gz,2 = sos_notebook.preview:preview_vcf
+*.vcf.bgz,2 = sos_notebook.preview:preview_vcf
+*.bam,1 = sos_notebook.preview:preview_bam
+*.fastq,1 = sos_notebook.preview:preview_fastq
+*.fq,1 = sos_notebook.preview:preview_fastq
+*.fastq.gz,2 = sos_notebook.preview:preview_fastq
+*.fq.gz,2 = sos_notebook.preview:preview_fastq
+*.bed,1 = sos_notebook.preview:preview_bed
+*.bed.gz,2 = sos_notebook.preview:preview_bed
 *.txt,1 = sos_notebook.preview:preview_txt
 *.md,1 = sos_notebook.preview:preview_md
 *.dot,1 = sos_notebook.preview:preview_dot [dot]
@@ -170,6 +191,7 @@ rmd-ipynb.func = sos_notebook.converter:Rmarkdown_to_notebook
 ''',
 
     extras_require = {
-        'dot':      ['graphviz']
+        'dot':      ['graphviz'],
+        'excel':    ['openpyxl', 'xlrd'],
     }
 )
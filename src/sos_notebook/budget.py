@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (sos), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import array
+import datetime
+import enum
+import numbers
+import pathlib
+import reprlib
+import time
+import types
+from itertools import islice
+from collections import deque
+from collections.abc import Mapping, Sized
+
+from sos.utils import pretty_size
+
+#
+# Previews of variables are limited by a budget of bytes and time. The length
+# of the repr of a variable is estimated by walking its items, which stops as
+# soon as the estimate exceeds the budget, so that the full repr is only
+# produced if it fits. Otherwise a structural summary with type, shape, dtype,
+# size and the first and last items of the variable is shown.
+#
+
+# types with short reprs, which are estimated and displayed by their reprs.
+# The reprs of other objects are not bounded and are never called.
+BOUNDED_TYPES = (numbers.Number, type(None), range, slice, type, enum.Enum, pathlib.PurePath,
+    datetime.date, datetime.time, datetime.timedelta, datetime.tzinfo,
+    types.FunctionType, types.BuiltinFunctionType, types.MethodType, types.ModuleType)
+
+
+class BoundedRepr(reprlib.Repr):
+    '''A reprlib.Repr that does not call the repr of objects of types other
+    than BOUNDED_TYPES, and that truncates bytes before calling their repr.'''
+    def repr_instance(self, obj, level):
+        if isinstance(obj, (bytes, bytearray)):
+            return repr(obj[:self.maxother]) + ('...' if len(obj) > self.maxother else '')
+        if isinstance(obj, BOUNDED_TYPES):
+            return super(BoundedRepr, self).repr_instance(obj, level)
+        return object.__repr__(obj)
+
+
+class Summary(object):
+    '''Text that is displayed as is by the formatters of IPython.'''
+    def __init__(self, text):
+        self.text = text
+
+    def __repr__(self):
+        return self.text
+
+
+class PreviewBudget(object):
+    def __init__(self, max_bytes=100000, max_time=1):
+        self.max_bytes = max_bytes
+        self.max_time = max_time
+        self._repr = BoundedRepr()
+        self._repr.maxlevel = 2
+        self._repr.maxstring = 60
+        self._repr.maxother = 60
+
+    def estimate(self, obj, limit=None):
+        '''Return an estimate of the length of repr(obj), or a number larger
+        than limit (default to max_bytes) if the estimate exceeds limit or the
+        time of the preview has run out.'''
+        limit = self.max_bytes if limit is None else limit
+        deadline = time.time() + self.max_time
+        try:
+            return self._estimate(obj, limit, deadline, 0)
+        except RecursionError:
+            return limit + 1
+
+    def _estimate(self, obj, limit, deadline, depth):
+        if isinstance(obj, (str, bytes, bytearray)):
+            return len(obj) + 3
+        if isinstance(obj, bool) or obj is None:
+            return 5
+        if isinstance(obj, int):
+            return obj.bit_length() // 3 + 2
+        if isinstance(obj, (float, complex)):
+            return 24
+        if hasattr(obj, 'shape') and (hasattr(obj, 'dtype') or hasattr(obj, 'dtypes')):
+            # numpy and pandas summarize large arrays and data frames in their repr
+            return min(getattr(obj, 'nbytes', 10000), 10000)
+        if isinstance(obj, Mapping):
+            items = (x for item in obj.items() for x in item)
+        elif isinstance(obj, (list, tuple, set, frozenset, deque, array.array)):
+            items = obj
+        elif isinstance(obj, BOUNDED_TYPES):
+            return len(repr(obj))
+        else:
+            # the repr of other objects is not bounded, so they are always
+            # summarized
+            return limit + 1
+        if len(obj) * 2 > limit or depth > 50:
+            return limit + 1
+        total = 2
+        for idx, item in enumerate(items):
+            total += self._estimate(item, limit - total, deadline, depth + 1) + 2
+            if total > limit or (idx % 1000 == 999 and time.time() > deadline):
+                return limit + 1
+        return total
+
+    def fits(self, obj, limit=None):
+        limit = self.max_bytes if limit is None else limit
+        return self.estimate(obj, limit) <= limit
+
+    def dpi(self, width, height, pages=1, min_dpi=72, max_dpi=150):
+        '''Return the resolution at which pages of width x height inches can be
+        rasterised within max_bytes, assuming that rasterised figures compress
+        to about 1/10 byte per pixel.'''
+        dpi = (self.max_bytes * 10 / max(width * height * pages, 1e-6)) ** 0.5
+        return int(min(max(dpi, min_dpi), max_dpi))
+
+    def describe(self, obj):
+        '''Type and structure of obj, e.g. "ndarray of shape (10, 10), dtype float64, 800 B"'''
+        desc = type(obj).__name__
+        if getattr(obj, 'shape', None) is not None:
+            desc += f' of shape {obj.shape}'
+            if getattr(obj, 'dtype', None) is not None:
+                desc += f', dtype {obj.dtype}'
+            if getattr(obj, 'nbytes', None) is not None:
+                desc += f', {pretty_size(obj.nbytes)}'
+        elif isinstance(obj, Mapping):
+            desc += f' with {len(obj)} keys'
+        elif isinstance(obj, Sized):
+            desc += f' of length {len(obj)}'
+        return desc
+
+    def summarize(self, obj, items=5):
+        '''Summary of obj with its type, structure and first and last items.'''
+        desc = self.describe(obj)
+        if hasattr(obj, 'shape') and hasattr(obj, 'dtype'):
+            content = repr(obj)
+        elif isinstance(obj, Mapping):
+            keys = list(islice(obj.keys(), items))
+            content = '{' + ', '.join(f'{self._repr.repr(k)}: {self._repr.repr(obj[k])}' for k in keys) + \
+                (', ...}' if len(obj) > items else '}')
+        elif isinstance(obj, (list, tuple)):
+            shown = [self._repr.repr(x) for x in obj[:items]]
+            if len(obj) > 2 * items:
+                shown += ['...'] + [self._repr.repr(x) for x in obj[-items:]]
+            else:
+                shown += [self._repr.repr(x) for x in obj[items:]]
+            content = ', '.join(shown).join('[]' if isinstance(obj, list) else '()')
+        else:
+            content = self._repr.repr(obj)
+        if len(content) > self.max_bytes:
+            content = content[:self.max_bytes] + '...'
+        return Summary(f'{desc}\n{content}')
+
+    def limit(self, obj):
+        '''Return obj if its repr fits in the budget, or its summary otherwise.'''
+        return obj if self.fits(obj) else self.summarize(obj)
+
+    def limit_dict(self, variables):
+        '''Return a dictionary in which variables that do not fit in the rest of
+        the budget are replaced by their summaries.'''
+        result = {}
+        remaining = self.max_bytes
+        for name, value in variables.items():
+            size = self.estimate(value, remaining)
+            if size <= remaining:
+                result[name] = value
+                remaining -= size
+            else:
+                result[name] = self.summarize(value)
+        return result
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (sos), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import pickle
+import hashlib
+from collections import OrderedDict
+
+from sos.utils import env
+
+
+class LRUCache(object):
+    '''A dictionary that keeps at most maxsize items and discards the least
+    recently used items first.'''
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        try:
+            value = self._items[key]
+        except KeyError:
+            return default
+        self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._items.pop(key, default)
+
+    def clear(self):
+        self._items.clear()
+
+
+def file_key(filename, *options):
+    '''Return a key that identifies the content of filename by its path,
+    modification time and size, and options.'''
+    st = os.stat(filename)
+    return (os.path.abspath(filename), st.st_mtime_ns, st.st_size) + options
+
+
+class DiskCache(object):
+    '''A cache that pickles values to files in directory, named after the
+    hash of their keys, and removes the least recently used files once their
+    total size exceeds max_bytes.'''
+    def __init__(self, directory, max_bytes=100 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # total size of files in directory, scanned on first put
+        self._size = None
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest())
+
+    def get(self, key, default=None):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as entry:
+                value = pickle.load(entry)
+            # modification time of files records their last use
+            os.utime(path)
+        except Exception:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if self._size is None:
+                self._size = sum(x.stat().st_size for x in self._entries())
+            with open(path + '.tmp', 'wb') as entry:
+                pickle.dump(value, entry, protocol=pickle.HIGHEST_PROTOCOL)
+            old_size = os.path.getsize(path) if os.path.isfile(path) else 0
+            os.replace(path + '.tmp', path)
+            self._size += os.path.getsize(path) - old_size
+        except Exception as e:
+            env.logger.debug(f'Failed to save {key} to cache {self.directory}: {e}')
+            return
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return [x for x in os.scandir(self.directory) if x.is_file() and not x.name.endswith('.tmp')]
+
+    def _evict(self):
+        entries = sorted(((x.stat().st_mtime, x.stat().st_size, x.path) for x in self._entries()))
+        self._size = sum(x[1] for x in entries)
+        for _, size, path in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        for entry in self._entries():
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+        self._size = 0
+
+    def stats(self):
+        '''Return a dictionary with numbers of hits, misses and entries, and
+        total size in bytes of the cache.'''
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(entries),
+            'size': sum(x.stat().st_size for x in entries)}
@@ -22,10 +22,13 @@
 
 import os
 import glob
+import time
 
 import rlcompleter
 from sos.utils import env
 
+from .namespace import NameIndex
+
 def last_valid(line):
     text = line
     for char in (' ', '\t', '"', "'", '=', '('):
@@ -35,78 +38,142 @@ def last_valid(line):
             text = text.rsplit(char, 1)[-1]
     return text
 
+def timed_out(deadline):
+    return deadline is not None and time.time() > deadline
+
 class SoS_MagicsCompleter:
     def __init__(self, kernel):
         self.kernel = kernel
 
-    def get_completions(self, line):
+    def get_variables(self, text):
+        # variables of the SoS dictionary, from the sorted index of its keys
+        return [x for x in self.kernel.user_ns_sync.names.prefix(text) if x not in \
+            self.kernel.original_keys and not x.startswith('_')]
+
+    def get_completions(self, line, deadline=None):
         text = last_valid(line)
 
         if not text.strip():
             if line.startswith('%get'):
-                return text, [x for x in env.sos_dict.keys() if x not in \
-                    self.kernel.original_keys and not x.startswith('_')]
+                return text, self.get_variables('')
             elif any(line.startswith(x) for x in ('%use', '%with', '%shutdown')):
                 return text, ['SoS'] + list(self.kernel.supported_languages.keys())
             else:
                 return None
         elif text.startswith('%') and line.startswith(text):
-            return text, ['%' + x + ' ' for x in self.kernel.ALL_MAGICS if x.startswith(text[1:])]
+            return text, ['%' + x + ' ' for x in self.kernel.magic_registry.names() - self.kernel.HIDDEN_MAGICS if x.startswith(text[1:])]
         elif any(line.startswith(x) for x in ('%use', '%with', '%shutdown')):
             return text, [x for x in self.kernel.supported_languages.keys() if x.startswith(text)]
         elif line.startswith('%get '):
-            return text, [x for x in env.sos_dict.keys() if x.startswith(text) \
-                and x not in self.kernel.original_keys and not x.startswith('_')]
+            return text, self.get_variables(text)
         else:
             return None
 
+class ListingCache(object):
+    '''Sorted directory listings, which are listed again only if the mtime
+    of the directory has changed.'''
+    def __init__(self):
+        self._listings = {}
+
+    def clear(self):
+        self._listings.clear()
+
+    def listdir(self, path, deadline=None):
+        '''Return a NameIndex of entries of path, which can be incomplete if
+        deadline has passed while the directory is listed.'''
+        path = os.path.abspath(path)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return NameIndex()
+        cached = self._listings.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        names = []
+        complete = True
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    names.append(entry.name)
+                    if timed_out(deadline):
+                        complete = False
+                        break
+        except OSError:
+            return NameIndex()
+        listing = NameIndex(names)
+        # a directory that is changed within the resolution of mtime
+        # could be changed again without changing its mtime
+        if complete and time.time() - mtime > 2:
+            self._listings[path] = (mtime, listing)
+        return listing
+
 class SoS_PathCompleter:
     '''PathCompleter.. The problem with ptpython's path completor is that
     it only matched 'text_before_cursor', which would not match cases such
     as %cd ~/, which we will need.'''
-    def __init__(self):
-        pass
+    def __init__(self, listings):
+        self.listings = listings
+
+    def get_matches(self, dirname, prefix, deadline=None):
+        # entries of dirname starting with prefix, hidden files are matched
+        # only if prefix starts with '.', as glob.glob(prefix + '*') does
+        listing = self.listings.listdir(dirname or '.', deadline)
+        return [os.path.join(dirname, x) for x in listing.prefix(prefix)
+            if prefix.startswith('.') or not x.startswith('.')]
 
-    def get_completions(self, line):
+    def get_completions(self, line, deadline=None):
         text = last_valid(line)
+        path = os.path.expanduser(text)
 
-        if not text.strip():
-            return text, glob.glob('*')
+        if glob.has_magic(path):
+            return text, glob.glob(path + '*')
+        matches = self.get_matches(*os.path.split(path), deadline)
+        if len(matches) == 1 and matches[0] == path and os.path.isdir(path):
+            return text, self.get_matches(path, '', deadline)
         else:
-            matches = glob.glob(os.path.expanduser(text) + '*')
-            if len(matches) == 1 and matches[0] == os.path.expanduser(text) \
-                and os.path.isdir(os.path.expanduser(text)):
-                return text, glob.glob(os.path.expanduser(text) + '/*')
-            else:
-                return text, matches
+            return text, matches
 
 class PythonCompleter:
-    def __init__(self):
-        pass
+    def __init__(self, kernel):
+        self.kernel = kernel
 
-    def get_completions(self, line):
+    def get_completions(self, line, deadline=None):
         text = last_valid(line)
 
-        completer = rlcompleter.Completer(env.sos_dict._dict)
+        # only variables starting with text are passed to the completer,
+        # which would otherwise scan the entire dictionary
+        values = env.sos_dict._dict
+        namespace = {}
+        for name in self.kernel.user_ns_sync.names.prefix(text):
+            if name in values:
+                namespace[name] = values[name]
+            if timed_out(deadline):
+                break
+        completer = rlcompleter.Completer(namespace)
         return text, completer.global_matches(text)
 
 class SoS_Completer(object):
     def __init__(self, kernel):
+        # directory listings are cleared by %cd
+        self.listings = ListingCache()
+        # seconds after which the completer returns partial or no matches
+        self.timeout = kernel.get_notebook_option('completion_timeout', 0.5)
         self.completers = [
             SoS_MagicsCompleter(kernel),
-            SoS_PathCompleter(),
-            PythonCompleter(),
+            SoS_PathCompleter(self.listings),
+            PythonCompleter(kernel),
         ]
 
     def complete_text(self, code, cursor_pos = None):
         if cursor_pos is None:
             cursor_pos = len(code)
+        deadline = time.time() + self.timeout
 
         # get current line before cursor
         doc = code[:cursor_pos].rpartition('\n')[2]
 
         for c in self.completers:
-            matched = c.get_completions(doc)
+            matched = c.get_completions(doc, deadline)
             if matched is None:
                 continue
             elif isinstance(matched, tuple):
@@ -114,6 +181,7 @@ class SoS_Completer(object):
                     return matched
             else:
                 raise RuntimeError(f'Unrecognized completer return type {matched}')
+            if timed_out(deadline):
+                break
         # No match
         return '', []
-
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (sos), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import os
+import sys
+
+from sos.utils import env
+
+#
+# Discovery of kernelspecs and entry points
+#
+# Scanning the entry points of all installed distributions and the kernelspec
+# directories is slow on environments with hundreds of packages, and the result
+# rarely changes between two kernel starts. The result of the scan is therefore
+# saved to ~/.sos/discovery_cache.json, together with the modification times of
+# the site directories on sys.path, of the entry_points.txt files of
+# distributions in these directories, and of the jupyter kernelspec
+# directories. Other directories on sys.path, such as the working directory of
+# the kernel, are not part of the key so that the cache is shared by notebooks
+# in different directories. Because
+# installing or removing a package or a kernel changes the mtime of one of these
+# directories, and reinstalling a package in place (e.g. pip install -e)
+# rewrites its entry_points.txt, the cache is rescanned only when it is stale.
+#
+GROUPS = ('sos_languages', 'sos_previewers', 'sos_converters', 'sos_magics')
+
+CACHE_FILE = os.path.join(os.path.expanduser('~'), '.sos', 'discovery_cache.json')
+
+try:
+    from importlib.metadata import EntryPoint, entry_points
+except ImportError:
+    # python < 3.8
+    import pkg_resources
+
+    class EntryPoint(object):
+        def __init__(self, name, value, group):
+            self.name = name
+            self.value = value
+            self.group = group
+
+        def load(self):
+            return pkg_resources.EntryPoint.parse(f'{self.name} = {self.value}').resolve()
+
+    def entry_points():
+        return {group: [EntryPoint(ep.name, str(ep).split('=', 1)[1].strip(), group)
+                        for ep in pkg_resources.iter_entry_points(group=group)]
+                for group in GROUPS}
+
+_discovered = None
+
+
+def _kernel_dirs():
+    from jupyter_core.paths import jupyter_path
+    return jupyter_path('kernels')
+
+
+def _entry_point_mtimes(directory):
+    # mtimes of entry_points.txt of distributions installed in directory
+    mtimes = {}
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return mtimes
+    for entry in entries:
+        if entry.name.endswith(('.dist-info', '.egg-info')):
+            filename = os.path.join(entry.path, 'entry_points.txt')
+            try:
+                mtimes[filename] = os.stat(filename).st_mtime
+            except OSError:
+                # not a directory, or distribution without entry points
+                pass
+    return mtimes
+
+
+def _is_site_dir(directory):
+    # directories of the python installation, and other directories with
+    # installed distributions (e.g. pip install --target)
+    import site
+    path = os.path.realpath(directory)
+    prefixes = site.PREFIXES + [site.getuserbase()]
+    if any(path.startswith(os.path.realpath(x) + os.sep) for x in prefixes):
+        return True
+    try:
+        return any(x.endswith(('.dist-info', '.egg-info')) for x in os.listdir(path))
+    except OSError:
+        return False
+
+
+def _cache_key():
+    # the script directory or working directory of the kernel is not a site
+    # directory even if it has installed distributions
+    cwd = os.path.realpath(os.getcwd())
+    dirs = [x for x in sys.path if x and os.path.realpath(x) != cwd and _is_site_dir(x)] + _kernel_dirs()
+    mtimes = {}
+    for d in dirs:
+        try:
+            mtimes[d] = os.stat(d).st_mtime
+        except OSError:
+            # the directory does not exist (yet)
+            mtimes[d] = None
+            continue
+        mtimes.update(_entry_point_mtimes(d))
+    return {'python': sys.executable, 'mtimes': mtimes}
+
+
+def _scan_entry_points():
+    eps = entry_points()
+    result = {}
+    for group in GROUPS:
+        # python 3.10 and later return an EntryPoints object with select,
+        # earlier versions return a dictionary of groups
+        items = eps.select(group=group) if hasattr(eps, 'select') else eps.get(group, [])
+        # the same distribution can be on sys.path more than once
+        seen = []
+        for ep in items:
+            if [ep.name, ep.value] not in seen:
+                seen.append([ep.name, ep.value])
+        result[group] = seen
+    return result
+
+
+def _scan_kernel_specs():
+    from jupyter_client.kernelspec import KernelSpecManager
+    return KernelSpecManager().find_kernel_specs()
+
+
+def _load_cache(key):
+    try:
+        with open(CACHE_FILE) as cache:
+            data = json.load(cache)
+        if data.get('key') == key:
+            return data
+    except Exception:
+        # missing or corrupted cache
+        pass
+    return None
+
+
+def _save_cache(data):
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        tmp_file = f'{CACHE_FILE}.{os.getpid()}'
+        with open(tmp_file, 'w') as cache:
+            json.dump(data, cache)
+        # atomic so that kernels starting at the same time never see a partial file
+        os.replace(tmp_file, CACHE_FILE)
+    except Exception as e:
+        env.logger.debug(f'Failed to save discovery cache {CACHE_FILE}: {e}')
+
+
+def get_discovered(refresh=False):
+    '''Return a dictionary with entry points of GROUPS as lists of [name, value]
+    under key "entry_points", and kernelspecs as {name: resource_dir} under key
+    "kernelspecs". The result is read from the discovery cache unless the cache
+    is stale or refresh is True.'''
+    global _discovered
+    if _discovered is not None and not refresh:
+        return _discovered
+    key = _cache_key()
+    data = None if refresh else _load_cache(key)
+    if data is None:
+        data = {'key': key,
+                'entry_points': _scan_entry_points(),
+                'kernelspecs': _scan_kernel_specs()}
+        _save_cache(data)
+    _discovered = data
+    return _discovered
+
+
+def iter_entry_points(group):
+    '''Return entry points of group, which have attributes name and value
+    and can be loaded with .load()'''
+    return [EntryPoint(name, value, group) for name, value in
+            get_discovered()['entry_points'].get(group, [])]
+
+
+def find_kernel_specs():
+    '''Return a dictionary of kernel name and resource directory of installed
+    kernelspecs, as returned by KernelSpecManager().find_kernel_specs()'''
+    return get_discovered()['kernelspecs']
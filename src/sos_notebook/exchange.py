@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (sos), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import shutil
+import tempfile
+import hashlib
+import importlib.util
+import pickle
+from collections import defaultdict
+
+#
+# Exchange of large variables between the SoS kernel and subkernels through
+# files in shared memory (/dev/shm) or the temporary directory. The sender
+# writes the value once and the receiver maps the file into memory instead
+# of receiving the value as statements or messages over zmq.
+#
+# A value is described by a dictionary with keys name, format, path and size.
+# Supported formats are
+#
+#   npy:      numeric numpy arrays, written with numpy.save and loaded with
+#             numpy.load(mmap_mode='c'), which is copy-on-write so that the
+#             loaded arrays can be modified
+#   feather:  pandas DataFrames, written as uncompressed Arrow IPC (feather V2)
+#             files and loaded with memory mapping
+#
+# Language modules opt into the exchange by defining
+#
+#   exchange_formats:  list of formats that the subkernel can read and write
+#   load_vars(descriptors): load variables described by descriptors in the
+#             subkernel (%get)
+#   save_vars(items, formats, directory, threshold): optional, write variables
+#             items of the subkernel that are larger than threshold bytes in one
+#             of formats to directory and return a dictionary of name and
+#             descriptors of the written variables (%put)
+#
+# Variables that are small, of other types, or not supported by the language
+# module are transferred by get_vars and put_vars as before.
+#
+
+FORMATS = ('npy', 'feather')
+
+def _shm_dir():
+    # use tmpfs-backed /dev/shm if available so that files are never written to disk
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+class VariableExchange(object):
+    def __init__(self, threshold):
+        # minimal size in bytes of values to be passed through files
+        self.threshold = threshold
+        self._directory = None
+        self._count = 0
+
+    def get_directory(self):
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix='sos_exchange_', dir=_shm_dir())
+        return self._directory
+
+    directory = property(lambda self: self.get_directory())
+
+    def _format_of(self, value, formats):
+        # avoid importing numpy or pandas for values of other types
+        module = type(value).__module__
+        if module == 'numpy' and 'npy' in formats:
+            import numpy
+            if isinstance(value, numpy.ndarray) and not value.dtype.hasobject:
+                return 'npy', value.nbytes
+        elif module.startswith('pandas.') and 'feather' in formats:
+            import pandas
+            if isinstance(value, pandas.DataFrame):
+                if importlib.util.find_spec('pyarrow') is None:
+                    return None, 0
+                return 'feather', int(value.memory_usage(index=True).sum())
+        return None, 0
+
+    def export(self, name, value, formats):
+        '''Write value to a file in one of formats if it is larger than the
+        threshold, and return its descriptor. None is returned if the value
+        should be transferred otherwise.'''
+        fmt, size = self._format_of(value, formats)
+        if fmt is None or size < self.threshold:
+            return None
+        self._count += 1
+        path = os.path.join(self.directory, f'{name}_{self._count}.{fmt}')
+        try:
+            if fmt == 'npy':
+                import numpy
+                numpy.save(path, value, allow_pickle=False)
+            else:
+                import pyarrow.feather
+                pyarrow.feather.write_feather(value, path, compression='uncompressed')
+        except Exception:
+            # e.g. data frames with non-string column names cannot be saved in
+            # feather format, fall back to regular transfer
+            self._remove(path)
+            return None
+        return {'name': name, 'format': fmt, 'path': path, 'size': size}
+
+    def load(self, descriptor):
+        '''Map value described by descriptor into memory'''
+        if descriptor['format'] == 'npy':
+            import numpy
+            # copy-on-write so that in-place updates of the array work as for
+            # arrays that are transferred otherwise
+            return numpy.load(descriptor['path'], mmap_mode='c')
+        elif descriptor['format'] == 'feather':
+            import pyarrow.feather
+            # the arrow table is memory mapped, columns are copied only if
+            # they cannot be represented by numpy arrays in the data frame
+            return pyarrow.feather.read_feather(descriptor['path'], memory_map=True)
+        else:
+            raise ValueError(f'Unsupported exchange format {descriptor["format"]}')
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            # the file could still be mapped (e.g. under windows), in which
+            # case it will be removed by cleanup()
+            pass
+
+    def release(self, descriptors):
+        '''Remove files after the values have been loaded by the receiver.
+        Memory mapped values remain valid after their files are removed.'''
+        for descriptor in descriptors:
+            self._remove(descriptor['path'])
+
+    def cleanup(self):
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+
+
+class _DigestWriter(object):
+    # a file-like object that passes written bytes to a digest
+    __slots__ = ('write',)
+
+    def __init__(self, digest):
+        self.write = digest.update
+
+
+def fingerprint(value):
+    '''Return a digest of the content of value, or None if the content of
+    value cannot be determined.'''
+    try:
+        if type(value).__module__ == 'numpy' and hasattr(value, 'dtype') and not value.dtype.hasobject:
+            # hash the buffer of numeric arrays directly
+            import numpy
+            digest = hashlib.blake2b(repr((value.dtype, value.shape)).encode(), digest_size=16)
+            digest.update(numpy.ascontiguousarray(value).data)
+            return digest.digest()
+        # stream the pickle into the digest instead of creating a copy of
+        # the pickled value in memory
+        digest = hashlib.blake2b(digest_size=16)
+        pickle.Pickler(_DigestWriter(digest), protocol=pickle.HIGHEST_PROTOCOL).dump(value)
+        return digest.digest()
+    except Exception:
+        return None
+
+class SharedVariableTracker(object):
+    '''Fingerprints of automatically shared (sos*) variables that were last
+    sent to or received from each subkernel, so that unchanged variables are
+    not sent again.'''
+    def __init__(self):
+        # kernel -> {name: fingerprint}
+        self._fingerprints = defaultdict(dict)
+
+    def changed(self, kernel, values):
+        '''Return names of values that have changed since they were last sent
+        to or received from kernel, and fingerprints of all values.'''
+        fingerprints = {name: fingerprint(value) for name, value in values.items()}
+        known = self._fingerprints.get(kernel, {})
+        return [name for name, fp in fingerprints.items() if fp is None or known.get(name) != fp], fingerprints
+
+    def record(self, kernel, fingerprints):
+        self._fingerprints[kernel].update({name: fp for name, fp in fingerprints.items() if fp is not None})
+
+    def retain(self, kernel, names):
+        '''Forget variables of kernel other than names, for example because
+        they have been removed from the subkernel.'''
+        known = self._fingerprints.get(kernel, {})
+        for name in [x for x in known if x not in names]:
+            known.pop(name)
+
+    def forget(self, kernel=None):
+        # forget variables of kernel, or of all kernels if kernel is None
+        if kernel is None:
+            self._fingerprints.clear()
+        else:
+            self._fingerprints.pop(kernel, None)
@@ -24,32 +24,56 @@ import pydoc
 from sos.utils import env
 from sos.syntax import SOS_USAGES
 
+from .cache import LRUCache
+
 class SoS_VariableInspector(object):
-    def __init__(self, kernel):
+    def __init__(self, kernel, cache):
         self.kernel = kernel
+        self.cache = cache
 
-    def inspect(self, name, line, pos):
+    def inspect(self, name, line, pos, detail_level=0):
+        # the preview is valid until the next cell changes the dictionary
+        key = ('preview', name, self.kernel.user_ns_sync.generation)
+        data = self.cache.get(key)
+        if data is not None:
+            return data
         try:
             obj_desc, preview = self.kernel.preview_var(name, style=None)
             if preview is None:
-                return {}
+                data = {}
             else:
                 format_dict, md_dict = preview
                 if 'text/plain' in format_dict:
-                    return format_dict
+                    data = format_dict
                 else:
-                    return {'text/plain': f'{repr(env.sos_dict["name"])} ({obj_desc})'}
+                    data = {'text/plain': f'{repr(env.sos_dict[name])} ({obj_desc})'}
         except Exception:
-            return {}
+            data = {}
+        self.cache.put(key, data)
+        return data
 
 class SoS_SyntaxInspector(object):
-    def __init__(self, kernel):
+    def __init__(self, kernel, cache):
         self.kernel = kernel
+        self.cache = cache
+
+    def render_doc(self, obj, detail_level=0):
+        # documentation is cached by identity of obj, which is kept in the
+        # cache so that its id cannot be reused. HTML is rendered only for
+        # detailed inspection.
+        key = ('doc', id(obj))
+        cached = self.cache.get(key)
+        if cached is None or cached[0] is not obj:
+            cached = (obj, {'text/plain': pydoc.render_doc(obj, title='%s', renderer=pydoc.plaintext)})
+            self.cache.put(key, cached)
+        if detail_level > 0 and 'text/html' not in cached[1]:
+            cached[1]['text/html'] = pydoc.render_doc(obj, title='%s', renderer=pydoc.html)
+        return dict(cached[1])
 
-    def inspect(self, name, line, pos):
+    def inspect(self, name, line, pos, detail_level=0):
         if line.startswith('%') and name in self.kernel.ALL_MAGICS and pos <= len(name) + 1:
             if hasattr(self.kernel, f'get_{name}_parser'):
-                parser = getattr(self.kernel, f'get_{name}_parser')()
+                parser = self.kernel.get_parser(name)
                 return {'text/plain': parser.format_help()}
             else:
                 return {'text/plain': f'Magic %{name}'}
@@ -61,9 +85,7 @@ class SoS_SyntaxInspector(object):
                 return {'text/plain': SOS_USAGES[name]}
             elif name in env.sos_dict:
                 # action?
-                return {'text/plain': pydoc.render_doc(env.sos_dict[name], title='%s', renderer=pydoc.plaintext),
-                        'text/html': pydoc.render_doc(env.sos_dict[name], title='%s', renderer=pydoc.html)
-                        }
+                return self.render_doc(env.sos_dict[name], detail_level)
             else:
                 return {}
         else:
@@ -71,19 +93,20 @@ class SoS_SyntaxInspector(object):
 
 class SoS_Inspector(object):
     def __init__(self, kernel):
+        # rendered documentation and previews of variables
+        self.cache = LRUCache(32)
         self.inspectors = [
-            SoS_SyntaxInspector(kernel),
-            SoS_VariableInspector(kernel),
+            SoS_SyntaxInspector(kernel, self.cache),
+            SoS_VariableInspector(kernel, self.cache),
         ]
 
-    def inspect(self, name, line, pos):
+    def inspect(self, name, line, pos, detail_level=0):
         for c in self.inspectors:
             try:
-                data = c.inspect(name, line, pos)
+                data = c.inspect(name, line, pos, detail_level)
                 if data:
                     return data
             except Exception:
                 continue
         # No match
         return {}
-
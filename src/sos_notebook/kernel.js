@@ -671,6 +671,20 @@ define([
                 cm.replaceRange(data, cm.getCursor());
             } else if (msg_type === 'alert') {
                 alert(data);
+            } else if (msg_type === 'kernel-ready') {
+                // subkernel started in the background when the notebook is opened
+                var kernel_status = Jupyter.notification_area.widget("kernel");
+                if (data[1]) {
+                    console.log("subkernel " + data[0] + " failed to start: " + data[1]);
+                    kernel_status.danger("Subkernel " + data[0] + " failed to start", 5000);
+                } else {
+                    console.log("subkernel " + data[0] + " is ready");
+                    kernel_status.info("Subkernel " + data[0] + " is ready", 3000);
+                }
+                // mark the subkernel in the kernel selector
+                $("#kernel_selector option").filter(function() {
+                    return $(this).val() === (window.DisplayName[data[0]] || data[0]);
+                }).attr("title", data[1] ? "failed to start: " + data[1] : "started");
             } else if (msg_type === 'clear-output') {
                 // if remove output of all cells
                 console.log(data)
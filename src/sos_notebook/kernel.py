@@ -25,39 +25,39 @@ import sys
 import re
 import time
 import shlex
-import fnmatch
 import contextlib
+import threading
 import subprocess
 import argparse
-import pkg_resources
 import pydoc
 
 from ipykernel.ipkernel import IPythonKernel
-from collections import Sized, defaultdict, OrderedDict
+from collections import Sized, defaultdict, deque, OrderedDict
 
 from types import ModuleType
-from sos.utils import env, WorkflowDict, short_repr, pretty_size, PrettyRelativeTime, log_to_file
+from sos.utils import env, short_repr, pretty_size, PrettyRelativeTime, log_to_file
 from sos._version import __sos_version__, __version__
-from sos.eval import SoS_exec, SoS_eval, interpolate
 from sos.syntax import SOS_SECTION_HEADER, SOS_GLOBAL_SECTION_HEADER
 
-from IPython.lib.clipboard import ClipboardEmpty, osx_clipboard_get, tkinter_clipboard_get
 from IPython.core.error import UsageError
 from IPython.core.display import HTML
 from IPython.utils.tokenutil import line_at_cursor, token_at_cursor
-from jupyter_client import manager, find_connection_file
 
 from textwrap import dedent
 
-from .completer import SoS_Completer
-from .inspector import SoS_Inspector
-
-from .workflow_executor import runfile
-from .step_executor import PendingTasks
+from .cache import LRUCache, file_key
+from .discovery import find_kernel_specs, iter_entry_points
+from .exchange import SharedVariableTracker
+from .magics import MagicRegistry
+from .namespace import NamespaceSync, TrackedWorkflowDict
+from .profiler import CellProfiler, phase, profiled
+from .output import StreamCoalescer, BoundedStream
+from .subkernels import SubkernelPool, SubkernelRegistry, shell_request, start_subkernel
 
 class FlushableStringIO:
-    '''This is a string buffer for output, but it will only
-    keep the first 200 lines and the last 10 lines.
+    '''This is a string buffer for output, which is sent through the
+    kernel so that, by default, only the first 200 lines and the last
+    10 lines of the output of a cell are kept.
     '''
     def __init__(self, kernel, name, *args, **kwargs):
         self.kernel = kernel
@@ -72,17 +72,17 @@ class FlushableStringIO:
                         'data': { 'text/html': HTML(f'<div class="sos_hint">{content[10:].strip()}</div>').data}
                 })
         else:
-            self.kernel.send_response(self.kernel.iopub_socket, 'stream',
-                {'name': self.name, 'text': content})
+            self.kernel.send_stream(self.name, content)
 
     def flush(self):
-        pass
+        self.kernel.flush_stream()
 
 __all__ = ['SoS_Kernel']
 
 def clipboard_get():
     """ Get text from the clipboard.
     """
+    from IPython.lib.clipboard import osx_clipboard_get, tkinter_clipboard_get
     if sys.platform == 'darwin':
         try:
             return osx_clipboard_get()
@@ -117,6 +117,7 @@ class SoS_Kernel(IPythonKernel):
         'matplotlib',
         'paste',
         'preview',
+        'profile',
         'pull',
         'push',
         'put',
@@ -136,36 +137,22 @@ class SoS_Kernel(IPythonKernel):
         'use',
         'with',
     }
-    MAGIC_DICT = re.compile('^%dict(\s|$)')
-    MAGIC_CONNECT_INFO = re.compile('^%connect_info(\s|$)')
-    MAGIC_MATPLOTLIB = re.compile('^%matplotlib(\s|$)')
-    MAGIC_CD = re.compile('^%cd(\s|$)')
-    MAGIC_SET = re.compile('^%set(\s|$)')
-    MAGIC_EXPAND = re.compile('^%expand(\s|$)')
-    MAGIC_SHUTDOWN = re.compile('^%shutdown(\s|$)')
-    MAGIC_WITH = re.compile('^%with(\s|$)')
-    MAGIC_FRONTEND = re.compile('^%frontend(\s|$)')
-    MAGIC_USE = re.compile('^%use(\s|$)')
-    MAGIC_GET = re.compile('^%get(\s|$)')
-    MAGIC_PULL = re.compile('^%pull(\s|$)')
-    MAGIC_PUSH = re.compile('^%push(\s|$)')
-    MAGIC_PUT = re.compile('^%put(\s|$)')
-    MAGIC_PASTE = re.compile('^%paste(\s|$)')
-    MAGIC_RUN = re.compile('^%run(\s|$)')
-    MAGIC_SOSRUN = re.compile('^%sosrun(\s|$)')
-    MAGIC_SOSSAVE = re.compile('^%sossave(\s|$)')
-    MAGIC_SAVE = re.compile('^%save(\s|$)')
-    MAGIC_RERUN = re.compile('^%rerun(\s|$)')
-    MAGIC_PREVIEW = re.compile('^%preview(\s|$)')
-    MAGIC_SANDBOX = re.compile('^%sandbox(\s|$)')
-    MAGIC_DEBUG = re.compile('^%debug(\s|$)')
-    MAGIC_TASKINFO = re.compile('^%taskinfo(\s|$)')
-    MAGIC_TASKS = re.compile('^%tasks(\s|$)')
-    MAGIC_SKIP = re.compile('^%skip(\s|$)')
-    MAGIC_TOC = re.compile('^%toc(\s|$)')
-    MAGIC_RENDER = re.compile('^%render(\s|$)')
-    MAGIC_SESSIONINFO = re.compile('^%sessioninfo(\s|$)')
-    MAGIC_CLEAR = re.compile('^%clear(\s|$)')
+    # magics that are not listed by %help or completed by the completer
+    HIDDEN_MAGICS = {
+        'connect_info',
+        'frontend',
+        'skip',
+    }
+    # modules that are not needed for the kernel to become ready but are
+    # needed by the first cell. They are imported in the background after the
+    # kernel is started.
+    PRELOAD_MODULES = [
+        'sos.eval',
+        'sos.runtime',
+        'sos_notebook.workflow_executor',
+        'sos_notebook.completer',
+        'sos_notebook.inspector',
+    ]
 
     def get_use_parser(self):
         parser = argparse.ArgumentParser(prog='%use',
@@ -199,6 +186,10 @@ class SoS_Kernel(IPythonKernel):
         parser.add_argument('-o', '--out', nargs='*', dest='out_vars',
             help='''Output variables (variables to put back to SoS kernel
             before switching back to the SoS kernel''')
+        parser.add_argument('--force', action='store_true',
+            help='''Send all automatically shared variables (variables with names
+            starting with sos), even if they have not been changed since they were
+            last sent to or received from the subkernel.''')
         parser.error = self._parse_error
         return parser
 
@@ -235,6 +226,10 @@ class SoS_Kernel(IPythonKernel):
         parser.add_argument('-o', '--out', nargs='*', dest='out_vars',
             help='''Output variables (variables to put back to SoS kernel
             before switching back to the SoS kernel''')
+        parser.add_argument('--force', action='store_true',
+            help='''Send all automatically shared variables (variables with names
+            starting with sos), even if they have not been changed since they were
+            last sent to or received from the subkernel.''')
         parser.error = self._parse_error
         return parser
 
@@ -416,6 +411,10 @@ class SoS_Kernel(IPythonKernel):
                 Default to the SoS kernel.''')
         parser.add_argument('vars', nargs='*',
             help='''Names of SoS variables''')
+        parser.add_argument('--force', action='store_true',
+            help='''Also send automatically shared variables (variables with names
+            starting with sos) that have not been changed since they were last sent
+            to or received from the subkernel.''')
         parser.error = self._parse_error
         return parser
 
@@ -438,6 +437,25 @@ class SoS_Kernel(IPythonKernel):
         parser.error = self._parse_error
         return parser
 
+    def get_profile_parser(self):
+        parser = argparse.ArgumentParser(prog='%profile',
+            description='''Display wall and CPU time spent in phases (magic parsing,
+            interpolation, %get and %put, execution in subkernels, parsing and
+            execution of workflows, preview, etc) of the last profiled cell, or of
+            all profiled cells of the session. Time of nested phases are included in
+            outer phases.''')
+        parser.add_argument('status', nargs='?', choices=['on', 'off'],
+            help='''Turn on or off profiling of subsequent cells.''')
+        parser.add_argument('-a', '--all', action='store_true',
+            help='''Display aggregated profiles of all profiled cells.''')
+        parser.add_argument('-l', '--log', metavar='FILE', nargs='?', const='',
+            help='''Append profile of each profiled cell as a JSON line to FILE,
+            or stop logging if no FILE is specified.''')
+        parser.add_argument('-r', '--reset', action='store_true',
+            help='''Clear collected profiles.''')
+        parser.error = self._parse_error
+        return parser
+
     def get_push_parser(self):
         parser = argparse.ArgumentParser('push',
             description='''Push local files or directory to a remote host''')
@@ -544,72 +562,57 @@ class SoS_Kernel(IPythonKernel):
         return parser
 
     def find_kernel(self, name, kernel=None, language=None, color=None, notify_frontend=True):
+        registry = self.kernel_registry
         # find from subkernel name
-        def update_existing(idx):
-            x = self._kernel_list[idx]
-            if (kernel is not None and kernel != x[1]) or (language is not None and language != x[2]):
+        def update_existing(kinfo):
+            if (kernel is not None and kernel != kinfo.kernel) or (language is not None and language != kinfo.language):
                 raise ValueError(f'Cannot change kernel or language of predefined subkernel {name}')
             if color is not None:
                 if color == 'default':
-                    if self._kernel_list[idx][2]:
-                        self._kernel_list[idx][3] = self._supported_languages[self._kernel_list[idx][2]].background_color
-                    else:
-                        self._kernel_list[idx][3] = ''
+                    kinfo = registry.add(kinfo._replace(color=self._supported_languages[kinfo.language].background_color
+                        if kinfo.language else ''))
                 else:
-                    self._kernel_list[idx][3] = color
+                    kinfo = registry.add(kinfo._replace(color=color))
                 if notify_frontend:
                     self.send_frontend_msg('kernel-list', self.get_kernel_list())
+            return kinfo
 
         # if the language module cannot be loaded for some reason
         if name in self._failed_languages:
             raise self._failed_languages[name]
         # find from language name (subkernel name, which is usually language name)
-        for idx,x in enumerate(self.get_kernel_list()):
-            if x[0] == name:
-                if x[0] == 'SoS' or x[2] or language is None:
-                    update_existing(idx)
-                    return x
-                else:
-                    if not kernel:
-                        kernel = name
-                    break
+        kinfo = registry.get(name)
+        if kinfo is not None:
+            if kinfo.name == 'SoS' or kinfo.language or language is None:
+                return update_existing(kinfo)
+            elif not kernel:
+                kernel = name
         # find from kernel name
-        for idx,x in enumerate(self._kernel_list):
-            if x[1] == name:
-                # if exist language or no new language defined.
-                if x[2] or language is None:
-                    update_existing(idx)
-                    return x
-                else:
-                    # otherwise, try to use the new language
-                    kernel = name
-                    break
+        kinfo = registry.by_kernel(name)
+        if kinfo is not None:
+            # if exist language or no new language defined.
+            if kinfo.language or language is None:
+                return update_existing(kinfo)
+            else:
+                # otherwise, try to use the new language
+                kernel = name
         # now, no kernel is found, name has to be a new name and we need some definition
         # if kernel is defined
-        def add_or_replace(kdef):
-            for idx, x in enumerate(self._kernel_list):
-                if x[0] == kdef[0]:
-                    self._kernel_list[idx] = kdef
-                    return self._kernel_list[idx]
-                else:
-                    self._kernel_list.append(kdef)
-                    return self._kernel_list[-1]
-
         if kernel is not None:
             # in this case kernel should have been defined in kernel list
-            if kernel not in [x[1] for x in self._kernel_list]:
+            kdef = registry.by_kernel(kernel)
+            if kdef is None:
                 raise ValueError(
                     f'Unrecognized Jupyter kernel name {kernel}. Please make sure it is properly installed and appear in the output of command "jupyter kenelspec list"')
             # now this a new instance for an existing kernel
-            kdef = [x for x in self._kernel_list if x[1] == kernel][0]
             if not language:
                 if color == 'default':
-                    if kdef[2]:
-                        color = self._supported_languages[kdef[2]].background_color
+                    if kdef.language:
+                        color = self._supported_languages[kdef.language].background_color
                     else:
-                        color = kdef[3]
-                new_def = add_or_replace([name, kdef[1], kdef[2], kdef[3] if color is None else color,
-                    getattr(self._supported_languages[kdef[2]], 'options', {}) if kdef[2] else {}])
+                        color = kdef.color
+                new_def = registry.add([name, kdef.kernel, kdef.language, kdef.color if color is None else color,
+                    getattr(self._supported_languages[kdef.language], 'options', {}) if kdef.language else {}])
                 if notify_frontend:
                     self.send_frontend_msg('kernel-list', self.get_kernel_list())
                 return new_def
@@ -636,7 +639,7 @@ class SoS_Kernel(IPythonKernel):
                     #
                     if color == 'default':
                         color = plugin.background_color
-                    new_def = add_or_replace([name, kdef[1], kernel, kdef[3] if color is None else color,
+                    new_def = registry.add([name, kdef.kernel, kernel, kdef.color if color is None else color,
                         getattr(plugin, 'options', {})])
                 else:
                     # if should be defined ...
@@ -647,7 +650,7 @@ class SoS_Kernel(IPythonKernel):
                     self._supported_languages[name] = self._supported_languages[language]
                     if color == 'default':
                         color = self._supported_languages[name].background_color
-                    new_def = add_or_replace([name, kdef[1], language, kdef[3] if color is None else color,
+                    new_def = registry.add([name, kdef.kernel, language, kdef.color if color is None else color,
                         getattr(self._supported_languages[name], 'options', {})])
                 if notify_frontend:
                     self.send_frontend_msg('kernel-list', self.get_kernel_list())
@@ -666,10 +669,10 @@ class SoS_Kernel(IPythonKernel):
                     raise RuntimeError(f'Failed to load language {language}: {e}')
                 if name in plugin.supported_kernels:
                     # if name is defined in the module, only search kernels for this language
-                    avail_kernels = [x for x in plugin.supported_kernels[name] if x in [y[1] for y in self._kernel_list]]
+                    avail_kernels = [x for x in plugin.supported_kernels[name] if registry.has_kernel(x)]
                 else:
                     # otherwise we search all supported kernels
-                    avail_kernels = [x for x in sum(plugin.supported_kernels.values(), []) if x in [y[1] for y in self._kernel_list]]
+                    avail_kernels = [x for x in sum(plugin.supported_kernels.values(), []) if registry.has_kernel(x)]
 
                 if not avail_kernels:
                     raise ValueError('Failed to find any of the kernels {} supported by language {}. Please make sure it is properly installed and appear in the output of command "jupyter kenelspec list"'.format(
@@ -679,7 +682,7 @@ class SoS_Kernel(IPythonKernel):
                     color = plugin.background_color
                 # find the language that has the kernel
                 lan_name = list({x:y for x,y in plugin.supported_kernels.items() if avail_kernels[0] in y}.keys())[0]
-                new_def = add_or_replace([name, avail_kernels[0], lan_name, plugin.background_color if color is None else color,
+                new_def = registry.add([name, avail_kernels[0], lan_name, plugin.background_color if color is None else color,
                     getattr(plugin, 'options', {})])
             else:
                 # if a language name is specified (not a path to module), if should be defined in setup.py
@@ -688,14 +691,14 @@ class SoS_Kernel(IPythonKernel):
                 #
                 plugin = self._supported_languages[language]
                 if language in plugin.supported_kernels:
-                    avail_kernels = [x for x in plugin.supported_kernels[language] if x in [y[1] for y in self._kernel_list]]
+                    avail_kernels = [x for x in plugin.supported_kernels[language] if registry.has_kernel(x)]
                 else:
-                    avail_kernels = [x for x in sum(plugin.supported_kernels.values(), []) if x in [y[1] for y in self._kernel_list]]
+                    avail_kernels = [x for x in sum(plugin.supported_kernels.values(), []) if registry.has_kernel(x)]
                 if not avail_kernels:
                     raise ValueError('Failed to find any of the kernels {} supported by language {}. Please make sure it is properly installed and appear in the output of command "jupyter kenelspec list"'.format(
                         ', '.join(sum(self._supported_languages[language].supported_kernels.values(), [])), language))
 
-                new_def = add_or_replace([
+                new_def = registry.add([
                     name, avail_kernels[0], language,
                         self._supported_languages[language].background_color if color is None or color == 'default' else color,
                         getattr(self._supported_languages[language], 'options', {})])
@@ -703,21 +706,35 @@ class SoS_Kernel(IPythonKernel):
             self.send_frontend_msg('kernel-list', self.get_kernel_list())
             return new_def
         else:
-            # let us check if there is something wrong with the pre-defined language
-            for entrypoint in pkg_resources.iter_entry_points(group='sos_languages'):
-                if entrypoint.name == name:
-                    # there must be something wrong, let us trigger the exception here
-                    entrypoint.load()
-            # if nothing is triggerred, kernel is not defined, return a general message
+            # language modules that failed to load are recorded in self._failed_languages
+            # and trigger an exception above, so kernel is not defined
             raise ValueError(
                 f'No subkernel named {name} is found. Please make sure that you have the kernel installed (listed in the output of "jupyter kernelspec list" and usable in jupyter by itself), install appropriate language module (e.g. "pip install sos-r"), restart jupyter notebook and try again.')
 
+    def get_language_plugin(self, name):
+        '''Return the (cached) instance of the language module of subkernel
+        name, or None if the subkernel has no language module.'''
+        kinfo = self.find_kernel(name)
+        cached = self._language_plugins.get(kinfo.name, None)
+        if cached is not None and cached[0] == kinfo[:3]:
+            return cached[1]
+        if kinfo.name not in self.supported_languages:
+            return None
+        plugin = self.supported_languages[kinfo.name](self, kinfo.kernel)
+        self._language_plugins[kinfo.name] = (kinfo[:3], plugin)
+        return plugin
+
+    def _forget_subkernel(self, name):
+        # drop states of a subkernel that is started, restarted, or shutdown
+        self._language_plugins.pop(name, None)
+        self.shared_variables.forget(name)
+
     def get_supported_languages(self):
         if self._supported_languages is not None:
             return self._supported_languages
         group = 'sos_languages'
         self._supported_languages = {}
-        for entrypoint in pkg_resources.iter_entry_points(group=group):
+        for entrypoint in iter_entry_points(group):
             # Grab the function that is the actual plugin.
             name = entrypoint.name
             try:
@@ -729,8 +746,53 @@ class SoS_Kernel(IPythonKernel):
 
     supported_languages = property(lambda self:self.get_supported_languages())
 
+    def get_magic_registry(self):
+        if self._magic_registry is None:
+            self._magic_registry = MagicRegistry(self,
+                {name: getattr(self, f'_magic_{name}') for name in self.ALL_MAGICS | self.HIDDEN_MAGICS})
+        return self._magic_registry
+
+    magic_registry = property(lambda self:self.get_magic_registry())
+
+    def get_parser(self, name):
+        '''Return argument parser of magic name, which is created by
+        get_{name}_parser only once.'''
+        if name not in self._parsers:
+            self._parsers[name] = getattr(self, f'get_{name}_parser')()
+        return self._parsers[name]
+
+    def get_profiler(self):
+        if self._profiler is None:
+            self._profiler = CellProfiler(self.get_notebook_option('profile', False),
+                self.get_notebook_option('profile_log', None))
+        return self._profiler
+
+    profiler = property(lambda self:self.get_profiler())
+
+    def get_exchange(self):
+        if self._exchange is None:
+            # minimal size of numeric arrays and data frames to be passed through
+            # shared memory files, None to disable
+            threshold = self.get_notebook_option('exchange_threshold', 10 * 1024 * 1024)
+            if threshold is not None:
+                from .exchange import VariableExchange
+                self._exchange = VariableExchange(threshold)
+        return self._exchange
+
+    exchange = property(lambda self:self.get_exchange())
+
+    def get_preview_budget(self):
+        if self._preview_budget is None:
+            from .budget import PreviewBudget
+            self._preview_budget = PreviewBudget(self.get_notebook_option('preview_max_bytes', 100000),
+                self.get_notebook_option('preview_max_time', 1))
+        return self._preview_budget
+
+    preview_budget = property(lambda self:self.get_preview_budget())
+
     def get_completer(self):
         if self._completer is None:
+            from .completer import SoS_Completer
             self._completer = SoS_Completer(self)
         return self._completer
 
@@ -738,11 +800,68 @@ class SoS_Kernel(IPythonKernel):
 
     def get_inspector(self):
         if self._inspector is None:
+            from .inspector import SoS_Inspector
             self._inspector = SoS_Inspector(self)
         return self._inspector
 
     inspector = property(lambda self:self.get_inspector())
 
+    def _get_init_statements(self, kinfo):
+        # initialization statements of the language module of subkernel kinfo
+        plugin = self.get_language_plugin(kinfo[0])
+        return None if plugin is None else plugin.init_statements
+
+    def get_kernel_pool(self):
+        if self._kernel_pool is None:
+            # number of initialized kernels to keep for each kernelspec, e.g.
+            # {'ir': 1, 'python3': 1}
+            sizes = self.get_notebook_option('warm_pool', None) or {}
+            self._kernel_pool = SubkernelPool(
+                startup_timeout=self.get_notebook_option('startup_timeout', 60))
+            for kernel_name, size in sizes.items():
+                language = None
+                init_statements = None
+                kinfo = [x for x in self.get_kernel_list() if x[1] == kernel_name and x[2]]
+                if kinfo:
+                    language = kinfo[0][2]
+                    try:
+                        init_statements = self._get_init_statements(kinfo[0])
+                    except Exception as e:
+                        self.warn(f'Failed to get initialization statements of kernel {kernel_name}: {e}')
+                        continue
+                self._kernel_pool.configure(kernel_name, size, language, init_statements)
+            self._kernel_pool.fill()
+        return self._kernel_pool
+
+    def start_notebook_kernels(self, notebook_kernel_list):
+        '''Start all subkernels used by the notebook concurrently in background
+        threads, if option eager_start is set. switch_kernel will then only wait
+        for the kernel it switches to.'''
+        if not self.get_notebook_option('eager_start', False):
+            return
+        for kdef in notebook_kernel_list:
+            try:
+                kinfo = self.find_kernel(kdef[0], notify_frontend=False)
+                if kinfo[0] == 'SoS' or kinfo[0] in self.kernels:
+                    continue
+                self.kernel_pool.reserve(kinfo[0], kinfo[1], kinfo[2],
+                    self._get_init_statements(kinfo), on_ready=self._notify_kernel_ready)
+            except Exception as e:
+                env.logger.warning(f'Failed to start subkernel {kdef[0]}: {e}')
+
+    def _notify_kernel_ready(self, name, error):
+        # called from the thread that starts the kernel, so the notification
+        # is sent from the main thread, between the execution of cells
+        self._ready_kernels.append([name, error])
+        if self._main_loop is not None:
+            self._main_loop.add_callback(self._send_kernel_ready)
+
+    def _send_kernel_ready(self):
+        while self._ready_kernels:
+            self.send_frontend_msg('kernel-ready', self._ready_kernels.popleft())
+
+    kernel_pool = property(lambda self:self.get_kernel_pool())
+
     def __init__(self, **kwargs):
         super(SoS_Kernel, self).__init__(**kwargs)
         self.options = ''
@@ -763,10 +882,28 @@ class SoS_Kernel(IPythonKernel):
         self.format_obj = self.shell.display_formatter.format
 
         self.previewers = None
+        # warnings sent by the running previewer, which are cached with the preview
+        self._preview_warnings = None
         self.original_keys = None
         self._supported_languages = None
         self._completer = None
         self._inspector = None
+        self._preview_budget = None
+        self._kernel_pool = None
+        # subkernels started in background, to be notified to the frontend
+        self._ready_kernels = deque()
+        self._main_loop = None
+        self._magic_registry = None
+        self._profiler = None
+        self._exchange = None
+        self.shared_variables = SharedVariableTracker()
+        self.user_ns_sync = NamespaceSync(self.shell)
+        self._kernel_registry = None
+        # cached instances of language modules of subkernels
+        self._language_plugins = {}
+        # replies of subkernels to complete and inspect requests
+        self._request_cache = LRUCache(64)
+        self._parsers = {}
         self._real_execution_count = 1
         self._execution_count = 1
         self._debug_mode = False
@@ -784,8 +921,30 @@ class SoS_Kernel(IPythonKernel):
         self._workflow_mode = False
         self._render_result = False
         self._failed_languages = {}
+        self._notebook_options = None
+        # the kernel is started in the directory of the notebook, which is
+        # kept for files that are linked from the notebook
+        self._notebook_dir = os.getcwd()
+        # merges stream output of the cell being executed
+        self._stream_coalescer = None
+        self._bounded_stream = None
+        self.stream_stats = {'messages_in': 0, 'messages_out': 0}
         env.__task_notifier__ = self.notify_task_status
 
+    def start(self):
+        super(SoS_Kernel, self).start()
+        from tornado import ioloop
+        self._main_loop = ioloop.IOLoop.current()
+        threading.Thread(target=self._preload_modules, daemon=True).start()
+
+    def _preload_modules(self):
+        import importlib
+        for module in self.PRELOAD_MODULES:
+            try:
+                importlib.import_module(module)
+            except Exception as e:
+                env.logger.debug(f'Failed to preload module {module}: {e}')
+
     def handle_taskinfo(self, task_id, task_queue, side_panel=None):
         # requesting information on task
         from sos.hosts import Host
@@ -842,12 +1001,12 @@ class SoS_Kernel(IPythonKernel):
                         ('Kernel', kinfo[1]),
                         ('Language', kinfo[2])
                 ]
-                if kernel not in self.supported_languages:
+                plugin = self.get_language_plugin(kernel)
+                if plugin is None:
                     continue
-                lan = self.supported_languages[kernel]
-                if hasattr(lan, 'sessioninfo'):
+                if hasattr(plugin, 'sessioninfo'):
                     try:
-                        sinfo = lan(self, kinfo[1]).sessioninfo()
+                        sinfo = plugin.sessioninfo()
                         if isinstance(sinfo, str):
                             result[kernel].append([sinfo])
                         elif isinstance(sinfo, dict):
@@ -861,6 +1020,15 @@ class SoS_Kernel(IPythonKernel):
         finally:
             self.switch_kernel(cur_kernel)
         #
+        if self.previewers is not None:
+            from .preview import preview_cache
+            stats = preview_cache.stats()
+            result['Preview cache'] = [
+                ('Hits', stats['hits']),
+                ('Misses', stats['misses']),
+                ('Entries', stats['entries']),
+                ('Size', pretty_size(stats['size']))]
+        #
         if 'sessioninfo' in env.sos_dict:
             result.update(env.sos_dict['sessioninfo'])
         #
@@ -895,6 +1063,10 @@ class SoS_Kernel(IPythonKernel):
             for k,v in content.items():
                 if k == 'list-kernel':
                     self.send_frontend_msg('kernel-list', self.get_kernel_list(v))
+                    # start kernels of the warm pool and of the notebook, if configured
+                    self.get_kernel_pool()
+                    if v:
+                        self.start_notebook_kernels(v)
                 elif k == 'kill-task':
                     # kill specified task
                     from sos.hosts import Host
@@ -1039,6 +1211,7 @@ class SoS_Kernel(IPythonKernel):
             raise RuntimeError(f'Unrecognized status change message {task_status}')
 
     def send_frontend_msg(self, msg_type, msg=None):
+        self.flush_stream()
         # if comm is never created by frontend, the kernel is in test mode without frontend
         if self._use_panel is False and msg_type in ('display_data', 'stream', 'preview-input'):
             if msg_type in ('display_data', 'stream'):
@@ -1056,7 +1229,8 @@ class SoS_Kernel(IPythonKernel):
             self.warn('Frontend communicator is broken. Please restart jupyter server')
 
     def _reset_dict(self):
-        env.sos_dict = WorkflowDict()
+        from sos.eval import SoS_exec
+        env.sos_dict = TrackedWorkflowDict()
         SoS_exec('import os, sys, glob', None)
         SoS_exec('from sos.runtime import *', None)
         SoS_exec("run_mode = 'interactive'", None)
@@ -1094,10 +1268,43 @@ class SoS_Kernel(IPythonKernel):
         return {'status': 'incomplete', 'indent': ''}
 
 
+    def subkernel_request(self, request, code, cursor_pos, timeout, **kwargs):
+        '''Send a complete or inspect request to the active subkernel and return
+        the content of its reply, or None if the subkernel does not reply in time.
+        Leading magics of the cell are not sent to the subkernel. Replies are
+        cached until the next cell is executed.'''
+        offset = 0
+        while code.startswith('%', offset):
+            end = code.find('\n', offset)
+            if end == -1 or end >= cursor_pos:
+                break
+            offset = end + 1
+        key = (self.kernel, request, code[offset:cursor_pos] if request == 'complete' else code[offset:],
+            cursor_pos - offset, tuple(sorted(kwargs.items())))
+        reply = self._request_cache.get(key)
+        if reply is None:
+            if getattr(self, 'KM', None) is None or not self.KM.is_alive():
+                return None
+            msg_id = getattr(self.KC, request)(code[offset:], cursor_pos - offset, **kwargs)
+            reply = shell_request(self.KC, msg_id, timeout)
+            if reply is None or reply.get('status', None) != 'ok':
+                return None
+            if request == 'complete':
+                reply['cursor_start'] += offset
+                reply['cursor_end'] += offset
+            self._request_cache.put(key, reply)
+        return reply
+
     def do_inspect(self, code, cursor_pos, detail_level=0):
         line, offset = line_at_cursor(code, cursor_pos)
+        if self.kernel != 'SoS' and not line.startswith('%'):
+            reply = self.subkernel_request('inspect', code, cursor_pos,
+                self.get_notebook_option('inspection_timeout', 2), detail_level=detail_level)
+            # fall back to SoS variables, actions etc if the subkernel knows nothing
+            if reply is not None and reply.get('found', False):
+                return reply
         name = token_at_cursor(code, cursor_pos)
-        data = self.inspector.inspect(name, line, cursor_pos - offset)
+        data = self.inspector.inspect(name, line, cursor_pos - offset, detail_level)
 
         reply_content = {'status' : 'ok'}
         reply_content['metadata'] = {}
@@ -1107,18 +1314,109 @@ class SoS_Kernel(IPythonKernel):
 
     def do_complete(self, code, cursor_pos):
         text, matches = self.completer.complete_text(code, cursor_pos)
+        cursor_start = cursor_pos - len(text)
+        if self.kernel != 'SoS' and not code[:cursor_pos].rpartition('\n')[2].startswith('%'):
+            # names of the subkernel go before magics, paths and SoS variables
+            reply = self.subkernel_request('complete', code, cursor_pos, self.completer.timeout)
+            if reply is not None and reply['matches']:
+                if reply['cursor_start'] == cursor_start:
+                    matches = reply['matches'] + [x for x in matches if x not in reply['matches']]
+                else:
+                    # matches that replace different text cannot be merged
+                    matches = reply['matches']
+                    cursor_start = reply['cursor_start']
         return {'matches' : matches,
                 'cursor_end' : cursor_pos,
-                'cursor_start' : cursor_pos - len(text),
+                'cursor_start' : cursor_start,
                 'metadata' : {},
                 'status' : 'ok'}
 
     def warn(self, message):
         message = str(message).rstrip() + '\n'
+        if self._preview_warnings is not None:
+            self._preview_warnings.append(message)
         if message.strip():
             self.send_response(self.iopub_socket, 'stream',
                 {'name': 'stderr', 'text': message})
 
+    def send_response(self, *args, **kwargs):
+        # send pending stream output first so that messages are sent in order
+        if self._stream_coalescer is not None:
+            self._stream_coalescer.flush()
+        return super(SoS_Kernel, self).send_response(*args, **kwargs)
+
+    def send_stream(self, name, text):
+        '''Send stream output of the current cell, which can be truncated if
+        the cell produces too much output, and be merged with adjacent stream
+        output by the stream coalescer.'''
+        if self._bounded_stream is None:
+            self._send_stream(name, text)
+        else:
+            self._bounded_stream.write(name, text)
+
+    def _send_stream(self, name, text):
+        if self._stream_coalescer is None:
+            self.send_response(self.iopub_socket, 'stream', {'name': name, 'text': text})
+        else:
+            self._stream_coalescer.write(name, text)
+
+    def _notify_dropped_output(self, lines, size, spill_file):
+        if lines:
+            msg = f'... {lines} line{"s" if lines > 1 else ""} ({pretty_size(size)}) of output omitted'
+        else:
+            msg = f'... {pretty_size(size)} of output omitted'
+        if spill_file:
+            # the link is relative to the directory of the notebook
+            link = os.path.relpath(spill_file, self._notebook_dir)
+            msg += f', complete output saved to <a href="{link}" target="_blank">{spill_file}</a>'
+        self.send_response(self.iopub_socket, 'display_data',
+            {
+                'source': 'SoS',
+                'metadata': {},
+                'data': { 'text/html': HTML(f'<div class="sos_hint">{msg}</div>').data}
+            })
+
+    def _start_bounded_stream(self):
+        head = self.get_notebook_option('output_head_lines', 200)
+        if not head or head < 0:
+            return
+        spill_file = None
+        if self.get_notebook_option('output_spill', False):
+            # saved to the notebook directory, which does not change with %cd
+            spill_file = os.path.join(self._notebook_dir, '.sos',
+                'output_{}_{}.log'.format(os.getpid(), self._real_execution_count))
+        self._bounded_stream = BoundedStream(self._send_stream, self._notify_dropped_output,
+            head=head, tail=max(self.get_notebook_option('output_tail_lines', 10), 0),
+            spill_file=spill_file, head_bytes=self.get_notebook_option('output_head_bytes', 1024 * 1024))
+
+    def _stop_bounded_stream(self):
+        if self._bounded_stream is None:
+            return
+        bounded_stream = self._bounded_stream
+        self._bounded_stream = None
+        bounded_stream.close()
+
+    def flush_stream(self):
+        if self._stream_coalescer is not None:
+            self._stream_coalescer.flush()
+
+    def _start_stream_coalescer(self):
+        self._stream_coalescer = StreamCoalescer(self,
+            window=self.get_notebook_option('stream_window', 0.05),
+            max_size=self.get_notebook_option('stream_max_size', 65536))
+
+    def _stop_stream_coalescer(self):
+        coalescer = self._stream_coalescer
+        if coalescer is None:
+            return
+        coalescer.flush()
+        self._stream_coalescer = None
+        self.stream_stats['messages_in'] += coalescer.messages_in
+        self.stream_stats['messages_out'] += coalescer.messages_out
+        if self._debug_mode:
+            log_to_file(f'Stream messages: {coalescer.messages_in} received, {coalescer.messages_out} sent')
+
+    @profiled('magic')
     def get_magic_and_code(self, code, warn_remaining=False):
         if code.startswith('%') or code.startswith('!'):
             lines = re.split(r'(?<!\\)\n', code, 1)
@@ -1137,6 +1435,80 @@ class SoS_Kernel(IPythonKernel):
             self.warn('Statement {} ignored'.format(short_repr(remaining_code)))
         return command_line, remaining_code
 
+    def get_notebook_option(self, key, default=None):
+        '''Return option key defined in the "sos-notebook" section of sos
+        configuration files (e.g. ~/.sos/config.yml), or default if the option
+        is not defined.'''
+        if self._notebook_options is None:
+            try:
+                from sos.utils import load_config_files
+                self._notebook_options = load_config_files().get('sos-notebook', None) or {}
+            except Exception as e:
+                env.logger.warning(f'Failed to load sos-notebook options: {e}')
+                self._notebook_options = {}
+        return self._notebook_options.get(key, default)
+
+    def relay_subkernel_messages(self, msg_id, handle_iopub, timeout=None):
+        '''Pass iopub messages triggered by request msg_id to handle_iopub until
+        the subkernel becomes idle, and return the shell reply to the request.
+        Instead of polling the channels, this function blocks on both the iopub
+        and shell sockets of the subkernel so that the SoS kernel stays idle
+        while the subkernel is busy. Messages and replies of other (e.g. timed
+        out or silent) requests are discarded.'''
+        import zmq
+        iopub = self.KC.iopub_channel
+        shell = self.KC.shell_channel
+        poller = zmq.Poller()
+        poller.register(iopub.socket, zmq.POLLIN)
+        poller.register(shell.socket, zmq.POLLIN)
+        # time to wait for the reply after the kernel becomes idle, and vice versa
+        reply_timeout = self.get_notebook_option('reply_timeout', 10)
+        # interval to check if the subkernel is still alive
+        poll_interval = self.get_notebook_option('poll_interval', 1)
+
+        start_time = time.time()
+        idle_time = None
+        reply_time = None
+        reply = None
+        while idle_time is None or reply is None:
+            now = time.time()
+            deadlines = []
+            if timeout is not None:
+                deadlines.append(start_time + timeout)
+            if idle_time is not None or reply_time is not None:
+                deadlines.append((idle_time or reply_time) + reply_timeout)
+            if deadlines and now >= min(deadlines):
+                raise TimeoutError(f'Subkernel {self.kernel} failed to respond in time')
+            wait = min([poll_interval] + [x - now for x in deadlines])
+            events = dict(poller.poll(max(wait, 0) * 1000))
+            if not events:
+                if not self.KM.is_alive():
+                    raise RuntimeError(f'Subkernel {self.kernel} died unexpectedly')
+                continue
+            if iopub.socket in events:
+                while iopub.msg_ready():
+                    sub_msg = iopub.get_msg()
+                    parent_id = sub_msg['parent_header'].get('msg_id', msg_id)
+                    if parent_id != msg_id:
+                        if self._debug_mode:
+                            log_to_file(f'Discard message {sub_msg["header"]["msg_type"]} of request {parent_id}')
+                        continue
+                    if sub_msg['header']['msg_type'] == 'status':
+                        if sub_msg['content']['execution_state'] == 'idle':
+                            idle_time = time.time()
+                    else:
+                        handle_iopub(sub_msg)
+            if shell.socket in events:
+                while shell.msg_ready():
+                    msg = shell.get_msg()
+                    if msg['parent_header'].get('msg_id', None) == msg_id:
+                        reply = msg
+                        reply_time = time.time()
+                    elif self._debug_mode:
+                        log_to_file(f'Discard stale reply {msg["header"]["msg_type"]}')
+        return reply
+
+    @profiled('run_cell')
     def run_cell(self, code, silent, store_history, on_error=None):
         #
         if not self.KM.is_alive():
@@ -1144,53 +1516,52 @@ class SoS_Kernel(IPythonKernel):
                                dict(name='stdout', text='Restarting kernel "{}"\n'.format(self.kernel)))
             self.KM.restart_kernel(now=False)
             self.KC = self.KM.client()
-        # flush stale replies, which could have been ignored, due to missed heartbeats
-        while self.KC.shell_channel.msg_ready():
-            self.KC.shell_channel.get_msg()
+            self.KC.start_channels()
+            self.kernels[self.kernel] = (self.KM, self.KC)
+            self._forget_subkernel(self.kernel)
         # executing code in another kernel
-        self.KC.execute(code, silent=silent, store_history=store_history)
+        msg_id = self.KC.execute(code, silent=silent, store_history=store_history)
 
-        # first thing is wait for any side effects (output, stdin, etc.)
-        _execution_state = "busy"
-        while _execution_state != 'idle':
-            # display intermediate print statements, etc.
-            while self.KC.iopub_channel.msg_ready():
-                sub_msg = self.KC.iopub_channel.get_msg()
-                msg_type = sub_msg['header']['msg_type']
-                if self._debug_mode:
-                    log_to_file(f'MSG TYPE {msg_type}')
-                    log_to_file(f'CONTENT  {sub_msg["content"]}')
-                if msg_type == 'status':
-                    _execution_state = sub_msg["content"]["execution_state"]
+        # display intermediate print statements, etc.
+        def relay_output(sub_msg):
+            msg_type = sub_msg['header']['msg_type']
+            if self._debug_mode:
+                log_to_file(f'MSG TYPE {msg_type}')
+                log_to_file(f'CONTENT  {sub_msg["content"]}')
+            if msg_type in ('execute_input', 'execute_result'):
+                # override execution count with the master count,
+                # not sure if it is needed
+                sub_msg['content']['execution_count'] = self._execution_count
+            #
+            if silent and msg_type in ['display_data', 'stream', 'execute_result']:
+                return
+            # NOTE: we do not send status of sub kernel alone because
+            # these are generated automatically during the execution of
+            # "this cell" in SoS kernel
+            if self._render_result and msg_type == 'stream' and sub_msg['content']['name'] == 'stdout':
+                format_dict, md_dict = self.format_obj(self.render_result(sub_msg['content']['text']))
+                self.send_response(self.iopub_socket, 'display_data',
+                    {'source': 'SoS', 'metadata': md_dict,
+                     'data': format_dict
+                    })
+            elif msg_type == 'error':
+                if on_error and not self._debug_mode:
+                    self.warn(on_error)
                 else:
-                    if msg_type in ('execute_input', 'execute_result'):
-                        # override execution count with the master count,
-                        # not sure if it is needed
-                        sub_msg['content']['execution_count'] = self._execution_count
-                    #
-                    if silent and msg_type in ['display_data', 'stream', 'execute_result']:
-                        continue
-                    # NOTE: we do not send status of sub kernel alone because
-                    # these are generated automatically during the execution of
-                    # "this cell" in SoS kernel
-                    if self._render_result and msg_type == 'stream' and sub_msg['content']['name'] == 'stdout':
-                        format_dict, md_dict = self.format_obj(self.render_result(sub_msg['content']['text']))
-                        self.send_response(self.iopub_socket, 'display_data',
-                            {'source': 'SoS', 'metadata': md_dict,
-                             'data': format_dict
-                            })
-                    elif msg_type == 'error':
-                        if on_error and not self._debug_mode:
-                            self.warn(on_error)
-                        else:
-                            self.send_response(self.iopub_socket, msg_type, sub_msg['content'])
-                    elif msg_type == 'stream' and sub_msg['content']['name'] == 'stderr':
-                        self.warn(sub_msg['content']['text'])
-                    else:
-                        self.send_response(self.iopub_socket, msg_type, sub_msg['content'])
+                    self.send_response(self.iopub_socket, msg_type, sub_msg['content'])
+            elif msg_type == 'stream':
+                if sub_msg['content']['name'] == 'stderr':
+                    text = sub_msg['content']['text'].rstrip()
+                    if text.strip():
+                        self.send_stream('stderr', text + '\n')
+                else:
+                    self.send_stream(sub_msg['content']['name'], sub_msg['content']['text'])
+            else:
+                self.send_response(self.iopub_socket, msg_type, sub_msg['content'])
         #
         # now get the real result
-        reply = self.KC.get_shell_msg(timeout=10)
+        reply = self.relay_subkernel_messages(msg_id, relay_output,
+            timeout=self.get_notebook_option('execution_timeout', None))
         reply['content']['execution_count'] = self._execution_count
         return reply['content']
 
@@ -1243,36 +1614,65 @@ Available subkernels:\n{}'''.format(
                 self.warn(f'Switch from {self.kernel} to {kinfo[0]}')
             # case when self.kernel == 'sos', kernel != 'sos'
             # to a subkernel
-            new_kernel = False
-            if kinfo[0] not in self.kernels:
-                # start a new kernel
-                try:
-                    self.kernels[kinfo[0]] = manager.start_new_kernel(
-                            startup_timeout=60, kernel_name=kinfo[1], cwd=os.getcwd())
-                    new_kernel = True
-                except Exception as e:
-                    # try toget error message
-                    import tempfile
-                    with tempfile.TemporaryFile() as ferr:
-                        try:
-                            # this should fail
-                            manager.start_new_kernel(
-                                startup_timeout=60, kernel_name=kinfo[1], cwd=os.getcwd(),
-                                stdout=subprocess.DEVNULL, stderr=ferr)
-                        except:
-                            ferr.seek(0)
-                            self.warn(f'Failed to start kernel "{kernel}". {e}\nError Message:\n{ferr.read().decode()}')
-                    return
+            try:
+                new_kernel = self._start_kernel(kinfo)
+            except Exception as e:
+                self.warn(f'Failed to start kernel "{kernel}". {e}')
+                return
             self.KM, self.KC = self.kernels[kinfo[0]]
             self.RET_VARS = [] if ret_vars is None else ret_vars
             self.kernel = kinfo[0]
-            if new_kernel and self.kernel in self.supported_languages:
-                init_stmts = self.supported_languages[self.kernel](self, kinfo[1]).init_statements
-                if init_stmts:
-                    self.run_cell(init_stmts, True, False)
+            if new_kernel:
+                self._init_kernel(kinfo)
             #
             self.handle_magic_get(in_vars)
 
+    def _start_kernel(self, kinfo):
+        '''Start subkernel kinfo if it is not running. Return True if a new
+        kernel is started and needs to be initialized.'''
+        if kinfo[0] in self.kernels:
+            return False
+        self._forget_subkernel(kinfo[0])
+        # start a new kernel, or take one from the pool of started kernels
+        warm = self.kernel_pool.claim(kinfo[0],
+            timeout=self.get_notebook_option('startup_timeout', 60))
+        if warm is None:
+            warm = self.kernel_pool.acquire(kinfo[1])
+        if warm is None:
+            self.kernels[kinfo[0]] = start_subkernel(kinfo[1], cwd=os.getcwd(),
+                startup_timeout=self.get_notebook_option('startup_timeout', 60))
+            return True
+        self.kernels[kinfo[0]] = (warm.km, warm.kc)
+        # kernels in the pool are initialized for the language of the kernel
+        return warm.language != kinfo[2]
+
+    def _init_kernel(self, kinfo):
+        # execute initialization statements of the language module in the
+        # current subkernel
+        if kinfo[0] in self.supported_languages:
+            init_stmts = self._get_init_statements(kinfo)
+            if init_stmts:
+                self.run_cell(init_stmts, True, False)
+
+    @contextlib.contextmanager
+    def use_subkernel(self, kernel):
+        '''Temporarily execute statements (e.g. by run_cell and language modules)
+        in subkernel kernel, which is started if needed. Unlike switch_kernel,
+        no variables are passed between the subkernel and SoS.'''
+        kinfo = self.find_kernel(kernel)
+        if kinfo[0] == 'SoS':
+            raise ValueError('use_subkernel can only be used for subkernels')
+        new_kernel = self._start_kernel(kinfo)
+        saved = self.kernel, getattr(self, 'KM', None), getattr(self, 'KC', None)
+        self.KM, self.KC = self.kernels[kinfo[0]]
+        self.kernel = kinfo[0]
+        try:
+            if new_kernel:
+                self._init_kernel(kinfo)
+            yield kinfo
+        finally:
+            self.kernel, self.KM, self.KC = saved
+
     def shutdown_kernel(self, kernel, restart=False):
         kernel = self.find_kernel(kernel)[0]
         if kernel == 'SoS':
@@ -1302,6 +1702,7 @@ Available subkernels:\n{}'''.format(
                     self.warn(f'Failed to shutdown kernel {kernel}: {e}\n')
                 finally:
                     self.kernels.pop(kernel)
+                    self._forget_subkernel(kernel)
         else:
             self.send_response(self.iopub_socket, 'stream',
                                dict(name='stdout', text='Specify one of the kernels to shutdown: SoS{}\n'
@@ -1344,7 +1745,7 @@ Available subkernels:\n{}'''.format(
     def handle_magic_dict(self, line):
         'Magic that displays content of the dictionary'
         # do not return __builtins__ beacuse it is too long...
-        parser = self.get_dict_parser()
+        parser = self.get_parser('dict')
         try:
             args = parser.parse_args(shlex.split(line))
         except SystemExit:
@@ -1373,12 +1774,13 @@ Available subkernels:\n{}'''.format(
             else:
                 self.send_result({x for x in env.sos_dict._dict.keys() if not x.startswith('__')} - self.original_keys)
         else:
+            # large variables are replaced by their summaries
             if args.all:
-                self.send_result(env.sos_dict._dict)
+                self.send_result(self.preview_budget.limit_dict(env.sos_dict._dict))
             elif args.vars:
-                self.send_result({x:y for x,y in env.sos_dict._dict.items() if x in args.vars})
+                self.send_result(self.preview_budget.limit_dict({x:y for x,y in env.sos_dict._dict.items() if x in args.vars}))
             else:
-                self.send_result({x:y for x,y in env.sos_dict._dict.items() if x not in self.original_keys and not x.startswith('__')})
+                self.send_result(self.preview_budget.limit_dict({x:y for x,y in env.sos_dict._dict.items() if x not in self.original_keys and not x.startswith('__')}))
 
     def handle_magic_set(self, options):
         if options.strip():
@@ -1399,10 +1801,15 @@ Available subkernels:\n{}'''.format(
                 self.send_response(self.iopub_socket, 'stream',
                     {'name': 'stdout', 'text': 'Usage: set persistent sos command line options such as "-v 3" (debug output)\n'})
 
+    @profiled('get')
     def handle_magic_get(self, items, from_kernel=None, explicit=False):
         if from_kernel is None or from_kernel.lower() == 'sos':
-            # autmatically get all variables with names start with 'sos'
-            default_items = [x for x in env.sos_dict.keys() if x.startswith('sos') and x not in self.original_keys]
+            # autmatically get all variables with names start with 'sos', if they
+            # have been changed since they were last sent to or received from
+            # the subkernel
+            default_items, fingerprints = self.shared_variables.changed(self.kernel,
+                {x: env.sos_dict[x] for x in env.sos_dict.keys() if x.startswith('sos')
+                    and x not in self.original_keys and (not items or x not in items)})
             items = default_items if not items else items + default_items
             for item in items:
                 if item not in env.sos_dict:
@@ -1410,14 +1817,16 @@ Available subkernels:\n{}'''.format(
                     return
             if not items:
                 return
-            if self.kernel in self.supported_languages:
-                lan = self.supported_languages[self.kernel]
-                kinfo = self.find_kernel(self.kernel)
+            plugin = self.get_language_plugin(self.kernel)
+            if plugin is not None:
                 try:
-                    lan(self, kinfo[1]).get_vars(items)
+                    items = self._export_vars(plugin, items)
+                    if items:
+                        plugin.get_vars(items)
                 except Exception as e:
                     self.warn(f'Failed to get variable: {e}\n')
                     return
+                self.shared_variables.record(self.kernel, fingerprints)
             elif self.kernel == 'SoS':
                 self.warn('Magic %get without option --kernel can only be executed by subkernels')
                 return
@@ -1429,55 +1838,83 @@ Available subkernels:\n{}'''.format(
             # if another kernel is specified and the current kernel is sos
             # we get from subkernel
             try:
-                self.switch_kernel(from_kernel)
-                self.handle_magic_put(items)
+                with self.use_subkernel(from_kernel):
+                    self.handle_magic_put(items)
             except Exception as e:
                 self.warn(f'Failed to get {", ".join(items)} from {from_kernel}: {e}')
-            finally:
-                self.switch_kernel('SoS')
         else:
             # if another kernel is specified, we should try to let that kernel pass
             # the variables to this one directly
             try:
-                my_kernel = self.kernel
-                self.switch_kernel(from_kernel)
-                # put stuff to sos or my_kernel directly
-                self.handle_magic_put(items, to_kernel=my_kernel, explicit=explicit)
+                self.transfer_vars(items, from_kernel, self.kernel, explicit=explicit)
             except Exception as e:
                 self.warn(f'Failed to get {", ".join(items)} from {from_kernel}: {e}')
-            finally:
-                # then switch back
-                self.switch_kernel(my_kernel)
+
+    def _export_vars(self, plugin, items):
+        '''Pass large arrays and data frames among items to the subkernel
+        through shared memory files if supported by the language module, and
+        return names of the remaining variables.'''
+        formats = getattr(plugin, 'exchange_formats', None)
+        if not formats or self.exchange is None:
+            return items
+        descriptors = [self.exchange.export(x, env.sos_dict[x], formats) for x in items]
+        descriptors = [x for x in descriptors if x is not None]
+        if not descriptors:
+            return items
+        try:
+            plugin.load_vars(descriptors)
+        finally:
+            self.exchange.release(descriptors)
+        if self._debug_mode:
+            self.warn('Exchanged {} through shared memory'.format(
+                ', '.join(f'{x["name"]} ({pretty_size(x["size"])})' for x in descriptors)))
+        exported = {x['name'] for x in descriptors}
+        return [x for x in items if x not in exported]
+
+    def _import_vars(self, plugin, items):
+        '''Receive large arrays and data frames among items from the subkernel
+        through shared memory files if supported by the language module.
+        Return a dictionary of received variables and names of the remaining
+        variables.'''
+        formats = getattr(plugin, 'exchange_formats', None)
+        if not items or not formats or not hasattr(plugin, 'save_vars') or self.exchange is None:
+            return {}, items
+        descriptors = plugin.save_vars(items, formats, self.exchange.directory,
+            self.exchange.threshold) or {}
+        objects = {}
+        try:
+            for name, descriptor in descriptors.items():
+                objects[name] = self.exchange.load(descriptor)
+        finally:
+            self.exchange.release(descriptors.values())
+        return objects, [x for x in items if x not in objects]
 
     def get_response(self, statement, msg_types, name=None):
         # get response of statement of specific msg types.
         responses = []
-        self.KC.execute(statement, silent=False, store_history=False)
-        # first thing is wait for any side effects (output, stdin, etc.)
-        _execution_state = "busy"
-        while _execution_state != 'idle':
-            # display intermediate print statements, etc.
-            while self.KC.iopub_channel.msg_ready():
-                sub_msg = self.KC.iopub_channel.get_msg()
-                msg_type = sub_msg['header']['msg_type']
+        msg_id = self.KC.execute(statement, silent=False, store_history=False)
+
+        def capture_response(sub_msg):
+            msg_type = sub_msg['header']['msg_type']
+            if self._debug_mode:
+                log_to_file(f'Received {msg_type} {sub_msg["content"]}')
+            if msg_type in msg_types and (name is None or sub_msg['content'].get('name', None) in name):
                 if self._debug_mode:
-                    log_to_file(f'Received {msg_type} {sub_msg["content"]}')
-                if msg_type == 'status':
-                    _execution_state = sub_msg["content"]["execution_state"]
-                else:
-                    if msg_type in msg_types and (name is None or sub_msg['content'].get('name', None) in name):
-                        if self._debug_mode:
-                            log_to_file(f'Capture response: {msg_type}: {sub_msg["content"]}')
-                        responses.append([msg_type, sub_msg['content']])
-                    else:
-                        if self._debug_mode:
-                            log_to_file(f'Non-response: {msg_type}: {sub_msg["content"]}')
-                        self.send_response(self.iopub_socket, msg_type, sub_msg['content'])
+                    log_to_file(f'Capture response: {msg_type}: {sub_msg["content"]}')
+                responses.append([msg_type, sub_msg['content']])
+            else:
+                if self._debug_mode:
+                    log_to_file(f'Non-response: {msg_type}: {sub_msg["content"]}')
+                self.send_response(self.iopub_socket, msg_type, sub_msg['content'])
+        # first thing is wait for any side effects (output, stdin, etc.)
+        self.relay_subkernel_messages(msg_id, capture_response,
+            timeout=self.get_notebook_option('execution_timeout', None))
         if not responses and self._debug_mode:
             self.warn(f'Failed to get a response from message type {msg_types}')
 
         return responses
 
+    @profiled('put')
     def handle_magic_put(self, items, to_kernel=None, explicit=False):
         if self.kernel.lower() == 'sos':
             if to_kernel is None:
@@ -1485,78 +1922,131 @@ Available subkernels:\n{}'''.format(
                 return
             # if another kernel is specified and the current kernel is sos
             try:
-                # switch to kernel and bring in items
-                self.switch_kernel(to_kernel, in_vars=items)
+                # bring in items to the subkernel
+                with self.use_subkernel(to_kernel):
+                    self.handle_magic_get(items)
+            except Exception as e:
+                self.warn(f'Failed to put {", ".join(items)} to {to_kernel}: {e}')
+        elif to_kernel is not None and to_kernel.lower() != 'sos':
+            # put directly to another subkernel
+            try:
+                self.transfer_vars(items if items else [], self.kernel, to_kernel, explicit=explicit)
             except Exception as e:
                 self.warn(f'Failed to put {", ".join(items)} to {to_kernel}: {e}')
-            finally:
-                # switch back
-                self.switch_kernel('SoS')
         else:
-            # put to sos kernel or another kernel
+            # put to sos kernel
             #
             # items can be None if unspecified
             if not items:
                 # we do not simply return because we need to return default variables (with name startswith sos
                 items = []
-            if self.kernel not in self.supported_languages:
+            plugin = self.get_language_plugin(self.kernel)
+            if plugin is None:
                 if explicit:
                     self.warn(f'Subkernel {self.kernel} does not support magic %put.')
                 return
             #
-            lan = self.supported_languages[self.kernel]
-            kinfo = self.find_kernel(self.kernel)
-            # pass language name to to_kernel
-            if to_kernel:
-                objects = lan(self, kinfo[1]).put_vars(items, to_kernel=self.find_kernel(to_kernel)[2])
-            else:
-                objects = lan(self, kinfo[1]).put_vars(items, to_kernel='SoS')
+            exchanged, items = self._import_vars(plugin, items)
+            objects = plugin.put_vars(items, to_kernel='SoS')
+            if exchanged:
+                env.sos_dict.update(exchanged)
             if isinstance(objects, dict):
                 # returns a SOS dictionary
                 try:
                     env.sos_dict.update(objects)
                 except Exception as e:
-                    self.warn(f'Failed to put {", ".join(items)} to {to_kernel}: {e}')
+                    self.warn(f'Failed to put {", ".join(items)} to SoS kernel: {e}')
                     return
-
-                if to_kernel is None:
-                    return
-                # if another kernel is specified and the current kernel is not sos
-                # we need to first put to sos then to another kernel
-                try:
-                    my_kernel = self.kernel
-                    # switch to the destination kernel and bring in vars
-                    self.switch_kernel(to_kernel, in_vars=items)
-                except Exception as e:
-                    self.warn(f'Failed to put {", ".join(items)} to {to_kernel}: {e}')
-                finally:
-                    # switch back to the original kernel
-                    self.switch_kernel(my_kernel)
+                # the subkernel has the same copy of received shared variables,
+                # and no longer has the shared variables it did not return
+                self.shared_variables.retain(self.kernel, set(objects) | set(exchanged))
+                self.shared_variables.record(self.kernel, self.shared_variables.changed(self.kernel,
+                    {x: y for x, y in objects.items() if x.startswith('sos')})[1])
             elif isinstance(objects, str):
-                # an statement that will be executed in the destination kernel
-                if to_kernel is None or to_kernel == 'SoS':
-                    # evaluate in SoS, this should not happen or rarely happen
-                    # because the subkernel should return a dictionary for SoS kernel
-                    try:
-                        exec(objects, env.sos_dict._dict)
-                    except Exception as e:
-                        self.warn(f'Failed to put variables {items} to SoS kernel: {e}')
-                        return
+                # evaluate in SoS, this should not happen or rarely happen
+                # because the subkernel should return a dictionary for SoS kernel
+                # shared variables of the subkernel are unknown
+                self.shared_variables.forget(self.kernel)
                 try:
-                    my_kernel = self.kernel
-                    # switch to the destination kernel
-                    self.switch_kernel(to_kernel)
-                    # execute the statement to pass variables directly to destination kernel
-                    self.run_cell(objects, True, False)
+                    self.user_ns_sync.add_code(objects)
+                    exec(objects, env.sos_dict._dict)
                 except Exception as e:
-                    self.warn(f'Failed to put {", ".join(items)} to {to_kernel}: {e}')
-                finally:
-                    # switch back to the original kernel
-                    self.switch_kernel(my_kernel)
+                    self.warn(f'Failed to put variables {items} to SoS kernel: {e}')
+                    return
             else:
-                self.warn(f'Unrecognized return value of type {object.__class__.__name__} for action %put')
+                self.warn(f'Unrecognized return value of type {objects.__class__.__name__} for action %put')
                 return
 
+    @profiled('transfer')
+    def transfer_vars(self, items, from_kernel, to_kernel, explicit=False):
+        '''Transfer variables items from subkernel from_kernel to subkernel
+        to_kernel without switching kernels. Variables are passed through shared
+        memory files if both language modules support a common exchange format,
+        then by statements returned by put_vars of from_kernel that are executed
+        in to_kernel. Only if put_vars returns values, they are passed through
+        the SoS dictionary. Return a dictionary with the transferred variables,
+        approximate number of bytes moved, and time taken.'''
+        start_time = time.time()
+        src = self.find_kernel(from_kernel)
+        dst = self.find_kernel(to_kernel)
+        report = {'items': [], 'bytes': 0, 'time': 0}
+        if src[0] == dst[0]:
+            return report
+        src_plugin = self.get_language_plugin(src[0])
+        dst_plugin = self.get_language_plugin(dst[0])
+        for kinfo, plugin in ((src, src_plugin), (dst, dst_plugin)):
+            if plugin is None:
+                if explicit:
+                    self.warn(f'Subkernel {kinfo[0]} does not support passing of variables.')
+                return report
+        #
+        # 1. through exchange files in a format that both kernels understand
+        formats = [x for x in getattr(src_plugin, 'exchange_formats', None) or []
+            if x in (getattr(dst_plugin, 'exchange_formats', None) or [])]
+        if items and formats and hasattr(src_plugin, 'save_vars') and self.exchange is not None:
+            with self.use_subkernel(src[0]):
+                descriptors = src_plugin.save_vars(items, formats, self.exchange.directory,
+                    self.exchange.threshold) or {}
+            if descriptors:
+                try:
+                    with self.use_subkernel(dst[0]):
+                        dst_plugin.load_vars(list(descriptors.values()))
+                finally:
+                    self.exchange.release(descriptors.values())
+                report['items'].extend(descriptors.keys())
+                report['bytes'] += sum(x['size'] for x in descriptors.values())
+                items = [x for x in items if x not in descriptors]
+        #
+        # 2. through put_vars of the source kernel, which also returns automatically
+        # shared variables if no variable is specified
+        if items or not report['items']:
+            with self.use_subkernel(src[0]):
+                objects = src_plugin.put_vars(items, to_kernel=dst[2])
+            if isinstance(objects, str):
+                # a statement that will be executed in the destination kernel
+                with self.use_subkernel(dst[0]):
+                    self.run_cell(objects, True, False)
+                report['bytes'] += len(objects)
+            elif isinstance(objects, dict):
+                # values are returned to SoS and have to be sent to the destination kernel
+                # only these variables, not other automatically shared variables
+                # that %get would also send, are sent to the destination kernel
+                env.sos_dict.update(objects)
+                with self.use_subkernel(dst[0]):
+                    names = self._export_vars(dst_plugin, list(objects.keys()))
+                    if names:
+                        dst_plugin.get_vars(names)
+                report['bytes'] += sum(sys.getsizeof(x) for x in objects.values())
+                items = list(objects.keys())
+            else:
+                raise ValueError(f'Unrecognized return value of type {objects.__class__.__name__} for action %put')
+            report['items'].extend(items)
+        report['time'] = time.time() - start_time
+        if self._debug_mode:
+            self.warn(f'Transferred {", ".join(report["items"])} from {src[0]} to {dst[0]}: '
+                f'{pretty_size(report["bytes"])} in {report["time"]:.2f} seconds')
+        return report
+
     def handle_magic_pull(self, args):
         from sos.hosts import Host
         if args.config:
@@ -1611,7 +2101,9 @@ Available subkernels:\n{}'''.format(
         except Exception as e:
             self.warn(f'Failed to send {", ".join(args.items)}: {e}')
 
+    @profiled('interpolate')
     def _interpolate_text(self, text, quiet=False):
+        from sos.eval import interpolate
         # interpolate command
         try:
             new_text = interpolate(text, local_dict=env.sos_dict._dict)
@@ -1710,6 +2202,9 @@ Available subkernels:\n{}'''.format(
         to_dir = option.strip()
         try:
             os.chdir(os.path.expanduser(to_dir))
+            # directory listings of the completer are listed again after %cd
+            if self._completer is not None:
+                self._completer.listings.clear()
             self.send_response(self.iopub_socket, 'stream',
                 {'name': 'stdout', 'text': os.getcwd()})
         except Exception as e:
@@ -1727,7 +2222,10 @@ Available subkernels:\n{}'''.format(
             self.warn(e)
 
     def run_sos_code(self, code, silent):
+        from .workflow_executor import runfile
+        from .step_executor import PendingTasks
         code = dedent(code)
+        self.user_ns_sync.add_code(code)
         with self.redirect_sos_io():
             try:
                 # record input and output
@@ -1821,6 +2319,7 @@ Available subkernels:\n{}'''.format(
         if item in env.sos_dict:
             obj = env.sos_dict[item]
         else:
+            from sos.eval import SoS_eval
             obj = SoS_eval(item)
         # get the basic information of object
         txt = type(obj).__name__
@@ -1846,10 +2345,12 @@ Available subkernels:\n{}'''.format(
                     raise ValueError(f'Unrecognized return value from visualizer: {short_repr(result)}.')
             except Exception as e:
                 self.warn(f'Failed to preview variable: {e}')
-                return txt, self.format_obj(obj)
+                return txt, self.format_obj(self.preview_budget.limit(obj))
         else:
-            return txt, self.format_obj(obj)
+            # a summary of the variable is displayed if its repr is too large
+            return txt, self.format_obj(self.preview_budget.limit(obj))
 
+    @profiled('preview')
     def preview_file(self, filename, style=None):
         if not os.path.isfile(filename):
             self.warn('\n> ' + filename + ' does not exist')
@@ -1862,42 +2363,39 @@ Available subkernels:\n{}'''.format(
                      f'<div class="sos_hint">> {filename} ({pretty_size(os.path.getsize(filename))}):</div>').data,
                 }
              })
-        previewer_func = None
         # lazy import of previewers
+        from .preview import preview_cache, PREVIEW_OPTIONS, UNCACHED_PREVIEWERS
         if self.previewers is None:
-            from .preview import get_previewers
-            self.previewers = get_previewers()
-        for x, y, _ in self.previewers:
-            if isinstance(x, str):
-                if fnmatch.fnmatch(os.path.basename(filename), x):
-                    # we load entrypoint only before it is used. This is to avoid
-                    # loading previewers that require additional external modules
-                    # we can cache the loaded function but there does not seem to be
-                    # a strong performance need for this.
-                    previewer_func = y.load()
-                    break
-            else:
-                # it should be a function
-                try:
-                    if x(filename):
-                        try:
-                            previewer_func = y.load()
-                        except Exception as e:
-                            self.send_frontend_msg('stream', dict(name='stderr',
-                                                                  text=f'Failed to load previewer {y}: {e}'))
-                            continue
-                        break
-                except Exception as e:
-                    self.send_frontend_msg('stream', {
-                                'name': 'stderr',
-                                'text': str(e)})
-                    continue
+            from .preview import get_previewers, PreviewerDispatcher, PREVIEW_CACHE_DIR
+            self.previewers = PreviewerDispatcher(get_previewers())
+            # the cache stays with the notebook after %cd
+            preview_cache.directory = os.path.join(self._notebook_dir, PREVIEW_CACHE_DIR)
+            preview_cache.max_bytes = self.get_notebook_option('preview_cache_size', preview_cache.max_bytes)
+        previewer_func = self.previewers.find(filename,
+            on_error=lambda msg: self.send_frontend_msg('stream', {'name': 'stderr', 'text': msg}))
         #
         # if no previewer can be found
         if previewer_func is None:
             return
         try:
-            result = previewer_func(filename, self, style)
+            # previews of unchanged files are reused, with warnings that were
+            # sent by the previewer
+            name = f'{previewer_func.__module__}:{previewer_func.__qualname__}'
+            key = file_key(filename, name, None if style is None else (style['style'], tuple(style['options'])),
+                tuple(self.get_notebook_option(x, None) for x in PREVIEW_OPTIONS))
+            cached = None if name in UNCACHED_PREVIEWERS else preview_cache.get(key)
+            if cached is None:
+                self._preview_warnings = []
+                try:
+                    result = previewer_func(filename, self, style)
+                finally:
+                    warnings, self._preview_warnings = self._preview_warnings, None
+                if name not in UNCACHED_PREVIEWERS:
+                    preview_cache.put(key, (result, warnings))
+            else:
+                result, warnings = cached
+                for warning in warnings:
+                    self.warn(warning)
             if not result:
                 return
             if isinstance(result, str):
@@ -1906,7 +2404,7 @@ Available subkernels:\n{}'''.format(
             elif isinstance(result, dict):
                 self.send_frontend_msg('display_data',
                     {'source': filename, 'data': result, 'metadata': {}})
-            elif isinstance(result, [list, tuple]) and len(result) == 2:
+            elif isinstance(result, (list, tuple)) and len(result) == 2:
                 self.send_frontend_msg('display_data',
                     {'source': filename, 'data': result[0], 'metadata': result[1]})
             else:
@@ -1941,13 +2439,11 @@ Available subkernels:\n{}'''.format(
                 {'execution_count': self._execution_count, 'data': format_dict,
                 'metadata': md_dict})
 
-    def get_kernel_list(self, notebook_kernel_list=None):
-        if not hasattr(self, '_kernel_list'):
-            from jupyter_client.kernelspec import KernelSpecManager
-            km = KernelSpecManager()
-            specs = km.find_kernel_specs()
+    def get_kernel_registry(self):
+        if self._kernel_registry is None:
+            specs = find_kernel_specs()
             # get supported languages
-            self._kernel_list = []
+            registry = SubkernelRegistry()
             lan_map = {}
             for x in self.supported_languages.keys():
                 for lname, knames in self.supported_languages[x].supported_kernels.items():
@@ -1955,25 +2451,25 @@ Available subkernels:\n{}'''.format(
                         if x != kname:
                             lan_map[kname] = (lname, self.supported_languages[x].background_color,
                                 getattr(self._supported_languages[x], 'options', {}))
-            # kernel_list has the following items
-            #
-            # 1. displayed name
-            # 2. kernel name
-            # 3. language name
-            # 4. color
             for spec in specs.keys():
                 if spec == 'sos':
                     # the SoS kernel will be default theme color.
-                    self._kernel_list.append(['SoS', 'sos', '', '', {
+                    registry.add(['SoS', 'sos', '', '', {
                         'variable_pattern': r'^[_A-Za-z0-9\.]+\s*$',
                         'assignment_pattern': r'^([_A-Za-z0-9\.]+)\s*=.*$'}])
                 elif spec in lan_map:
                     # e.g. ir ==> R
-                    self._kernel_list.append([lan_map[spec][0], spec, lan_map[spec][0], lan_map[spec][1],
+                    registry.add([lan_map[spec][0], spec, lan_map[spec][0], lan_map[spec][1],
                         lan_map[spec][2]])
                 else:
                     # undefined language also use default theme color
-                    self._kernel_list.append([spec, spec, '', '', {}])
+                    registry.add([spec, spec, '', '', {}])
+            self._kernel_registry = registry
+        return self._kernel_registry
+
+    kernel_registry = property(lambda self:self.get_kernel_registry())
+
+    def get_kernel_list(self, notebook_kernel_list=None):
         # now, using a list of kernels sent from the kernel, we might need to adjust
         # our list or create new kernels.
         if notebook_kernel_list is not None:
@@ -1985,9 +2481,8 @@ Available subkernels:\n{}'''.format(
                     # otherwise do not worry about it.
                     env.logger.warning(
                         f'Failed to locate subkernel {name} with kernerl "{kernel}" and language "{lan}": {e}')
-        # sort kernel list by name to avoid unnecessary change of .ipynb files
-        self._kernel_list.sort(key=lambda x: x[0])
-        return self._kernel_list
+        # kernel list is sorted by name
+        return self.kernel_registry.sorted()
 
     def do_execute(self, code, silent, store_history=True, user_expressions=None,
                    allow_stdin=False):
@@ -1995,17 +2490,27 @@ Available subkernels:\n{}'''.format(
             self.warn(code)
         # a flag for if the kernel is hard switched (by %use)
         self.hard_switch_kernel = False
+        # names and documentation of the subkernel may change after the cell
+        self._request_cache.clear()
+        self._start_stream_coalescer()
+        self._start_bounded_stream()
+        self.profiler.start_cell(self._real_execution_count)
         # evaluate user expression
         try:
             ret = self._do_execute(code=code, silent=silent, store_history=store_history,
                 user_expressions=user_expressions, allow_stdin=allow_stdin)
         except Exception as e:
+            self.profiler.end_cell()
             return {'status': 'error',
                     'ename': e.__class__.__name__,
                     'evalue': str(e),
                     'traceback': [],
                     'execution_count': self._execution_count,
                    }
+        finally:
+            self._stop_bounded_stream()
+            self._stop_stream_coalescer()
+            self._send_kernel_ready()
 
         if ret is None:
             ret = {'status': 'ok',
@@ -2014,6 +2519,7 @@ Available subkernels:\n{}'''.format(
 
         out = {}
         for key, expr in (user_expressions or {}).items():
+            from sos.eval import SoS_eval
             try:
                 #value = self.shell._format_user_obj(SoS_eval(expr))
                 value = SoS_eval(expr)
@@ -2027,412 +2533,456 @@ Available subkernels:\n{}'''.format(
         if not silent and store_history:
             self._real_execution_count += 1
         self._execution_count = self._real_execution_count
-        # make sure post_executed is triggered after the completion of all cell content
-        self.shell.user_ns.update(env.sos_dict._dict)
-        # trigger post processing of object and display matplotlib figures
-        self.shell.events.trigger('post_execute')
+        with phase('post_execute'):
+            # make sure post_executed is triggered after the completion of all cell content
+            self.user_ns_sync.sync(env.sos_dict)
+            # trigger post processing of object and display matplotlib figures
+            self.shell.events.trigger('post_execute')
         # tell the frontend the kernel for the "next" cell
         if store_history:
             self.send_frontend_msg('default-kernel', self.kernel)
+        self.profiler.end_cell()
         return ret
 
     def remove_leading_comments(self, code):
-        lines = code.splitlines()
+        # this function is called for each magic of a cell so we only scan
+        # the leading lines instead of splitting the entire cell
+        pos = 0
+        while pos < len(code):
+            end = code.find('\n', pos)
+            line = code[pos:] if end == -1 else code[pos:end]
+            if line.strip() and not line.startswith('#'):
+                return code[pos:-1] if code.endswith('\n') else code[pos:]
+            if end == -1:
+                break
+            pos = end + 1
+        # if all line is empty
+        return ''
+
+    def _run_subkernel_cell(self, code, silent, store_history):
+        # handle string interpolation before sending to the underlying kernel
+        if code:
+            self.last_executed_code = code
+        #code = self._interpolate_text(code, quiet=False)
+        if self.cell_idx is not None:
+            self.send_frontend_msg('cell-kernel', [self.cell_idx, self.kernel])
+            self.cell_idx = None
+        if code is None:
+            return
         try:
-            idx = [x.startswith('#') or not x.strip() for x in lines].index(False)
-            return '\n'.join(lines[idx:])
-        except Exception:
-            # if all line is empty
-            return ''
+            return self.run_cell(code, silent, store_history)
+        except KeyboardInterrupt:
+            self.warn('Keyboard Interrupt\n')
+            self.KM.interrupt_kernel()
+            return {'status': 'abort', 'execution_count': self._execution_count}
+
+    def _magic_skip(self, code, silent, store_history, user_expressions, allow_stdin):
+        self.warn('The %skip magic is deprecated and will be removed later.')
+        return {'status': 'ok', 'payload': [], 'user_expressions': {}, 'execution_count': self._execution_count}
+
+    def _magic_render(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        parser = self.get_parser('render')
+        try:
+            args = parser.parse_args(shlex.split(options))
+        except SystemExit:
+            return
+        try:
+            self._render_result = args.format
+            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+        finally:
+            self._render_result = False
 
-    def _do_execute(self, code, silent, store_history=True, user_expressions=None,
-                   allow_stdin=False):
-        # if the kernel is SoS, remove comments and newlines
-        code = self.remove_leading_comments(code)
+    def _magic_sessioninfo(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        parser = self.get_parser('sessioninfo')
+        try:
+            args = parser.parse_known_args(shlex.split(options))
+        except SystemExit:
+            return
+        self.handle_sessioninfo()
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _magic_toc(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        self.send_frontend_msg('show_toc')
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _magic_dict(self, code, silent, store_history, user_expressions, allow_stdin):
+        # %dict should be the last magic
+        options, remaining_code = self.get_magic_and_code(code, False)
+        self.handle_magic_dict(options)
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _magic_connect_info(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        from jupyter_client import find_connection_file
+        cfile = find_connection_file()
+        with open(cfile) as conn:
+            conn_info = conn.read()
+        self.send_response(self.iopub_socket, 'stream',
+              {'name': 'stdout', 'text': 'Connection file: {}\n{}'.format(cfile, conn_info)})
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _magic_matplotlib(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        try:
+            self.shell.enable_gui = lambda gui: None
+            self.shell.enable_matplotlib(options)
+        except Exception as e:
+            self.warn('Failed to set matplotlib backnd {}: {}'.format(options, e))
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _magic_set(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        self.handle_magic_set(options)
+        # self.options will be set to inflence the execution of remaing_code
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _magic_expand(self, code, silent, store_history, user_expressions, allow_stdin):
+        lines = code.splitlines() 
+        options = lines[0]
+        parser = self.get_parser('expand')
+        try:
+            args = parser.parse_args(options.split()[1:])
+        except SystemExit:
+            return
+        if args.sigil in ('None', None):
+            sigil = None
+        if args.right_sigil is not None:
+            sigil = f'{args.sigil} {args.right_sigil}'
+        # now we need to expand the text, but separate the magics first
+        lines = lines[1:]
+        line_start = 0
+        for idx, line in enumerate(lines):
+            if line.strip() and not line.startswith('%') and not line.startswith('!'):
+                start_line = idx
+                break
+        text = '\n'.join(lines[start_line:])
+        if sigil is not None and sigil != '{ }':
+            from sos.parser import replace_sigil
+            text = replace_sigil(text, sigil)
+        from sos.eval import interpolate
+        try:
+            interpolated = interpolate(text, local_dict=env.sos_dict._dict)
+            remaining_code = '\n'.join(lines[:start_line] + [interpolated]) + '\n'
+            # self.options will be set to inflence the execution of remaing_code
+            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+        except Exception as e:
+            self.warn(e)
+            return
 
-        if self.original_keys is None:
-            self._reset_dict()
-        if code == 'import os\n_pid = os.getpid()':
-            # this is a special probing command from vim-ipython. Let us handle it specially
-            # so that vim-python can get the pid.
+    def _magic_shutdown(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        parser = self.get_parser('shutdown')
+        try:
+            args = parser.parse_args(shlex.split(options))
+        except SystemExit:
             return
-        if self.MAGIC_SKIP.match(code):
-            self.warn('The %skip magic is deprecated and will be removed later.')
-            return {'status': 'ok', 'payload': [], 'user_expressions': {}, 'execution_count': self._execution_count}
-        elif self.MAGIC_RENDER.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
-            parser = self.get_render_parser()
+        self.shutdown_kernel(args.kernel if args.kernel else self.kernel, args.restart)
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _magic_clear(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        parser = self.get_parser('clear')
+        try:
+            args = parser.parse_args(options.split())
+        except SystemExit:
+            return
+        # self.cell_idx could be reset by _do_execute
+        cell_idx = self.cell_idx
+        try:
+            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+        finally:
+            if args.status:
+                status_style = [self.status_class[x] for x in args.status]
+            else:
+                status_style = None
+            self.send_frontend_msg('clear-output', [cell_idx, args.all, status_style])
+
+    def _magic_frontend(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        try:
+            parser = self.get_parser('frontend')
             try:
                 args = parser.parse_args(shlex.split(options))
             except SystemExit:
                 return
+            self.cell_idx = args.cell_idx
+            # for panel cell, we return a non-informative execution count
+            if self.cell_idx is None or self.cell_idx < 0:
+                self._execution_count = '-'
+            self._notebook_name = args.filename if args.filename else 'Untitled'
+        except Exception as e:
+            self.warn('Invalid option "{}": {}\n'.format(options, e))
+            return {'status': 'error',
+                'ename': e.__class__.__name__,
+                'evalue': str(e),
+                'traceback': [],
+                'execution_count': self._execution_count,
+               }
+        self._use_panel = args.use_panel is True
+        if args.list_kernel:
+            # https://github.com/jupyter/help/issues/153#issuecomment-289026056
+            #
+            # when the frontend is refreshed, cached comm would be lost and
+            # communication would be discontinued. However, a kernel-list
+            # request would be sent by the new-connection so we reset the
+            # frontend_comm to re-connect to the frontend.
+            self.comm_manager.register_target('sos_comm', self.sos_comm)
+
+        # args.default_kernel should be valid
+        if self.find_kernel(args.default_kernel)[0] != self.find_kernel(self.kernel)[0]:
+            self.switch_kernel(args.default_kernel)
+        #
+        if args.cell_kernel == 'undefined':
+            args.cell_kernel = args.default_kernel
+        #
+        original_kernel = self.kernel
+        try:
+            if self.find_kernel(args.cell_kernel)[0] != self.find_kernel(self.kernel)[0]:
+                self.switch_kernel(args.cell_kernel)
+        except Exception as e:
+            self.warn(f'Failed to switch to language "{args.cell_kernel}": {e}\n')
+            return {'status': 'error',
+                'ename': e.__class__.__name__,
+                'evalue': str(e),
+                'traceback': [],
+                'execution_count': self._execution_count,
+            }
+        try:
+            if args.resume:
+                self._resume_execution = True
+            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+        finally:
+            self._resume_execution = False
+            if not self.hard_switch_kernel:
+                self.switch_kernel(original_kernel)
+
+    def _magic_with(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        try:
+            parser = self.get_parser('with')
             try:
-                self._render_result = args.format
-                return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-            finally:
-                self._render_result = False
-        elif self.MAGIC_SESSIONINFO.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
-            parser = self.get_sessioninfo_parser()
-            try:
-                args = parser.parse_known_args(shlex.split(options))
+                args = parser.parse_args(shlex.split(options))
             except SystemExit:
                 return
-            self.handle_sessioninfo()
-            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-        elif self.MAGIC_TOC.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
-            self.send_frontend_msg('show_toc')
-            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-        elif self.MAGIC_DICT.match(code):
-            # %dict should be the last magic
-            options, remaining_code = self.get_magic_and_code(code, False)
-            self.handle_magic_dict(options)
-            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-        elif self.MAGIC_CONNECT_INFO.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
-            cfile = find_connection_file()
-            with open(cfile) as conn:
-                conn_info = conn.read()
-            self.send_response(self.iopub_socket, 'stream',
-                  {'name': 'stdout', 'text': 'Connection file: {}\n{}'.format(cfile, conn_info)})
-            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-        elif self.MAGIC_MATPLOTLIB.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
-            try:
-                self.shell.enable_gui = lambda gui: None
-                self.shell.enable_matplotlib(options)
-            except Exception as e:
-                self.warn('Failed to set matplotlib backnd {}: {}'.format(options, e))
-            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-        elif self.MAGIC_SET.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
-            self.handle_magic_set(options)
-            # self.options will be set to inflence the execution of remaing_code
+        except Exception as e:
+            self.warn(f'Invalid option "{options}": {e}\n')
+            return {'status': 'error',
+                'ename': e.__class__.__name__,
+                'evalue': str(e),
+                'traceback': [],
+                'execution_count': self._execution_count,
+               }
+        original_kernel = self.kernel
+        if args.restart and args.name in self.kernels:
+            self.shutdown_kernel(args.name)
+        if args.force:
+            self.shared_variables.forget()
+        try:
+            self.switch_kernel(args.name, args.in_vars, args.out_vars,
+                args.kernel, args.language, args.color)
+        except Exception as e:
+            self.warn(
+                f'Failed to switch to subkernel {args.name} (kernel {args.kernel}, language {args.language}): {e}')
+            return {'status': 'error',
+                'ename': e.__class__.__name__,
+                'evalue': str(e),
+                'traceback': [],
+                'execution_count': self._execution_count,
+               }
+        try:
             return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-        elif self.MAGIC_EXPAND.match(code):
-            lines = code.splitlines() 
-            options = lines[0]
-            parser = self.get_expand_parser()
+        finally:
+            self.switch_kernel(original_kernel)
+
+    def _magic_use(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        try:
+            parser = self.get_parser('use')
             try:
-                args = parser.parse_args(options.split()[1:])
+                args = parser.parse_args(shlex.split(options))
             except SystemExit:
                 return
-            if args.sigil in ('None', None):
-                sigil = None
-            if args.right_sigil is not None:
-                sigil = f'{args.sigil} {args.right_sigil}'
-            # now we need to expand the text, but separate the magics first
-            lines = lines[1:]
-            line_start = 0
-            for idx, line in enumerate(lines):
-                if line.strip() and not line.startswith('%') and not line.startswith('!'):
-                    start_line = idx
-                    break
-            text = '\n'.join(lines[start_line:])
-            if sigil is not None and sigil != '{ }':
-                from sos.parser import replace_sigil
-                text = replace_sigil(text, sigil)
+        except Exception as e:
+            self.warn(f'Invalid option "{options}": {e}\n')
+            return {'status': 'abort',
+                'ename': e.__class__.__name__,
+                'evalue': str(e),
+                'traceback': [],
+                'execution_count': self._execution_count,
+               }
+        if args.restart and args.name in self.kernels:
+            self.shutdown_kernel(args.name)
+            self.warn(f'{args.name} is shutdown')
+        if args.force:
+            self.shared_variables.forget()
+        try:
+            self.switch_kernel(args.name, args.in_vars, args.out_vars,
+                args.kernel, args.language, args.color)
+            self.hard_switch_kernel = True
+            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+        except Exception as e:
+            self.warn(
+                f'Failed to switch to subkernel {args.name} (kernel {args.kernel}, language {args.language}): {e}')
+            return {'status': 'error',
+                'ename': e.__class__.__name__,
+                'evalue': str(e),
+                'traceback': [],
+                'execution_count': self._execution_count,
+               }
+
+    def _magic_get(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        try:
+            parser = self.get_parser('get')
             try:
-                interpolated = interpolate(text, local_dict=env.sos_dict._dict)
-                remaining_code = '\n'.join(lines[:start_line] + [interpolated]) + '\n'
-                # self.options will be set to inflence the execution of remaing_code
-                return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-            except Exception as e:
-                self.warn(e)
+                args = parser.parse_args(options.split())
+            except SystemExit:
                 return
-        elif self.MAGIC_SHUTDOWN.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
-            parser = self.get_shutdown_parser()
+        except Exception as e:
+            self.warn(f'Invalid option "{options}": {e}\n')
+            return {'status': 'error',
+                'ename': e.__class__.__name__,
+                'evalue': str(e),
+                'traceback': [],
+                'execution_count': self._execution_count,
+               }
+        if args.force:
+            self.shared_variables.forget(self.kernel)
+        self.handle_magic_get(args.vars, args.__from__, explicit=True)
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _magic_put(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        try:
+            parser = self.get_parser('put')
             try:
-                args = parser.parse_args(shlex.split(options))
+                args = parser.parse_args(options.split())
             except SystemExit:
                 return
-            self.shutdown_kernel(args.kernel if args.kernel else self.kernel, args.restart)
-            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-        elif self.MAGIC_CLEAR.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
-            parser = self.get_clear_parser()
+        except Exception as e:
+            self.warn(f'Invalid option "{options}": {e}\n')
+            return {'status': 'error',
+                'ename': e.__class__.__name__,
+                'evalue': str(e),
+                'traceback': [],
+                'execution_count': self._execution_count,
+               }
+        self.handle_magic_put(args.vars, args.__to__, explicit=True)
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _magic_push(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        try:
+            parser = self.get_parser('push')
             try:
                 args = parser.parse_args(options.split())
             except SystemExit:
                 return
-            # self.cell_idx could be reset by _do_execute
-            cell_idx = self.cell_idx
-            try:
-                return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-            finally:
-                if args.status:
-                    status_style = [self.status_class[x] for x in args.status]
-                else:
-                    status_style = None
-                self.send_frontend_msg('clear-output', [cell_idx, args.all, status_style])
-        elif self.MAGIC_FRONTEND.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
-            try:
-                parser = self.get_frontend_parser()
-                try:
-                    args = parser.parse_args(shlex.split(options))
-                except SystemExit:
-                    return
-                self.cell_idx = args.cell_idx
-                # for panel cell, we return a non-informative execution count
-                if self.cell_idx is None or self.cell_idx < 0:
-                    self._execution_count = '-'
-                self._notebook_name = args.filename if args.filename else 'Untitled'
-            except Exception as e:
-                self.warn('Invalid option "{}": {}\n'.format(options, e))
-                return {'status': 'error',
-                    'ename': e.__class__.__name__,
-                    'evalue': str(e),
-                    'traceback': [],
-                    'execution_count': self._execution_count,
-                   }
-            self._use_panel = args.use_panel is True
-            if args.list_kernel:
-                # https://github.com/jupyter/help/issues/153#issuecomment-289026056
-                #
-                # when the frontend is refreshed, cached comm would be lost and
-                # communication would be discontinued. However, a kernel-list
-                # request would be sent by the new-connection so we reset the
-                # frontend_comm to re-connect to the frontend.
-                self.comm_manager.register_target('sos_comm', self.sos_comm)
-
-            # args.default_kernel should be valid
-            if self.find_kernel(args.default_kernel)[0] != self.find_kernel(self.kernel)[0]:
-                self.switch_kernel(args.default_kernel)
-            #
-            if args.cell_kernel == 'undefined':
-                args.cell_kernel = args.default_kernel
-            #
-            original_kernel = self.kernel
-            try:
-                if self.find_kernel(args.cell_kernel)[0] != self.find_kernel(self.kernel)[0]:
-                    self.switch_kernel(args.cell_kernel)
-            except Exception as e:
-                self.warn(f'Failed to switch to language "{args.cell_kernel}": {e}\n')
-                return {'status': 'error',
-                    'ename': e.__class__.__name__,
-                    'evalue': str(e),
-                    'traceback': [],
-                    'execution_count': self._execution_count,
-                }
-            try:
-                if args.resume:
-                    self._resume_execution = True
-                return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-            finally:
-                self._resume_execution = False
-                if not self.hard_switch_kernel:
-                    self.switch_kernel(original_kernel)
-        elif self.MAGIC_WITH.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
-            try:
-                parser = self.get_with_parser()
-                try:
-                    args = parser.parse_args(shlex.split(options))
-                except SystemExit:
-                    return
-            except Exception as e:
-                self.warn(f'Invalid option "{options}": {e}\n')
-                return {'status': 'error',
-                    'ename': e.__class__.__name__,
-                    'evalue': str(e),
-                    'traceback': [],
-                    'execution_count': self._execution_count,
-                   }
-            original_kernel = self.kernel
-            if args.restart and args.name in self.kernels:
-                self.shutdown_kernel(args.name)
-            try:
-                self.switch_kernel(args.name, args.in_vars, args.out_vars,
-                    args.kernel, args.language, args.color)
-            except Exception as e:
-                self.warn(
-                    f'Failed to switch to subkernel {args.name} (kernel {args.kernel}, language {args.language}): {e}')
-                return {'status': 'error',
-                    'ename': e.__class__.__name__,
-                    'evalue': str(e),
-                    'traceback': [],
-                    'execution_count': self._execution_count,
-                   }
-            try:
-                return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-            finally:
-                self.switch_kernel(original_kernel)
-        elif self.MAGIC_USE.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
-            try:
-                parser = self.get_use_parser()
-                try:
-                    args = parser.parse_args(shlex.split(options))
-                except SystemExit:
-                    return
-            except Exception as e:
-                self.warn(f'Invalid option "{options}": {e}\n')
-                return {'status': 'abort',
-                    'ename': e.__class__.__name__,
-                    'evalue': str(e),
-                    'traceback': [],
-                    'execution_count': self._execution_count,
-                   }
-            if args.restart and args.name in self.kernels:
-                self.shutdown_kernel(args.name)
-                self.warn(f'{args.name} is shutdown')
-            try:
-                self.switch_kernel(args.name, args.in_vars, args.out_vars,
-                    args.kernel, args.language, args.color)
-                self.hard_switch_kernel = True
-                return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-            except Exception as e:
-                self.warn(
-                    f'Failed to switch to subkernel {args.name} (kernel {args.kernel}, language {args.language}): {e}')
-                return {'status': 'error',
-                    'ename': e.__class__.__name__,
-                    'evalue': str(e),
-                    'traceback': [],
-                    'execution_count': self._execution_count,
-                   }
-        elif self.MAGIC_GET.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
-            try:
-                parser = self.get_get_parser()
-                try:
-                    args = parser.parse_args(options.split())
-                except SystemExit:
-                    return
-            except Exception as e:
-                self.warn(f'Invalid option "{options}": {e}\n')
-                return {'status': 'error',
-                    'ename': e.__class__.__name__,
-                    'evalue': str(e),
-                    'traceback': [],
-                    'execution_count': self._execution_count,
-                   }
-            self.handle_magic_get(args.vars, args.__from__, explicit=True)
-            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-        elif self.MAGIC_PUT.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
-            try:
-                parser = self.get_put_parser()
-                try:
-                    args = parser.parse_args(options.split())
-                except SystemExit:
-                    return
-            except Exception as e:
-                self.warn(f'Invalid option "{options}": {e}\n')
-                return {'status': 'error',
-                    'ename': e.__class__.__name__,
-                    'evalue': str(e),
-                    'traceback': [],
-                    'execution_count': self._execution_count,
-                   }
-            self.handle_magic_put(args.vars, args.__to__, explicit=True)
-            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-        elif self.MAGIC_PUSH.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
+        except Exception as e:
+            self.warn(f'Invalid option "{options}": {e}\n')
+            return {'status': 'error',
+                'ename': e.__class__.__name__,
+                'evalue': str(e),
+                'traceback': [],
+                'execution_count': self._execution_count,
+               }
+        self.handle_magic_push(args)
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _magic_profile(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        parser = self.get_parser('profile')
+        try:
+            args = parser.parse_args(shlex.split(options))
+        except SystemExit:
+            return
+        if args.log is not None:
+            self.profiler.log_file = os.path.expanduser(args.log) if args.log else None
+        if args.reset:
+            self.profiler.reset()
+        if args.status is not None:
+            self.profiler.enabled = args.status == 'on'
+        elif not args.reset and args.log is None:
+            summary = self.profiler.summary(args.all)
+            if summary is None:
+                self.send_response(self.iopub_socket, 'stream',
+                    {'name': 'stdout', 'text': 'No profiled cell. Use "%profile on" to turn on profiling.\n'})
+            else:
+                self.send_response(self.iopub_socket, 'stream',
+                    {'name': 'stdout', 'text': summary})
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _magic_pull(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        try:
+            parser = self.get_parser('pull')
             try:
-                parser = self.get_push_parser()
-                try:
-                    args = parser.parse_args(options.split())
-                except SystemExit:
-                    return
-            except Exception as e:
-                self.warn(f'Invalid option "{options}": {e}\n')
-                return {'status': 'error',
-                    'ename': e.__class__.__name__,
-                    'evalue': str(e),
-                    'traceback': [],
-                    'execution_count': self._execution_count,
-                   }
-            self.handle_magic_push(args)
-            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-        elif self.MAGIC_PULL.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
+                args = parser.parse_args(options.split())
+            except SystemExit:
+                return
+        except Exception as e:
+            self.warn(f'Invalid option "{options}": {e}\n')
+            return {'status': 'error',
+                'ename': e.__class__.__name__,
+                'evalue': str(e),
+                'traceback': [],
+                'execution_count': self._execution_count,
+               }
+        self.handle_magic_pull(args)
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _magic_paste(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, True)
+        try:
+            old_options = self.options
+            self.options = options + ' ' + self.options
+            from IPython.lib.clipboard import ClipboardEmpty
             try:
-                parser = self.get_pull_parser()
-                try:
-                    args = parser.parse_args(options.split())
-                except SystemExit:
-                    return
+                code = clipboard_get()
+            except ClipboardEmpty:
+                raise UsageError("The clipboard appears to be empty")
             except Exception as e:
-                self.warn(f'Invalid option "{options}": {e}\n')
-                return {'status': 'error',
-                    'ename': e.__class__.__name__,
-                    'evalue': str(e),
-                    'traceback': [],
-                    'execution_count': self._execution_count,
-                   }
-            self.handle_magic_pull(args)
-            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-        elif self.MAGIC_PASTE.match(code):
-            options, remaining_code = self.get_magic_and_code(code, True)
-            try:
-                old_options = self.options
-                self.options = options + ' ' + self.options
-                try:
-                    code = clipboard_get()
-                except ClipboardEmpty:
-                    raise UsageError("The clipboard appears to be empty")
-                except Exception as e:
-                    env.logger.warn(f'Failed to get text from the clipboard: {e}')
-                    return
-                #
-                self.send_response(self.iopub_socket, 'stream',
-                    {'name': 'stdout', 'text': code.strip() + '\n## -- End pasted text --\n'})
-                return self._do_execute(code, silent, store_history, user_expressions, allow_stdin)
-            finally:
-                self.options = old_options
-        elif self.MAGIC_RUN.match(code):
-            # there can be multiple %run magic, but there should not be any other magics
-            run_code = code
-            run_options = []
-            while True:
-                if self.MAGIC_RUN.match(run_code):
-                    options, run_code = self.get_magic_and_code(run_code, False)
-                    run_options.append(options)
-                else:
-                    break
-            # if there are more magics after %run, they will be ignored so a warning
-            # is needed.
-            if run_code.lstrip().startswith('%'):
-                self.warn(f'Magic {run_code.split()[0]} after magic %run will be ignored.')
-
-            # find the global sections of the workflow
-            global_sections = ''
-            in_global = False
-            for line in self._workflow.splitlines():
-                if SOS_GLOBAL_SECTION_HEADER.match(line):
-                    in_global = True
-                elif SOS_SECTION_HEADER.match(line):
-                    in_global = False
-                if in_global:
-                    global_sections += line + '\n'
-            if not any(SOS_SECTION_HEADER.match(line) for line in run_code.splitlines()):
-                global_sections += '[default]\n'
-            # now we need to run the code multiple times with each option
-            for options in run_options:
-                old_options = self.options
-                self.options = options + ' ' + self.options
-                try:
-                    # %run is executed in its own namespace
-                    old_dict = env.sos_dict
-                    self._reset_dict()
-                    self._workflow_mode = True
-                    if self._debug_mode:
-                        self.warn(f'Executing\n{global_sections + run_code}')
-                    ret = self._do_execute(global_sections + run_code, silent, store_history, user_expressions, allow_stdin)
-                except Exception as e:
-                    self.warn(f'Failed to execute workflow: {e}')
-                    raise
-                finally:
-                    old_dict.quick_update(env.sos_dict._dict)
-                    env.sos_dict = old_dict
-                    self._workflow_mode = False
-                    self.options = old_options
-            return ret
-        elif self.MAGIC_SOSRUN.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
+                env.logger.warn(f'Failed to get text from the clipboard: {e}')
+                return
+            #
+            self.send_response(self.iopub_socket, 'stream',
+                {'name': 'stdout', 'text': code.strip() + '\n## -- End pasted text --\n'})
+            return self._do_execute(code, silent, store_history, user_expressions, allow_stdin)
+        finally:
+            self.options = old_options
+
+    def _magic_run(self, code, silent, store_history, user_expressions, allow_stdin):
+        # there can be multiple %run magic, but there should not be any other magics
+        run_code = code
+        run_options = []
+        while True:
+            if self.magic_registry.match(run_code) == 'run':
+                options, run_code = self.get_magic_and_code(run_code, False)
+                run_options.append(options)
+            else:
+                break
+        # if there are more magics after %run, they will be ignored so a warning
+        # is needed.
+        if run_code.lstrip().startswith('%'):
+            self.warn(f'Magic {run_code.split()[0]} after magic %run will be ignored.')
+
+        # find the global sections of the workflow
+        global_sections = ''
+        in_global = False
+        for line in self._workflow.splitlines():
+            if SOS_GLOBAL_SECTION_HEADER.match(line):
+                in_global = True
+            elif SOS_SECTION_HEADER.match(line):
+                in_global = False
+            if in_global:
+                global_sections += line + '\n'
+        if not any(SOS_SECTION_HEADER.match(line) for line in run_code.splitlines()):
+            global_sections += '[default]\n'
+        # now we need to run the code multiple times with each option
+        for options in run_options:
             old_options = self.options
             self.options = options + ' ' + self.options
             try:
@@ -2440,11 +2990,9 @@ Available subkernels:\n{}'''.format(
                 old_dict = env.sos_dict
                 self._reset_dict()
                 self._workflow_mode = True
-                #self.send_frontend_msg('preview-workflow', self._workflow)
-                if not self._workflow:
-                    self.warn('Nothing to execute (notebook workflow is empty).')
-                else:
-                    self._do_execute(self._workflow, silent, store_history, user_expressions, allow_stdin)
+                if self._debug_mode:
+                    self.warn(f'Executing\n{global_sections + run_code}')
+                ret = self._do_execute(global_sections + run_code, silent, store_history, user_expressions, allow_stdin)
             except Exception as e:
                 self.warn(f'Failed to execute workflow: {e}')
                 raise
@@ -2453,310 +3001,345 @@ Available subkernels:\n{}'''.format(
                 env.sos_dict = old_dict
                 self._workflow_mode = False
                 self.options = old_options
-            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-        elif self.MAGIC_SAVE.match(code):
-            if self.kernel != 'SoS':
-                # pass the %save magic to underlying kernel
-                return self._do_execute(code, silent, store_history, user_expressions, allow_stdin)
-            # if sos kernel ...
-            options, remaining_code = self.get_magic_and_code(code, False)
+        return ret
+
+    def _magic_sosrun(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        old_options = self.options
+        self.options = options + ' ' + self.options
+        try:
+            # %run is executed in its own namespace
+            old_dict = env.sos_dict
+            self._reset_dict()
+            self._workflow_mode = True
+            #self.send_frontend_msg('preview-workflow', self._workflow)
+            if not self._workflow:
+                self.warn('Nothing to execute (notebook workflow is empty).')
+            else:
+                self._do_execute(self._workflow, silent, store_history, user_expressions, allow_stdin)
+        except Exception as e:
+            self.warn(f'Failed to execute workflow: {e}')
+            raise
+        finally:
+            old_dict.quick_update(env.sos_dict._dict)
+            env.sos_dict = old_dict
+            self._workflow_mode = False
+            self.options = old_options
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _magic_save(self, code, silent, store_history, user_expressions, allow_stdin):
+        if self.kernel != 'SoS':
+            # pass the %save magic to underlying kernel
+            return self._run_subkernel_cell(code, silent, store_history)
+        # if sos kernel ...
+        options, remaining_code = self.get_magic_and_code(code, False)
+        try:
+            parser = self.get_parser('save')
             try:
-                parser = self.get_save_parser()
-                try:
-                    args = parser.parse_args(shlex.split(options))
-                except SystemExit:
-                    return
-                filename = os.path.expanduser(args.filename)
-                if os.path.isfile(filename) and not args.force:
-                    raise ValueError(f'Cannot overwrite existing output file {filename}')
+                args = parser.parse_args(shlex.split(options))
+            except SystemExit:
+                return
+            filename = os.path.expanduser(args.filename)
+            if os.path.isfile(filename) and not args.force:
+                raise ValueError(f'Cannot overwrite existing output file {filename}')
 
-                with open(filename, 'a' if args.append else 'w') as script:
-                    script.write('\n'.join(remaining_code.splitlines()).rstrip() + '\n')
-                if args.setx:
-                    import stat
-                    os.chmod(filename, os.stat(filename).st_mode | stat.S_IEXEC)
+            with open(filename, 'a' if args.append else 'w') as script:
+                script.write('\n'.join(remaining_code.splitlines()).rstrip() + '\n')
+            if args.setx:
+                import stat
+                os.chmod(filename, os.stat(filename).st_mode | stat.S_IEXEC)
 
-                self.send_response(self.iopub_socket, 'display_data',
-                    {'source': 'SoS', 'metadata': {},
-                     'data': {
-                         'text/plain': f'Cell content saved to {filename}\n',
-                         'text/html': HTML(
-                             f'<div class="sos_hint">Cell content saved to <a href="{filename}" target="_blank">{filename}</a></div>').data
-                          }
-                     })
-            except Exception as e:
-                self.warn(f'Failed to save cell: {e}')
-                return {'status': 'error',
-                    'ename': e.__class__.__name__,
-                    'evalue': str(e),
-                    'traceback': [],
-                    'execution_count': self._execution_count,
-                }
-            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-        elif self.MAGIC_SOSSAVE.match(code):
-            # get the saved filename
-            options, remaining_code = self.get_magic_and_code(code, False)
+            self.send_response(self.iopub_socket, 'display_data',
+                {'source': 'SoS', 'metadata': {},
+                 'data': {
+                     'text/plain': f'Cell content saved to {filename}\n',
+                     'text/html': HTML(
+                         f'<div class="sos_hint">Cell content saved to <a href="{filename}" target="_blank">{filename}</a></div>').data
+                      }
+                 })
+        except Exception as e:
+            self.warn(f'Failed to save cell: {e}')
+            return {'status': 'error',
+                'ename': e.__class__.__name__,
+                'evalue': str(e),
+                'traceback': [],
+                'execution_count': self._execution_count,
+            }
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _magic_sossave(self, code, silent, store_history, user_expressions, allow_stdin):
+        # get the saved filename
+        options, remaining_code = self.get_magic_and_code(code, False)
+        try:
+            parser = self.get_parser('sossave')
             try:
-                parser = self.get_sossave_parser()
-                try:
-                    args = parser.parse_args(shlex.split(options))
-                except SystemExit:
-                    return
-                if args.filename:
-                    filename = args.filename
-                    if filename.lower().endswith('.html'):
-                        if args.__to__ is None:
-                            ftype = 'html'
-                        elif args.__to__ != 'html':
-                            self.warn(f'%sossave to an .html file in {args.__to__} format')
-                            ftype = args.__to__
-                    else:
-                        ftype = 'sos'
+                args = parser.parse_args(shlex.split(options))
+            except SystemExit:
+                return
+            if args.filename:
+                filename = args.filename
+                if filename.lower().endswith('.html'):
+                    if args.__to__ is None:
+                        ftype = 'html'
+                    elif args.__to__ != 'html':
+                        self.warn(f'%sossave to an .html file in {args.__to__} format')
+                        ftype = args.__to__
                 else:
-                    ftype = args.__to__ if args.__to__ else 'sos'
-                    filename = self._notebook_name + '.' + ftype
-
-                filename = os.path.expanduser(filename)
-
-                if os.path.isfile(filename) and not args.force:
-                    raise ValueError(f'Cannot overwrite existing output file {filename}')
-                #self.send_frontend_msg('preview-workflow', self._workflow)
-                if ftype == 'sos':
-                    if not args.all:
-                        with open(filename, 'w') as script:
-                            script.write(self._workflow)
-                    else:
-                        # convert to sos report
-                        from .converter import notebook_to_script
-                        arg = argparse.Namespace()
-                        arg.all = True
-                        notebook_to_script(self._notebook_name + '.ipynb', filename, args=arg, unknown_args=[])
-                    if args.setx:
-                        import stat
-                        os.chmod(filename, os.stat(filename).st_mode | stat.S_IEXEC)
+                    ftype = 'sos'
+            else:
+                ftype = args.__to__ if args.__to__ else 'sos'
+                filename = self._notebook_name + '.' + ftype
+
+            filename = os.path.expanduser(filename)
+
+            if os.path.isfile(filename) and not args.force:
+                raise ValueError(f'Cannot overwrite existing output file {filename}')
+            #self.send_frontend_msg('preview-workflow', self._workflow)
+            if ftype == 'sos':
+                if not args.all:
+                    with open(filename, 'w') as script:
+                        script.write(self._workflow)
                 else:
                     # convert to sos report
-                    from .converter import notebook_to_html
+                    from .converter import notebook_to_script
                     arg = argparse.Namespace()
-                    if args.template == 'default-sos-template':
-                        from sos.utils import load_config_files
-                        cfg = load_config_files()
-                        if 'default-sos-template' in cfg:
-                            arg.template = cfg['default-sos-template']
-                        else:
-                            arg.template = 'sos-report'
+                    arg.all = True
+                    notebook_to_script(self._notebook_name + '.ipynb', filename, args=arg, unknown_args=[])
+                if args.setx:
+                    import stat
+                    os.chmod(filename, os.stat(filename).st_mode | stat.S_IEXEC)
+            else:
+                # convert to sos report
+                from .converter import notebook_to_html
+                arg = argparse.Namespace()
+                if args.template == 'default-sos-template':
+                    from sos.utils import load_config_files
+                    cfg = load_config_files()
+                    if 'default-sos-template' in cfg:
+                        arg.template = cfg['default-sos-template']
                     else:
-                        arg.template = args.template
-                    notebook_to_html(self._notebook_name + '.ipynb', filename, sargs=arg, unknown_args=[])
+                        arg.template = 'sos-report'
+                else:
+                    arg.template = args.template
+                notebook_to_html(self._notebook_name + '.ipynb', filename, sargs=arg, unknown_args=[])
 
-                self.send_response(self.iopub_socket, 'display_data',
-                    {'source': 'SoS', 'metadata': {},
-                     'data': {
-                         'text/plain': f'Workflow saved to {filename}\n',
-                         'text/html': HTML(
-                             f'<div class="sos_hint">Workflow saved to <a href="{filename}" target="_blank">{filename}</a></div>').data
-                          }
-                     })
-                #
-                if args.commit:
-                    self.handle_shell_command({'git', 'commit', filename, '-m',
-                                               args.message if args.message else f'save {filename}'})
-                if args.push:
-                    self.handle_shell_command(['git', 'push'])
-            except Exception as e:
-                self.warn(f'Failed to save workflow: {e}')
-                return {'status': 'error',
-                    'ename': e.__class__.__name__,
-                    'evalue': str(e),
-                    'traceback': [],
-                    'execution_count': self._execution_count,
-                }
-            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-        elif self.MAGIC_RERUN.match(code):
-            options, remaining_code = self.get_magic_and_code(code, True)
-            old_options = self.options
-            self.options = options + ' ' + self.options
-            try:
-                self._workflow_mode = True
+            self.send_response(self.iopub_socket, 'display_data',
+                {'source': 'SoS', 'metadata': {},
+                 'data': {
+                     'text/plain': f'Workflow saved to {filename}\n',
+                     'text/html': HTML(
+                         f'<div class="sos_hint">Workflow saved to <a href="{filename}" target="_blank">{filename}</a></div>').data
+                      }
+                 })
+            #
+            if args.commit:
+                self.handle_shell_command({'git', 'commit', filename, '-m',
+                                           args.message if args.message else f'save {filename}'})
+            if args.push:
+                self.handle_shell_command(['git', 'push'])
+        except Exception as e:
+            self.warn(f'Failed to save workflow: {e}')
+            return {'status': 'error',
+                'ename': e.__class__.__name__,
+                'evalue': str(e),
+                'traceback': [],
+                'execution_count': self._execution_count,
+            }
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _magic_rerun(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, True)
+        old_options = self.options
+        self.options = options + ' ' + self.options
+        try:
+            self._workflow_mode = True
+            old_dict = env.sos_dict
+            self._reset_dict()
+            if not self.last_executed_code:
+                self.warn('No saved script')
+                self.last_executed_code = ''
+            return self._do_execute(self.last_executed_code, silent, store_history, user_expressions, allow_stdin)
+        except Exception as e:
+            self.warn(f'Failed to execute workflow: {e}')
+            raise
+        finally:
+            old_dict.quick_update(env.sos_dict._dict)
+            env.sos_dict = old_dict
+            self.options = old_options
+            self._workflow_mode = False
+
+    def _magic_sandbox(self, code, silent, store_history, user_expressions, allow_stdin):
+        import tempfile
+        import shutil
+        options, remaining_code = self.get_magic_and_code(code, False)
+        parser = self.get_parser('sandbox')
+        try:
+            args = parser.parse_args(shlex.split(options))
+        except SystemExit:
+            return
+        self.in_sandbox = True
+        try:
+            old_dir = os.getcwd()
+            if args.dir:
+                args.dir = os.path.expanduser(args.dir)
+                if not os.path.isdir(args.dir):
+                    os.makedirs(args.dir)
+                env.exec_dir = os.path.abspath(args.dir)
+                os.chdir(args.dir)
+            else:
+                new_dir = tempfile.mkdtemp()
+                env.exec_dir = os.path.abspath(new_dir)
+                os.chdir(new_dir)
+            if not args.keep_dict:
                 old_dict = env.sos_dict
                 self._reset_dict()
-                if not self.last_executed_code:
-                    self.warn('No saved script')
-                    self.last_executed_code = ''
-                return self._do_execute(self.last_executed_code, silent, store_history, user_expressions, allow_stdin)
-            except Exception as e:
-                self.warn(f'Failed to execute workflow: {e}')
-                raise
-            finally:
-                old_dict.quick_update(env.sos_dict._dict)
-                env.sos_dict = old_dict
-                self.options = old_options
-                self._workflow_mode = False
-        elif self.MAGIC_SANDBOX.match(code):
-            import tempfile
-            import shutil
-            options, remaining_code = self.get_magic_and_code(code, False)
-            parser = self.get_sandbox_parser()
-            try:
-                args = parser.parse_args(shlex.split(options))
-            except SystemExit:
-                return
-            self.in_sandbox = True
-            try:
-                old_dir = os.getcwd()
-                if args.dir:
-                    args.dir = os.path.expanduser(args.dir)
-                    if not os.path.isdir(args.dir):
-                        os.makedirs(args.dir)
-                    env.exec_dir = os.path.abspath(args.dir)
-                    os.chdir(args.dir)
-                else:
-                    new_dir = tempfile.mkdtemp()
-                    env.exec_dir = os.path.abspath(new_dir)
-                    os.chdir(new_dir)
-                if not args.keep_dict:
-                    old_dict = env.sos_dict
-                    self._reset_dict()
-                ret = self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-                if args.expect_error and ret['status'] == 'error':
-                    #self.warn('\nSandbox execution failed.')
-                    return {'status': 'ok',
-                        'payload': [], 'user_expressions': {},
-                        'execution_count': self._execution_count}
-                else:
-                    return ret
-            finally:
-                if not args.keep_dict:
-                    env.sos_dict = old_dict
-                os.chdir(old_dir)
-                if not args.dir:
-                    shutil.rmtree(new_dir)
-                self.in_sandbox = False
-                #env.exec_dir = old_dir
-        elif self.MAGIC_PREVIEW.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
-            parser = self.get_preview_parser()
-            options = shlex.split(options, posix=False)
-            help_option = []
-            if ('-s' in options or '--style' in options) and '-h' in options:
-                # defer -h to subparser
-                options.remove('-h')
-                help_option = ['-h']
-            try:
-                args, style_options = parser.parse_known_args(options)
-            except SystemExit:
-                return
-            #
-            style_options.extend(help_option)
-            style = {'style': args.style, 'options': style_options }
-            #
-            if args.off:
-                self.preview_output = False
+            ret = self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+            if args.expect_error and ret['status'] == 'error':
+                #self.warn('\nSandbox execution failed.')
+                return {'status': 'ok',
+                    'payload': [], 'user_expressions': {},
+                    'execution_count': self._execution_count}
             else:
-                self.preview_output = True
-            #
-            if args.panel:
-                self._use_panel = True
-            elif args.notebook:
-                self._use_panel = False
-            # else, use default _use_panel
-            try:
-                return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-            finally:
-                # preview workflow
-                if args.workflow:
-                    import random
-                    ta_id = 'preview_wf_{}'.format(random.randint(1, 1000000))
-                    self.send_response(self.iopub_socket, 'display_data',
-                        {'metadata': {},
-                         'data':
-                            {'text/plain': self._workflow,
-                             'text/html': HTML(f'<textarea id="{ta_id}">{self._workflow}</textarea>').data
-                      }})
-                    self.send_frontend_msg('highlight-workflow', ta_id)
-                if not args.off and args.items:
-                    if args.host is None:
-                        if not args.keep_output and self._use_panel:
-                            self.send_frontend_msg('preview-input', f'%preview {" ".join(args.items)}')
-                        self.handle_magic_preview(args.items, args.kernel, style)
-                    elif args.workflow:
-                        self.warn('Invalid option --kernel with -r (--host)')
-                    elif args.kernel:
-                        self.warn('Invalid option --kernel with -r (--host)')
-                    else:
-                        if args.config:
-                            from sos.utils import load_config_files
-                            load_config_files(args.config)
-                        try:
-                            rargs = ['sos', 'preview', '--html'] + options
-                            rargs = [x for x in rargs if x not in ('-n', '--notebook', '-p', '--panel')]
-                            if self._debug_mode:
-                                self.warn(f'Running "{" ".join(rargs)}"')
-                            self.send_frontend_msg('preview-input', f'%preview {" ".join(args.items)} -r {args.host}')
-                            for msg in eval(subprocess.check_output(rargs)):
-                                self.send_frontend_msg(msg[0], msg[1])
-                        except Exception as e:
-                            self.warn('Failed to preview {} on remote host {}{}'.format(
-                                args.items, args.host, f': {e}' if self._debug_mode else ''))
-        elif self.MAGIC_CD.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
-            self.handle_magic_cd(options)
-            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-        elif self.MAGIC_DEBUG.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
-            parser = self.get_debug_parser()
-            try:
-                args = parser.parse_args(options.split())
-            except SystemExit:
-                return
-            self._debug_mode = args.status == 'on'
-            if self._debug_mode:
-                self.warn(remaining_code)
-            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-        elif self.MAGIC_TASKINFO.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
-            parser = self.get_taskinfo_parser()
-            try:
-                args = parser.parse_args(options.split())
-            except SystemExit:
-                return
-            if args.config:
-                from sos.utils import load_cfg_files
-                load_cfg_files(args.config)
-            self.handle_taskinfo(args.task, args.queue)
-            return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-        elif self.MAGIC_TASKS.match(code):
-            options, remaining_code = self.get_magic_and_code(code, False)
-            parser = self.get_tasks_parser()
-            try:
-                args = parser.parse_args(options.split())
-            except SystemExit:
-                return
-            if args.config:
-                from sos.utils import load_cfg_files
-                load_cfg_files(args.config)
-            self.handle_tasks(args.tasks, args.queue if args.queue else 'localhost', args.status, args.age)
+                return ret
+        finally:
+            if not args.keep_dict:
+                env.sos_dict = old_dict
+            os.chdir(old_dir)
+            if not args.dir:
+                shutil.rmtree(new_dir)
+            self.in_sandbox = False
+            #env.exec_dir = old_dir
+
+    def _magic_preview(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        parser = self.get_parser('preview')
+        options = shlex.split(options, posix=False)
+        help_option = []
+        if ('-s' in options or '--style' in options) and '-h' in options:
+            # defer -h to subparser
+            options.remove('-h')
+            help_option = ['-h']
+        try:
+            args, style_options = parser.parse_known_args(options)
+        except SystemExit:
+            return
+        #
+        style_options.extend(help_option)
+        style = {'style': args.style, 'options': style_options }
+        #
+        if args.off:
+            self.preview_output = False
+        else:
+            self.preview_output = True
+        #
+        if args.panel:
+            self._use_panel = True
+        elif args.notebook:
+            self._use_panel = False
+        # else, use default _use_panel
+        try:
             return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
-        elif code.startswith('!'):
+        finally:
+            # preview workflow
+            if args.workflow:
+                import random
+                ta_id = 'preview_wf_{}'.format(random.randint(1, 1000000))
+                self.send_response(self.iopub_socket, 'display_data',
+                    {'metadata': {},
+                     'data':
+                        {'text/plain': self._workflow,
+                         'text/html': HTML(f'<textarea id="{ta_id}">{self._workflow}</textarea>').data
+                  }})
+                self.send_frontend_msg('highlight-workflow', ta_id)
+            if not args.off and args.items:
+                if args.host is None:
+                    if not args.keep_output and self._use_panel:
+                        self.send_frontend_msg('preview-input', f'%preview {" ".join(args.items)}')
+                    self.handle_magic_preview(args.items, args.kernel, style)
+                elif args.workflow:
+                    self.warn('Invalid option --kernel with -r (--host)')
+                elif args.kernel:
+                    self.warn('Invalid option --kernel with -r (--host)')
+                else:
+                    if args.config:
+                        from sos.utils import load_config_files
+                        load_config_files(args.config)
+                    try:
+                        rargs = ['sos', 'preview', '--html'] + options
+                        rargs = [x for x in rargs if x not in ('-n', '--notebook', '-p', '--panel')]
+                        if self._debug_mode:
+                            self.warn(f'Running "{" ".join(rargs)}"')
+                        self.send_frontend_msg('preview-input', f'%preview {" ".join(args.items)} -r {args.host}')
+                        for msg in eval(subprocess.check_output(rargs)):
+                            self.send_frontend_msg(msg[0], msg[1])
+                    except Exception as e:
+                        self.warn('Failed to preview {} on remote host {}{}'.format(
+                            args.items, args.host, f': {e}' if self._debug_mode else ''))
+
+    def _magic_cd(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        self.handle_magic_cd(options)
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _magic_debug(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        parser = self.get_parser('debug')
+        try:
+            args = parser.parse_args(options.split())
+        except SystemExit:
+            return
+        self._debug_mode = args.status == 'on'
+        if self._debug_mode:
+            self.warn(remaining_code)
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _magic_taskinfo(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        parser = self.get_parser('taskinfo')
+        try:
+            args = parser.parse_args(options.split())
+        except SystemExit:
+            return
+        if args.config:
+            from sos.utils import load_cfg_files
+            load_cfg_files(args.config)
+        self.handle_taskinfo(args.task, args.queue)
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _magic_tasks(self, code, silent, store_history, user_expressions, allow_stdin):
+        options, remaining_code = self.get_magic_and_code(code, False)
+        parser = self.get_parser('tasks')
+        try:
+            args = parser.parse_args(options.split())
+        except SystemExit:
+            return
+        if args.config:
+            from sos.utils import load_cfg_files
+            load_cfg_files(args.config)
+        self.handle_tasks(args.tasks, args.queue if args.queue else 'localhost', args.status, args.age)
+        return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
+
+    def _do_execute(self, code, silent, store_history=True, user_expressions=None,
+                   allow_stdin=False):
+        # if the kernel is SoS, remove comments and newlines
+        code = self.remove_leading_comments(code)
+
+        if self.original_keys is None:
+            self._reset_dict()
+        if code == 'import os\n_pid = os.getpid()':
+            # this is a special probing command from vim-ipython. Let us handle it specially
+            # so that vim-python can get the pid.
+            return
+        if code.startswith('%'):
+            name = self.magic_registry.match(code)
+            if name is not None:
+                return self.magic_registry.get(name)(code, silent, store_history, user_expressions, allow_stdin)
+        if code.startswith('!'):
             options, remaining_code = self.get_magic_and_code(code, False)
             self.handle_shell_command(code.split(' ')[0][1:] + ' ' + options)
             return self._do_execute(remaining_code, silent, store_history, user_expressions, allow_stdin)
         elif self.kernel != 'SoS':
-            # handle string interpolation before sending to the underlying kernel
-            if code:
-                self.last_executed_code = code
-            #code = self._interpolate_text(code, quiet=False)
-            if self.cell_idx is not None:
-                self.send_frontend_msg('cell-kernel', [self.cell_idx, self.kernel])
-                self.cell_idx = None
-            if code is None:
-                return
-            try:
-                return self.run_cell(code, silent, store_history)
-            except KeyboardInterrupt:
-                self.warn('Keyboard Interrupt\n')
-                self.KM.interrupt_kernel()
-                return {'status': 'abort', 'execution_count': self._execution_count}
+            return self._run_subkernel_cell(code, silent, store_history)
         else:
             if code:
                 self.last_executed_code = code
@@ -2788,6 +3371,13 @@ Available subkernels:\n{}'''.format(
                 km.shutdown_kernel(restart=restart)
             except Exception as e:
                 self.warn(f'Failed to shutdown kernel {name}: {e}')
+        if self._kernel_pool is not None:
+            self._kernel_pool.shutdown()
+        if self.previewers is not None:
+            from .preview import shutdown_pdf_pool
+            shutdown_pdf_pool()
+        if self._exchange is not None:
+            self._exchange.cleanup()
 
     def __del__(self):
         # upon releasing of sos kernel, kill all subkernels. This I thought would be
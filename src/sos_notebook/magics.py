@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (sos), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import re
+from functools import partial
+
+from sos.utils import env
+
+from .discovery import iter_entry_points
+
+# name of the magic at the beginning of a cell, e.g. %get in "%get a b"
+MAGIC_NAME = re.compile(r'^%(\w+)(?=\s|$)')
+
+class MagicRegistry(object):
+    '''Registry of cell magics of the SoS kernel, keyed by magic name. Magics
+    are dispatched by a single regular expression match and a dictionary
+    lookup. External packages can add magics through entry point group
+    sos_magics, with entry points pointing to functions
+
+        handler(kernel, code, silent, store_history, user_expressions, allow_stdin)
+
+    where code is the cell starting with the magic. A handler usually calls
+    kernel.get_magic_and_code(code) to separate the options of the magic from
+    the rest of the cell, which is then executed by kernel._do_execute. Magics
+    of the SoS kernel cannot be overridden. Entry points are loaded only when
+    the magic is used.
+    '''
+    def __init__(self, kernel, handlers):
+        self._kernel = kernel
+        self._handlers = dict(handlers)
+        self._entrypoints = {}
+        for entrypoint in iter_entry_points('sos_magics'):
+            if entrypoint.name in self._handlers:
+                env.logger.warning(f'Magic %{entrypoint.name} defined by {entrypoint.value} is ignored because it is a builtin magic.')
+            else:
+                self._entrypoints[entrypoint.name] = entrypoint
+
+    def register(self, name, handler):
+        self._handlers[name] = handler
+        self._entrypoints.pop(name, None)
+
+    def names(self):
+        return set(self._handlers.keys()) | set(self._entrypoints.keys())
+
+    def match(self, code):
+        '''Return the name of the registered magic at the beginning of code,
+        or None if code does not start with a registered magic.'''
+        m = MAGIC_NAME.match(code)
+        if m is None:
+            return None
+        name = m.group(1)
+        if name in self._handlers or name in self._entrypoints:
+            return name
+        return None
+
+    def get(self, name):
+        '''Return handler of magic name, which accepts parameters code, silent,
+        store_history, user_expressions, and allow_stdin.'''
+        if name not in self._handlers:
+            entrypoint = self._entrypoints.pop(name)
+            try:
+                self._handlers[name] = partial(entrypoint.load(), self._kernel)
+            except Exception as e:
+                raise RuntimeError(f'Failed to load magic %{name}: {e}')
+        return self._handlers[name]
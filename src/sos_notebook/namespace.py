@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (sos), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import re
+from bisect import bisect_left
+
+from sos.utils import WorkflowDict
+
+#
+# Synchronization of the SoS dictionary (env.sos_dict) with the namespace of
+# the IPython shell (shell.user_ns), which is used by IPython extensions and
+# post_execute callbacks such as the display of matplotlib figures.
+#
+# Instead of copying the entire dictionary after each cell, only keys that
+# might have been changed by the cell are pushed to, or removed from, user_ns.
+# These are
+#
+#   1. keys that are set or removed through the methods of TrackedWorkflowDict
+#      (set, update, quick_update, pop...), which are used by the executors,
+#      %get, %put, %dict etc, and
+#   2. identifiers in the code executed in the dictionary, which include all
+#      names that the code can assign or delete, unless it does so dynamically
+#      (e.g. globals(), exec() or "from module import *"), in which case the
+#      whole dictionary is synchronized.
+#
+# Code executed in the dictionary cannot be tracked by a dict subclass because
+# it would slow down all name lookups and assignments of the code.
+#
+
+IDENTIFIER = re.compile(r'[^\d\W]\w*')
+# code that binds names that do not appear in the code, including sos_run,
+# which executes steps of the workflow defined in other cells
+DYNAMIC_BINDING = re.compile(r'\b(?:globals|vars|exec|sos_run)\b|\bimport\s+\*')
+
+
+class NameIndex(object):
+    '''A sorted list of names for prefix search.'''
+    def __init__(self, names=()):
+        self._names = sorted(names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def reset(self, names):
+        self._names = sorted(names)
+
+    def update(self, added=(), removed=()):
+        if len(added) + len(removed) > 100:
+            # cheaper to sort again than to insert names one by one
+            self._names = sorted(set(self._names).difference(removed).union(added))
+            return
+        for name in removed:
+            idx = bisect_left(self._names, name)
+            if idx < len(self._names) and self._names[idx] == name:
+                del self._names[idx]
+        for name in added:
+            idx = bisect_left(self._names, name)
+            if idx == len(self._names) or self._names[idx] != name:
+                self._names.insert(idx, name)
+
+    def prefix(self, text):
+        '''Return sorted names that start with text.'''
+        start = bisect_left(self._names, text)
+        # names starting with text are followed by the first name that
+        # starts with text with its last character (that can be) incremented
+        stripped = text.rstrip(chr(0x10ffff))
+        if not stripped:
+            end = len(self._names)
+        else:
+            end = bisect_left(self._names, stripped[:-1] + chr(ord(stripped[-1]) + 1), start)
+        return self._names[start:end]
+
+
+class TrackedWorkflowDict(WorkflowDict):
+    '''A WorkflowDict that records keys that are set or removed through its
+    methods.'''
+    def __init__(self, *args, **kwargs):
+        super(TrackedWorkflowDict, self).__init__(*args, **kwargs)
+        self.changed = set()
+
+    def set(self, key, value):
+        super(TrackedWorkflowDict, self).set(key, value)
+        self.changed.add(key)
+
+    def quick_update(self, obj):
+        super(TrackedWorkflowDict, self).quick_update(obj)
+        self.changed.update(obj.keys())
+
+    def update(self, obj):
+        super(TrackedWorkflowDict, self).update(obj)
+        self.changed.update(obj.keys())
+
+    def pop(self, key, *default):
+        self.changed.add(key)
+        return self._dict.pop(key, *default)
+
+
+class NamespaceSync(object):
+    '''Push changes of the SoS dictionary to the namespace of an IPython shell.'''
+    def __init__(self, shell):
+        self._shell = shell
+        # the dictionary that was last synchronized, and its keys in user_ns
+        self._sos_dict = None
+        self._keys = set()
+        # sorted keys of the dictionary, used for completion
+        self.names = NameIndex()
+        # identifiers of code executed since the last synchronization
+        self._names = set()
+        self._full = True
+        # incremented after each synchronization, that is, after each cell,
+        # so that results derived from values of the dictionary can be cached
+        self.generation = 0
+
+    def add_code(self, code):
+        '''Record names that code executed in the SoS dictionary can change.'''
+        if DYNAMIC_BINDING.search(code):
+            self._full = True
+        else:
+            self._names.update(IDENTIFIER.findall(code))
+
+    def invalidate(self):
+        '''Synchronize the entire dictionary next time.'''
+        self._full = True
+
+    def sync(self, sos_dict):
+        user_ns = self._shell.user_ns
+        values = sos_dict._dict
+        if self._full or sos_dict is not self._sos_dict or not isinstance(sos_dict, TrackedWorkflowDict):
+            # remove variables of a dictionary that has been reset or replaced
+            removed = self._keys - values.keys()
+            for key in removed:
+                user_ns.pop(key, None)
+            user_ns.update(values)
+            self.names.update(values.keys() - self._keys, removed)
+            self._keys = set(values.keys())
+            self._sos_dict = sos_dict
+            self._full = False
+        else:
+            for key in sos_dict.changed | self._names:
+                if key in values:
+                    user_ns[key] = values[key]
+                    if key not in self._keys:
+                        self._keys.add(key)
+                        self.names.update(added=[key])
+                elif key in self._keys:
+                    user_ns.pop(key, None)
+                    self._keys.discard(key)
+                    self.names.update(removed=[key])
+        if isinstance(sos_dict, TrackedWorkflowDict):
+            sos_dict.changed.clear()
+        self._names.clear()
+        self.generation += 1
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (sos), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import time
+import threading
+from collections import deque
+
+
+class StreamCoalescer(object):
+    '''Merge consecutive stream messages (stdout and stderr) of a cell so that
+    at most one stream message is sent per time window (or per max_size
+    characters). Pending output is flushed when the stream name changes, so
+    the order of stdout and stderr is kept, and after window seconds without
+    flush so that output of idle cells is not delayed.'''
+    def __init__(self, kernel, window=0.05, max_size=65536):
+        self.kernel = kernel
+        self.window = window
+        self.max_size = max_size
+        # number of messages received and sent, for diagnosis
+        self.messages_in = 0
+        self.messages_out = 0
+        self._name = None
+        self._chunks = []
+        self._size = 0
+        self._start = None
+        self._timer = None
+        self._lock = threading.RLock()
+
+    def write(self, name, text):
+        if not text:
+            return
+        with self._lock:
+            self.messages_in += 1
+            if self._name is not None and name != self._name:
+                self._flush()
+            self._name = name
+            self._chunks.append(text)
+            self._size += len(text)
+            if self._start is None:
+                self._start = time.time()
+                if self.window > 0:
+                    self._timer = threading.Timer(self.window, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+            if self.window <= 0 or self._size >= self.max_size or \
+                time.time() - self._start >= self.window:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._chunks:
+            return
+        # reset the buffer before sending so that the flush triggered
+        # by kernel.send_response has nothing to send
+        name, text = self._name, ''.join(self._chunks)
+        self._name = None
+        self._chunks = []
+        self._size = 0
+        self._start = None
+        self.messages_out += 1
+        self.kernel.send_response(self.kernel.iopub_socket, 'stream',
+            {'name': name, 'text': text})
+
+
+def _is_incomplete(line):
+    # if line does not end with a line boundary of str.splitlines
+    return line.splitlines()[0] == line
+
+
+class BoundedStream(object):
+    '''Pass the first head lines, and at most head_bytes bytes, of the stream
+    output of a cell to send, keep the last tail lines in a ring buffer, and
+    count the lines and bytes that are dropped in between. Lines are counted as
+    by str.splitlines so that progress output updated by '\\r' is bounded, and
+    kept lines longer than max_line characters are cut to their last max_line
+    characters. The kept tail is sent, after a notice on the dropped output,
+    when the stream is closed. If spill_file is specified, the complete output
+    is written to the file once the output is truncated.'''
+    def __init__(self, send, notify, head=200, tail=10, spill_file=None,
+        head_bytes=1024 * 1024, max_line=10000):
+        self.send = send
+        self.notify = notify
+        self.head = head
+        self.tail = tail
+        self.spill_file = spill_file
+        self.head_bytes = head_bytes
+        self.max_line = max_line
+        self.dropped_lines = 0
+        self.dropped_bytes = 0
+        self.truncated = False
+        self._lines = 0
+        self._bytes = 0
+        # if the last line that was sent is incomplete
+        self._open_line = False
+        self._head_output = []
+        self._tail_output = deque()
+        self._spill = None
+
+    def write(self, name, text):
+        if not text:
+            return
+        if not self.truncated:
+            in_head = self._take_head(text)
+            if in_head:
+                self.send(name, in_head)
+                if self.spill_file:
+                    self._head_output.append(in_head)
+            if not self.truncated:
+                return
+            if self.spill_file:
+                self._start_spill()
+            text = text[len(in_head):]
+            if not text:
+                return
+        if self._spill is not None:
+            self._spill.write(text)
+        self._keep_tail(name, text)
+
+    def _take_head(self, text):
+        # return the leading part of text that fits in head lines and
+        # head_bytes, and mark the stream as truncated if text does not fit
+        size = 0
+        for piece in text.splitlines(True):
+            new_line = 0 if self._open_line else 1
+            if self._lines + new_line > self.head:
+                self.truncated = True
+                break
+            piece_bytes = len(piece.encode('utf-8', 'replace'))
+            if self._bytes + piece_bytes > self.head_bytes:
+                # the part of a long line within head_bytes
+                room = self.head_bytes - self._bytes
+                part = piece.encode('utf-8', 'replace')[:room].decode('utf-8', 'ignore')
+                self._lines += new_line
+                self._bytes = self.head_bytes
+                self._open_line = True
+                self.truncated = True
+                size += len(part)
+                break
+            self._lines += new_line
+            self._bytes += piece_bytes
+            self._open_line = _is_incomplete(piece)
+            size += len(piece)
+        return text[:size]
+
+    def _start_spill(self):
+        try:
+            spill_dir = os.path.dirname(self.spill_file)
+            if spill_dir and not os.path.isdir(spill_dir):
+                os.makedirs(spill_dir)
+            self._spill = open(self.spill_file, 'w')
+            self._spill.write(''.join(self._head_output))
+        except Exception:
+            self._spill = None
+            self.spill_file = None
+        self._head_output = []
+
+    def _keep_tail(self, name, text):
+        pieces = text.splitlines(True)
+        # join the first piece with an incomplete last line
+        if self._tail_output and self._tail_output[-1][0] == name and \
+            _is_incomplete(self._tail_output[-1][1]):
+            pieces[0] = self._tail_output.pop()[1] + pieces[0]
+        # lines that will be pushed out of the ring buffer anyway
+        if len(pieces) > self.tail:
+            self._drop(pieces[:len(pieces) - self.tail])
+            pieces = pieces[len(pieces) - self.tail:]
+        for piece in pieces:
+            if len(piece) > self.max_line:
+                # count the cut part of a long line as dropped bytes only
+                self.dropped_bytes += len(piece[:-self.max_line].encode('utf-8', 'replace'))
+                piece = piece[-self.max_line:]
+            if len(self._tail_output) >= self.tail:
+                self._drop([self._tail_output.popleft()[1]])
+            self._tail_output.append((name, piece))
+
+    def _drop(self, lines):
+        self.dropped_lines += len(lines)
+        self.dropped_bytes += sum(len(x.encode('utf-8', 'replace')) for x in lines)
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        if self.dropped_lines or self.dropped_bytes:
+            self.notify(self.dropped_lines, self.dropped_bytes, self.spill_file)
+        for name, text in self._tail_output:
+            self.send(name, text)
+        self._tail_output.clear()
@@ -19,19 +19,24 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
+import os
+import io
+import re
 import base64
+import fnmatch
 import argparse
 from IPython.core.display import HTML
 from sos.utils import env, dehtml
 
-import pkg_resources
+from .cache import DiskCache, file_key
+from .discovery import iter_entry_points
 
 def get_previewers():
     # Note: data is zest.releaser specific: we want to pass
     # something to the plugin
     group = 'sos_previewers'
     result = []
-    for entrypoint in pkg_resources.iter_entry_points(group=group):
+    for entrypoint in iter_entry_points(group):
         # if ':' in entry point name, it should be a function
         try:
             name, priority = entrypoint.name.split(',', 1)
@@ -59,31 +64,508 @@ def get_previewers():
             [x for x in result if not isinstance(x[0], str)] + \
             [x for x in result if x[0] == '*']
 
-def preview_img(filename, kernel=None, style=None):
-    with open(filename, 'rb') as f:
-        image = f.read()
+class FileSample(io.RawIOBase):
+    '''A read-only file object that serves reads from the first HEAD_SIZE bytes
+    of a file, which are read only once, and opens the file only if content
+    beyond the head is needed. It is shared by all content detectors so that
+    they do not open and read the file again.'''
+    HEAD_SIZE = 64 * 1024
+
+    def __init__(self, filename):
+        super(FileSample, self).__init__()
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.head = f.read(self.HEAD_SIZE)
+        self.size = os.path.getsize(filename)
+        self._pos = 0
+        self._file = None
+
+    def readable(self):
+        return True
 
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f'negative seek position {offset}')
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, buffer):
+        if self._pos + len(buffer) <= len(self.head) or len(self.head) == self.size:
+            data = self.head[self._pos:self._pos + len(buffer)]
+        else:
+            if self._file is None:
+                self._file = open(self.filename, 'rb')
+            self._file.seek(self._pos)
+            data = self._file.read(len(buffer))
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        super(FileSample, self).close()
+
+
+def _is_tarfile(sample):
+    # tarfile.is_tarfile accepts file objects only since Python 3.9
+    import tarfile
+    try:
+        tarfile.open(fileobj=sample).close()
+        return True
+    except tarfile.TarError:
+        return False
+
+def _what_image(sample):
     import imghdr
-    image_type = imghdr.what(None, image)
-    image_data = base64.b64encode(image).decode('ascii')
-    if image_type != 'png':
+    return imghdr.what(None, sample.head)
+
+def _is_zipfile(sample):
+    import zipfile
+    return zipfile.is_zipfile(sample)
+
+# content detectors of the standard library that can work on a FileSample.
+# Other detectors are called with the name of the file.
+SAMPLE_DETECTORS = {
+    'imghdr:what': _what_image,
+    'zipfile:is_zipfile': _is_zipfile,
+    'tarfile:is_tarfile': _is_tarfile,
+}
+
+# previewers whose results contain ids of HTML elements that are unique to a
+# kernel session, and which cannot be reused from the preview cache. Their
+# expensive parts (e.g. counting records) are cached separately.
+UNCACHED_PREVIEWERS = {
+    'sos_notebook.preview:preview_csv',
+    'sos_notebook.preview:preview_xls',
+}
+
+# notebook options that previewers use as defaults of their options, and
+# which are therefore part of the keys of cached previews
+PREVIEW_OPTIONS = ('preview_image_size', 'preview_image_bytes', 'preview_max_bytes', 'preview_max_time')
+
+
+class PreviewerDispatcher(object):
+    '''Find the previewer of a file from previewers returned by get_previewers.
+    Filename patterns of previewers are compiled into a single regular
+    expression, in which the first matching pattern (with the highest priority)
+    wins. Content detectors share a FileSample of the file, and previewers are
+    loaded from their entry points only once.'''
+    def __init__(self, previewers):
+        patterns = [(x, y) for x, y, _ in previewers if isinstance(x, str) and x != '*']
+        self._patterns = [y for x, y in patterns]
+        self._regex = re.compile('|'.join(f'(?P<p{idx}>{fnmatch.translate(os.path.normcase(x))})'
+            for idx, (x, y) in enumerate(patterns)))
+        self._detectors = [(x, y) for x, y, _ in previewers if not isinstance(x, str)]
+        self._fallback = next((y for x, y, _ in previewers if x == '*'), None)
+        self._loaded = {}
+
+    def load(self, entrypoint):
+        if entrypoint not in self._loaded:
+            self._loaded[entrypoint] = entrypoint.load()
+        return self._loaded[entrypoint]
+
+    def _detect(self, detector, sample):
+        sniffer = SAMPLE_DETECTORS.get(f'{detector.__module__}:{detector.__name__}', None)
+        if sniffer is None:
+            return detector(sample.filename)
+        sample.seek(0)
+        return sniffer(sample)
+
+    def find(self, filename, on_error=None):
+        '''Return the previewer function of filename, or None if no previewer
+        is found. Errors of content detectors and failures to load their
+        previewers are passed to on_error and the next previewer is tried.'''
+        m = self._regex.match(os.path.normcase(os.path.basename(filename))) if self._patterns else None
+        if m:
+            return self.load(self._patterns[int(m.lastgroup[1:])])
+        if self._detectors:
+            sample = FileSample(filename)
+            try:
+                for detector, entrypoint in self._detectors:
+                    try:
+                        if not self._detect(detector, sample):
+                            continue
+                    except Exception as e:
+                        if on_error:
+                            on_error(str(e))
+                        continue
+                    try:
+                        return self.load(entrypoint)
+                    except Exception as e:
+                        if on_error:
+                            on_error(f'Failed to load previewer {entrypoint}: {e}')
+            finally:
+                sample.close()
+        if self._fallback is not None:
+            return self.load(self._fallback)
+        return None
+
+
+# previews, such as thumbnails of images, are saved to this directory and
+# reused until the previewed file or the preview options change. The directory
+# is relative to the directory of the notebook, and is resolved by the kernel
+# before the first preview.
+PREVIEW_CACHE_DIR = os.path.join('.sos', 'preview_cache')
+
+preview_cache = DiskCache(PREVIEW_CACHE_DIR)
+
+def _preview_img_parser(kernel):
+    parser = argparse.ArgumentParser(prog='%preview *.png')
+    parser.add_argument('--max-size', type=int,
+        default=800 if kernel is None else kernel.get_notebook_option('preview_image_size', 800),
+        help='''Maximum width and height in pixels of previewed images. Larger
+            images are previewed as thumbnails with a link to the image.''')
+    parser.add_argument('--max-bytes', type=int,
+        default=500000 if kernel is None else kernel.get_notebook_option('preview_image_bytes', 500000),
+        help='''Maximum size in bytes of previewed images.''')
+    parser.error = lambda msg: env.logger.warning(msg)
+    return parser
+
+def make_thumbnail(filename, max_size, max_bytes):
+    '''Return the image type and content of a thumbnail of the first frame of
+    image filename, which is no larger than max_size pixels and, if possible,
+    max_bytes bytes.'''
+    from wand.image import Image
+    # [0] reads only the first frame of multi-frame images such as tiff
+    with Image(filename=filename + '[0]') as img:
+        img.transform(resize=f'{max_size}x{max_size}>')
+        img.format = 'png'
+        image = img.make_blob()
+        for _ in range(3):
+            if len(image) <= max_bytes:
+                break
+            # switch to jpeg, then reduce dimensions of the thumbnail
+            if img.format == 'png':
+                img.format = 'jpeg'
+                img.compression_quality = 85
+            else:
+                ratio = (max_bytes / len(image)) ** 0.5
+                img.resize(max(1, int(img.width * ratio)), max(1, int(img.height * ratio)))
+            image = img.make_blob()
+        return img.format.lower(), image
+
+def _cached_thumbnail(filename, max_size, max_bytes):
+    key = file_key(filename, 'thumbnail', max_size, max_bytes)
+    thumbnail = preview_cache.get(key)
+    if thumbnail is None:
+        thumbnail = make_thumbnail(filename, max_size, max_bytes)
+        preview_cache.put(key, thumbnail)
+    return thumbnail
+
+def preview_img(filename, kernel=None, style=None):
+    import imghdr
+    from sos.utils import pretty_size
+    parser = _preview_img_parser(kernel)
+    try:
+        args = parser.parse_args([] if style is None else style['options'])
+    except SystemExit:
+        return
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        header = f.read(32)
+    image_type = imghdr.what(None, header)
+    # small images that can be displayed by browsers are sent as they are
+    if image_type in ('png', 'jpeg', 'gif') and size <= args.max_bytes:
         try:
             from wand.image import Image
-            img = Image(filename=filename)
-            return { 'image/' + image_type: image_data,
-                'image/png': base64.b64encode(img._repr_png_()).decode('ascii') }
+            # ping reads dimensions without decoding the image
+            with Image(filename=filename + '[0]', ping=True) as img:
+                small = img.width <= args.max_size and img.height <= args.max_size
         except Exception:
-            return { 'image/' + image_type: image_data }
-    else:
-        return { 'image/' + image_type: image_data }
+            small = True
+        if small:
+            with open(filename, 'rb') as f:
+                return { 'image/' + image_type: base64.b64encode(f.read()).decode('ascii') }
+    try:
+        thumb_type, image = _cached_thumbnail(filename, args.max_size, args.max_bytes)
+    except Exception as e:
+        if kernel is not None:
+            kernel.warn(f'Failed to create thumbnail of {filename}: {e}')
+        return f'{image_type or "unknown"} image ({pretty_size(size)})'
+    image_data = base64.b64encode(image).decode('ascii')
+    # the original image is linked, and served from disk, instead of being inlined
+    return { 'text/plain': f'Thumbnail of {filename} ({pretty_size(size)})',
+        'text/html': HTML(f'<div class="sos_preview_image"><img src="data:image/{thumb_type};base64,{image_data}"/><br/>'
+            f'<a href="{filename}" target="_blank">full size ({pretty_size(size)})</a></div>').data }
 
 def _preview_pdf_parser():
     parser = argparse.ArgumentParser(prog='%preview *.pdf')
     parser.add_argument('--pages', nargs='+', type=int,
         help='Pages of the PDF to preview.')
+    parser.add_argument('--dpi', type=int,
+        help='''Resolution at which pages are rasterised, default to a
+            resolution that keeps the preview within the preview budget.''')
     parser.error = lambda msg: env.logger.warning(msg)
     return parser
 
+def _pdf_int(key, content, default=None):
+    # direct integer value of key in a PDF dictionary
+    m = re.search(rb'/%s\s+(\d+)\b(?!\s+\d+\s+R)' % key, content)
+    return int(m.group(1)) if m else default
+
+def _pdf_read(pdf, offset, max_size=16 * 1024 * 1024):
+    # return number and content of the object at offset of a PDF file
+    pdf.seek(offset)
+    content = b''
+    while len(content) < max_size:
+        chunk = pdf.read(64 * 1024)
+        content += chunk
+        if not chunk or b'endobj' in content[-len(chunk) - 6:]:
+            break
+    m = re.match(rb'\s*(\d+)\s+\d+\s+obj\b(.*?)endobj', content, re.S)
+    if m is None:
+        raise ValueError(f'No object at offset {offset}')
+    return int(m.group(1)), m.group(2)
+
+def _pdf_stream(content):
+    '''Return the dictionary and decoded data of a stream object, which can be
+    compressed by FlateDecode, with or without the PNG Up predictor that is
+    used by cross-reference streams.'''
+    import zlib
+    m = re.search(rb'stream\r?\n', content)
+    if m is None:
+        raise ValueError('Not a stream object')
+    header = content[:m.start()]
+    length = _pdf_int(b'Length', header)
+    data = content[m.end():].rsplit(b'endstream', 1)[0] if length is None else content[m.end():m.end() + length]
+    filters = re.findall(rb'/(\w+Decode)\b', header)
+    if filters == [b'FlateDecode']:
+        data = zlib.decompressobj().decompress(data)
+    elif filters:
+        raise ValueError(f'Unsupported filters {filters}')
+    predictor = _pdf_int(b'Predictor', header, 1)
+    if predictor >= 10:
+        columns = _pdf_int(b'Columns', header, 1)
+        rows = []
+        row = bytes(columns)
+        for idx in range(0, len(data), columns + 1):
+            if data[idx] == 2:
+                row = bytes((x + y) & 0xff for x, y in zip(data[idx + 1:idx + columns + 1], row))
+            elif data[idx] == 0:
+                row = data[idx + 1:idx + columns + 1]
+            else:
+                raise ValueError(f'Unsupported PNG predictor {data[idx]}')
+            rows.append(row)
+        data = b''.join(rows)
+    elif predictor != 1:
+        raise ValueError(f'Unsupported predictor {predictor}')
+    return header, data
+
+def _pdf_xref_stream(content, offsets):
+    # add offsets, or (object stream, index) of objects in object streams,
+    # from a cross-reference stream, and return its dictionary
+    header, data = _pdf_stream(content)
+    widths = [int(x) for x in re.search(rb'/W\s*\[([\d\s]+)\]', header).group(1).split()]
+    m = re.search(rb'/Index\s*\[([\d\s]+)\]', header)
+    index = [int(x) for x in m.group(1).split()] if m else [0, _pdf_int(b'Size', header)]
+    pos = 0
+    for first, count in zip(index[::2], index[1::2]):
+        for num in range(first, first + count):
+            fields = []
+            for width in widths:
+                fields.append(int.from_bytes(data[pos:pos + width], 'big'))
+                pos += width
+            # entries are of type 1 (offset) if the type is omitted
+            entry_type = fields[0] if widths[0] else 1
+            if entry_type == 1:
+                offsets.setdefault(num, fields[1])
+            elif entry_type == 2:
+                offsets.setdefault(num, (fields[1], fields[2]))
+    return header
+
+def _pdf_xref(pdf, start):
+    '''Return offsets of objects in the cross-reference tables or streams of a
+    PDF file, starting from offset start and following the cross-references
+    of previous updates, and the object number of the document catalog.'''
+    offsets = {}
+    root = None
+    visited = set()
+    while start is not None and start not in visited:
+        visited.add(start)
+        pdf.seek(start)
+        m = re.match(rb'xref\s*', pdf.read(16))
+        if m is None:
+            trailer = _pdf_xref_stream(_pdf_read(pdf, start)[1], offsets)
+        else:
+            pos = start + m.end()
+            # subsections of fixed-size entries
+            while True:
+                pdf.seek(pos)
+                m = re.match(rb'(\d+)\s+(\d+)\s*', pdf.read(64))
+                if m is None:
+                    break
+                first, count = int(m.group(1)), int(m.group(2))
+                pdf.seek(pos + m.end())
+                entries = pdf.read(20 * count)
+                for idx in range(count):
+                    entry = entries[idx * 20:(idx + 1) * 20]
+                    if entry[17:18] == b'n':
+                        # entries of later updates override earlier ones
+                        offsets.setdefault(first + idx, int(entry[:10]))
+                pos += m.end() + 20 * count
+            pdf.seek(pos)
+            trailer = pdf.read(4096).split(b'startxref')[0]
+            # objects in object streams of hybrid files
+            xref_stream = _pdf_int(b'XRefStm', trailer)
+            if xref_stream is not None:
+                _pdf_xref_stream(_pdf_read(pdf, xref_stream)[1], offsets)
+        if root is None:
+            m = re.search(rb'/Root\s+(\d+)\s+\d+\s+R', trailer)
+            root = int(m.group(1)) if m else None
+        start = _pdf_int(b'Prev', trailer)
+    return offsets, root
+
+def _pdf_object(pdf, offsets, num, streams):
+    '''Return the content of object num of a PDF file, or None if the object
+    does not exist. Objects of object streams are decoded into streams.'''
+    entry = offsets.get(num, None)
+    if entry is None:
+        return None
+    if isinstance(entry, tuple):
+        if entry[0] not in streams:
+            header, data = _pdf_stream(_pdf_object(pdf, offsets, entry[0], streams))
+            first = _pdf_int(b'First', header)
+            # pairs of object numbers and offsets, followed by the objects
+            pairs = [int(x) for x in data[:first].split()]
+            ends = pairs[3::2] + [len(data) - first]
+            streams[entry[0]] = {x: data[first + y:first + z] for x, y, z in zip(pairs[::2], pairs[1::2], ends)}
+        return streams[entry[0]].get(num, None)
+    number, content = _pdf_read(pdf, entry)
+    if number != num:
+        raise ValueError(f'Object {number} found at offset {entry} of object {num}')
+    return content
+
+def _read_page_tree(filename):
+    # number of pages and the media box of the first page of a PDF file
+    with open(filename, 'rb') as pdf:
+        pdf.seek(max(0, os.path.getsize(filename) - 1024))
+        m = re.findall(rb'startxref\s+(\d+)', pdf.read())
+        if not m:
+            raise ValueError('No cross-reference table')
+        offsets, root = _pdf_xref(pdf, int(m[-1]))
+        streams = {}
+        catalog = None if root is None else _pdf_object(pdf, offsets, root, streams)
+        m = None if catalog is None else re.search(rb'/Pages\s+(\d+)\s+\d+\s+R', catalog)
+        node = None if m is None else _pdf_object(pdf, offsets, int(m.group(1)), streams)
+        if node is None:
+            raise ValueError('No page tree')
+        count = _pdf_int(b'Count', node)
+        box = None
+        # the first leaf of the page tree is the first page
+        for _ in range(32):
+            m = re.search(rb'/MediaBox\s*\[\s*([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s*\]', node)
+            if m is not None:
+                box = [float(x) for x in m.groups()]
+            m = re.search(rb'/Kids\s*\[\s*(\d+)\s+\d+\s+R', node)
+            if m is None:
+                break
+            node = _pdf_object(pdf, offsets, int(m.group(1)), streams)
+            if node is None:
+                box = None
+                break
+    return count, box
+
+def _read_pdf_page_info(filename):
+    # number of pages and size of the first page from pypdf, or from
+    # ImageMagick, which pings pages without rasterising them
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        from wand.image import Image
+        with Image(filename=filename, ping=True) as img:
+            return len(img.sequence), img.sequence[0].width, img.sequence[0].height
+    reader = PdfReader(filename)
+    box = reader.pages[0].mediabox
+    return len(reader.pages), float(box.width), float(box.height)
+
+def pdf_page_info(filename):
+    '''Return the number of pages of a PDF file, and width and height in
+    points of its first page, following the document catalog to the root of
+    the page tree and its first page, whose size can be inherited from the
+    page tree. Values that cannot be found this way, for example because of
+    unsupported compression, are read by pypdf or ImageMagick, and are
+    returned as None if they cannot be read.'''
+    count, width, height = None, None, None
+    try:
+        count, box = _read_page_tree(filename)
+        if box is not None:
+            width, height = abs(box[2] - box[0]), abs(box[3] - box[1])
+    except Exception as e:
+        env.logger.debug(f'Failed to read page tree of {filename}: {e}')
+    if count is None or width is None:
+        try:
+            info = _read_pdf_page_info(filename)
+        except Exception as e:
+            env.logger.debug(f'Failed to read pages of {filename}: {e}')
+            return count, width, height
+        count = info[0] if count is None else count
+        if width is None:
+            width, height = info[1:]
+    return count, width, height
+
+def rasterize_pdf_page(filename, page, dpi):
+    '''Return content of a png image of page (starting from 0) of a PDF file,
+    rendered at dpi. [page] lets ImageMagick render only this page.'''
+    from wand.image import Image
+    with Image(filename=f'{filename}[{page}]', resolution=dpi) as img:
+        img.format = 'png'
+        return img.make_blob()
+
+_pdf_pool = None
+
+def _get_pdf_pool():
+    # pages are rasterised by worker processes, which are started with spawn
+    # because the threads of the kernel are not safe to fork
+    global _pdf_pool
+    if _pdf_pool is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        _pdf_pool = ProcessPoolExecutor(max_workers=min(4, os.cpu_count() or 1),
+            mp_context=multiprocessing.get_context('spawn'))
+    return _pdf_pool
+
+def shutdown_pdf_pool():
+    global _pdf_pool
+    if _pdf_pool is not None:
+        _pdf_pool.shutdown(wait=False)
+        _pdf_pool = None
+
+def rasterize_pdf_pages(filename, pages, dpi):
+    '''Return png images of pages of a PDF file. Pages are rasterised in
+    parallel by a pool of processes and are cached individually.'''
+    # worker processes keep the working directory in which they are started
+    filename = os.path.abspath(filename)
+    keys = [file_key(filename, 'pdf_page', page, dpi) for page in pages]
+    images = [preview_cache.get(key) for key in keys]
+    missing = [idx for idx, image in enumerate(images) if image is None]
+    if len(missing) == 1:
+        rasterized = [rasterize_pdf_page(filename, pages[missing[0]], dpi)]
+    elif missing:
+        try:
+            rasterized = list(_get_pdf_pool().map(rasterize_pdf_page,
+                [filename] * len(missing), [pages[idx] for idx in missing], [dpi] * len(missing)))
+        except Exception as e:
+            # for example BrokenProcessPool if a worker was killed
+            env.logger.debug(f'Failed to rasterise pages of {filename} in parallel: {e}')
+            shutdown_pdf_pool()
+            rasterized = [rasterize_pdf_page(filename, pages[idx], dpi) for idx in missing]
+    for idx, image in zip(missing, rasterized if missing else []):
+        images[idx] = image
+        preview_cache.put(keys[idx], image)
+    return images
+
 def preview_pdf(filename, kernel=None, style=None):
     use_png = False
     if style is not None and 'style' in style:
@@ -92,47 +574,36 @@ def preview_pdf(filename, kernel=None, style=None):
                 kernel.warn(f'Option --style of PDF preview only accept parameter png: {style["style"]} provided')
         else:
             use_png = True
+    nPages, width, height = pdf_page_info(filename)
     if use_png:
         try:
-            # this import will fail even if wand is installed
-            # if imagemagick is not installed properly.
-            from wand.image import Image
-            img = Image(filename=filename)
-            nPages = len(img.sequence)
-            pages = list(range(nPages))
-
-            if style is not None and 'options' in style:
-                parser = _preview_pdf_parser()
-                try:
-                    args = parser.parse_args(style['options'])
-                except SystemExit:
-                    return
-                if args.pages is not None:
+            parser = _preview_pdf_parser()
+            try:
+                args = parser.parse_args([] if style is None or 'options' not in style else style['options'])
+            except SystemExit:
+                return
+            # all pages, or the first page if the number of pages is unknown
+            pages = list(range(nPages or 1))
+            if args.pages is not None:
+                if nPages is not None and any(p < 1 or p > nPages for p in args.pages):
+                    if kernel is not None:
+                        kernel.warn(f'Page {args.pages} out of range of the pdf file ({nPages} pages)')
+                else:
                     pages = [x-1 for x in args.pages]
-                    for p in pages:
-                        if p >= nPages:
-                            if kernel is not None:
-                                kernel.warn(f'Page {p} out of range of the pdf file ({nPages} pages)')
-                            pages = list(range(nPages))
-                            break
-            # single page PDF
-            if len(pages) == 1 and pages[0] == 0:
-                return {
-                    'image/png': base64.b64encode(img._repr_png_()).decode('ascii') }
-            elif len(pages) == 1:
-                # if only one page
-                return {
-                    'image/png': base64.b64encode(Image(img.sequence[pages[0]])._repr_png_()).decode('ascii') }
+            if args.dpi is not None:
+                dpi = args.dpi
             else:
-                image = Image(width=img.width, height=img.height * len(pages))
-                for i,p in enumerate(pages):
-                    image.composite(
-                        img.sequence[p],
-                        top=img.height * i,
-                        left=0
-                    )
-                return {
-                    'image/png': base64.b64encode(image._repr_png_()).decode('ascii') }
+                from .budget import PreviewBudget
+                budget = PreviewBudget() if kernel is None else kernel.preview_budget
+                # letter size if the size of pages is unknown
+                dpi = budget.dpi((width or 612) / 72, (height or 792) / 72, len(pages))
+            images = [base64.b64encode(x).decode('ascii') for x in rasterize_pdf_pages(filename, pages, dpi)]
+            if len(images) == 1:
+                return { 'image/png': images[0] }
+            # pages are stacked by the browser instead of being composited
+            # into a single image
+            return { 'text/plain': f'Pages {", ".join(str(x + 1) for x in pages)} of {filename}',
+                'text/html': HTML(''.join(f'<div><img src="data:image/png;base64,{x}"/></div>' for x in images)).data }
         except Exception as e:
             if kernel is not None:
                 kernel.warn(e)
@@ -140,16 +611,11 @@ def preview_pdf(filename, kernel=None, style=None):
                 HTML(f'<iframe src={filename} width="100%"></iframe>').data}
     else:
         # by default use iframe, because PDF figure can have multiple pages (#693)
-        # try to get width and height
-        try:
-            from wand.image import Image
-            img = Image(filename=filename)
+        if width and height:
             return { 'text/html':
-                HTML(f'<iframe src={filename} width="800px" height="{img.height/img.width * 800}px"></iframe>').data}
-        except Exception as e:
-            kernel.warn(e)
-            return { 'text/html':
-                HTML(f'<iframe src={filename} width="100%"></iframe>').data}
+                HTML(f'<iframe src={filename} width="800px" height="{height/width * 800}px"></iframe>').data}
+        return { 'text/html':
+            HTML(f'<iframe src={filename} width="100%"></iframe>').data}
 
 def preview_html(filename, kernel=None, style=None):
     with open(filename) as html:
@@ -184,17 +650,148 @@ def preview_txt(filename, kernel=None, style=None):
                 content += fin.readline()
     return content
 
+def _open_compressed(filename, raw):
+    # open a compressed file from its raw file object, or return None if the
+    # file is not compressed
+    if filename.endswith('.gz'):
+        import gzip
+        return gzip.GzipFile(fileobj=raw)
+    elif filename.endswith('.bz2'):
+        import bz2
+        return bz2.BZ2File(raw)
+    elif filename.endswith('.xz'):
+        import lzma
+        return lzma.LZMAFile(raw)
+    elif filename.endswith('.zip'):
+        raise ValueError('Cannot count lines of zip files')
+    return None
+
+def count_lines(filename, exact_size=256 * 1024 * 1024, sample_size=4 * 1024 * 1024):
+    '''Return the number of lines of a text file, which can be compressed with
+    gzip, bzip2 or xz, and whether or not the number is exact. Lines of files
+    larger than exact_size are estimated from samples of sample_size bytes at
+    the beginning, middle and end of the file, and lines of compressed files
+    are estimated from the first sample_size compressed bytes.'''
+    import mmap
+    size = os.path.getsize(filename)
+    if size == 0:
+        return 0, True
+    chunk = 16 * 1024 * 1024
+    with open(filename, 'rb') as raw:
+        compressed = _open_compressed(filename.lower(), raw)
+        if compressed is not None:
+            lines = 0
+            with compressed:
+                while raw.tell() < sample_size:
+                    data = compressed.read(chunk)
+                    if not data:
+                        return lines, True
+                    lines += data.count(b'\n')
+            return int(lines * size / raw.tell()), False
+        with mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if size <= exact_size:
+                lines = sum(mm[i:i + chunk].count(b'\n') for i in range(0, size, chunk))
+                # last line without trailing newline
+                return lines + (mm[size - 1:size] != b'\n'), True
+            sampled = 0
+            lines = 0
+            for start in (0, size // 2, size - sample_size):
+                data = mm[start:start + sample_size]
+                lines += data.count(b'\n')
+                sampled += len(data)
+            return int(lines * size / sampled), False
+
 def preview_csv(filename, kernel=None, style=None):
     import pandas
     from .visualize import Visualizer
-    data = pandas.read_csv(filename)
-    return Visualizer(kernel, style).preview(data)
+    visualizer = Visualizer(kernel, style)
+    # only records that will be previewed are read
+    limit = visualizer.get_limit()
+    name = filename.lower()
+    for ext in ('.gz', '.bz2', '.xz', '.zip'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    data = pandas.read_csv(filename, sep='\t' if name.endswith(('.tsv', '.tab')) else ',', nrows=limit)
+    total_rows = None
+    if limit is not None and data.shape[0] >= limit:
+        try:
+            # number of lines minus the header
+            key = file_key(filename, 'count_lines')
+            counted = preview_cache.get(key)
+            if counted is None:
+                counted = count_lines(filename)
+                preview_cache.put(key, counted)
+            lines, exact = counted
+            total_rows = lines - 1 if exact else f'about {lines - 1}'
+        except Exception as e:
+            env.logger.debug(f'Failed to count records of {filename}: {e}')
+    return visualizer.preview(data, total_rows)
+
+def _get_xls_parser():
+    parser = argparse.ArgumentParser(prog='%preview *.xls', add_help=False)
+    parser.add_argument('--sheet', help='''Name or index (starting from 0) of
+        the worksheet to preview, default to the first worksheet.''')
+    parser.error = lambda msg: env.logger.warning(msg)
+    return parser
+
+def _read_xlsx(filename, sheet, limit):
+    # read rows of a xlsx file in read-only mode, which streams the
+    # worksheet instead of loading the entire workbook
+    import openpyxl
+    wb = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+    try:
+        # dimensions are read from the metadata of worksheets and can be
+        # unavailable (None) if the file was not written with it
+        sheets = [(ws.title, ws.max_row, ws.max_column) for ws in wb.worksheets]
+        ws = wb.worksheets[sheet] if isinstance(sheet, int) else wb[sheet]
+        rows = list(ws.iter_rows(max_row=None if limit is None else limit + 1, values_only=True))
+        return sheets, ws.title, rows, ws.max_row
+    finally:
+        wb.close()
+
+def _read_xls(filename, sheet, limit):
+    # on_demand loads only the worksheet that is previewed
+    import xlrd
+    wb = xlrd.open_workbook(filename, on_demand=True)
+    try:
+        try:
+            ws = wb.sheet_by_index(sheet) if isinstance(sheet, int) else wb.sheet_by_name(sheet)
+        except xlrd.XLRDError:
+            raise KeyError(sheet)
+        # dimensions of other worksheets are unknown until they are loaded
+        sheets = [(x, ws.nrows, ws.ncols) if x == ws.name else (x, None, None) for x in wb.sheet_names()]
+        nrows = ws.nrows if limit is None else min(ws.nrows, limit + 1)
+        return sheets, ws.name, [ws.row_values(i) for i in range(nrows)], ws.nrows
+    finally:
+        wb.release_resources()
 
 def preview_xls(filename, kernel=None, style=None):
     import pandas
     from .visualize import Visualizer
-    data = pandas.read_excel(filename)
-    return Visualizer(kernel, style).preview(data)
+    parser = _get_xls_parser()
+    try:
+        args, options = parser.parse_known_args([] if style is None else style['options'])
+    except SystemExit:
+        return
+    sheet = 0 if args.sheet is None else int(args.sheet) if args.sheet.isdigit() else args.sheet
+    visualizer = Visualizer(kernel, {'style': None if style is None else style['style'], 'options': options})
+    # only records that will be previewed are read
+    limit = visualizer.get_limit()
+    try:
+        sheets, name, rows, max_row = (_read_xls if filename.lower().endswith('.xls') else _read_xlsx)(filename, sheet, limit)
+    except (KeyError, IndexError) as e:
+        raise ValueError(f'Worksheet {args.sheet} does not exist in {filename}: {e}')
+    except ImportError:
+        # fall back to pandas without listing of worksheets
+        data = pandas.read_excel(filename, sheet_name=sheet, nrows=limit)
+        return visualizer.preview(data)
+    data = pandas.DataFrame(list(rows[1:]), columns=rows[0] if rows else None)
+    result = visualizer.preview(data, None if max_row is None or limit is None else max(max_row - 1, 0))
+    if len(sheets) > 1 and isinstance(result, dict) and 'text/html' in result:
+        desc = ', '.join((f'<b>{x}</b>' if x == name else x) + ('' if r is None else f' ({r} x {c})')
+            for x, r, c in sheets)
+        result['text/html'] = f'<div class="sos_hint">Sheets: {desc}</div>' + result['text/html']
+    return result
 
 def preview_zip(filename, kernel=None, style=None):
     import zipfile
@@ -223,6 +820,253 @@ def preview_gz(filename, kernel=None, style=None):
     except Exception:
         return 'binary data'
 
+#
+# genomics formats, which are previewed from their headers and first records
+# without decompressing entire files
+#
+def _get_genomics_parser(prog):
+    parser = argparse.ArgumentParser(prog=prog)
+    parser.add_argument('-l', '--limit', type=int, default=5, help='''Maximum number
+        of records to preview.''')
+    parser.add_argument('--count', action='store_true', help='''Count records of
+        files without index, within the time limit of previews (option
+        preview_max_time of sos-notebook).''')
+    parser.error = lambda msg: env.logger.warning(msg)
+    return parser
+
+def _parse_genomics_options(prog, style):
+    parser = _get_genomics_parser(prog)
+    try:
+        args = parser.parse_args([] if style is None else style['options'])
+    except SystemExit:
+        return None
+    # a negative limit previews all records
+    if args.limit < 0:
+        args.limit = None
+    return args
+
+def _open_text(filename):
+    # gzip also reads bgzip-compressed files, one block at a time
+    with open(filename, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        import gzip
+        return gzip.open(filename, 'rt', errors='replace')
+    return open(filename, 'r', errors='replace')
+
+def _read_index_refs(idx, n_ref, pseudo_bin, csi=False):
+    # return number of records in the pseudo bins of references of a
+    # bai/tbi/csi index, skipping chunks and linear indexes of other bins
+    import struct
+    total = 0
+    for _ in range(n_ref):
+        n_bin, = struct.unpack('<i', idx.read(4))
+        for _ in range(n_bin):
+            if csi:
+                bin_id, _, n_chunk = struct.unpack('<IQi', idx.read(16))
+            else:
+                bin_id, n_chunk = struct.unpack('<Ii', idx.read(8))
+            if bin_id == pseudo_bin and n_chunk == 2:
+                _, _, n_mapped, n_unmapped = struct.unpack('<QQQQ', idx.read(32))
+                total += n_mapped + n_unmapped
+            else:
+                idx.seek(16 * n_chunk, 1)
+        if not csi:
+            n_intv, = struct.unpack('<i', idx.read(4))
+            idx.seek(8 * n_intv, 1)
+    # number of unplaced records, which is optional
+    unplaced = idx.read(8)
+    if len(unplaced) == 8:
+        total += struct.unpack('<Q', unplaced)[0]
+    return total
+
+def index_record_count(filename):
+    '''Return the number of records of a bam, vcf or bed file from its .bai,
+    .tbi or .csi index, or None if the file has no usable index. Indexes are
+    read as streams so that large indexes are not loaded into memory.'''
+    import struct
+    import gzip
+    base = os.path.splitext(filename)[0]
+    for index in (filename + '.csi', filename + '.tbi', filename + '.bai', base + '.bai'):
+        if not os.path.isfile(index) or os.path.getmtime(index) < os.path.getmtime(filename):
+            continue
+        try:
+            with open(index, 'rb') as idx:
+                magic = idx.read(2)
+            # tbi and csi indexes are compressed by bgzip
+            with (gzip.open(index, 'rb') if magic == b'\x1f\x8b' else open(index, 'rb')) as idx:
+                magic = idx.read(4)
+                if magic == b'BAI\x01':
+                    n_ref, = struct.unpack('<i', idx.read(4))
+                    return _read_index_refs(idx, n_ref, 37450)
+                elif magic == b'TBI\x01':
+                    n_ref, = struct.unpack('<i', idx.read(4))
+                    idx.seek(24, 1)
+                    l_nm, = struct.unpack('<i', idx.read(4))
+                    idx.seek(l_nm, 1)
+                    return _read_index_refs(idx, n_ref, 37450)
+                elif magic == b'CSI\x01':
+                    _, depth, l_aux = struct.unpack('<iii', idx.read(12))
+                    idx.seek(l_aux, 1)
+                    n_ref, = struct.unpack('<i', idx.read(4))
+                    return _read_index_refs(idx, n_ref,
+                        ((1 << ((depth + 1) * 3)) - 1) // 7 + 1, csi=True)
+        except Exception as e:
+            env.logger.debug(f'Failed to read index {index}: {e}')
+    return None
+
+def _count_records(records, counted, kernel):
+    # count remaining records from an iterator within the time limit of
+    # previews, and return a description such as "1000" or "at least 1000"
+    import time
+    max_time = 1 if kernel is None else kernel.preview_budget.max_time
+    deadline = time.time() + max_time
+    count = counted
+    for count, _ in enumerate(records, counted + 1):
+        if count % 10000 == 0 and time.time() > deadline:
+            return f'at least {count}'
+    return str(count)
+
+def _record_count(filename, records, counted, args, kernel):
+    # number of records from index, or from counted records that have been
+    # read and remaining records if --count is specified
+    count = index_record_count(filename)
+    if count is not None:
+        return f'{count} records (from index)'
+    elif args.count:
+        return f'{_count_records(records, counted, kernel)} records'
+    return None
+
+def _format_preview(header, records, limit, count):
+    more = limit is not None and len(records) > limit
+    lines = header + records[:limit]
+    if count is not None:
+        lines.append(f'... {count}' if more else count)
+    elif more:
+        lines.append('...')
+    return '\n'.join(lines) + '\n'
+
+def _truncate(line, width=200):
+    return line if len(line) <= width else line[:width] + ' ...'
+
+def preview_vcf(filename, kernel=None, style=None):
+    args = _parse_genomics_options('%preview *.vcf', style)
+    if args is None:
+        return
+    from itertools import islice
+    header = []
+    records = []
+    with _open_text(filename) as vcf:
+        meta = 0
+        for line in vcf:
+            if line.startswith('##'):
+                meta += 1
+                if line.startswith('##fileformat'):
+                    header.append(line.rstrip('\n'))
+                continue
+            if line.startswith('#'):
+                fields = line.rstrip('\n').split('\t')
+                header.append(f'{meta} meta-information lines, {max(len(fields) - 9, 0)} samples')
+                header.append('\t'.join(fields[:9]) + (' ...' if len(fields) > 9 else ''))
+                continue
+            records.append(line)
+            break
+        # one more record to tell if there are more records
+        records.extend(islice(vcf, args.limit))
+        count = _record_count(filename, vcf, len(records), args, kernel)
+    # the first fields of records with many samples
+    records = [_truncate('\t'.join(x.rstrip('\n').split('\t', 10)[:10]) + (' ...' if x.count('\t') > 9 else ''))
+        for x in records]
+    return _format_preview(header, records, args.limit, count)
+
+def _preview_lines(filename, kernel, style, prog, lines_per_record=1, describe=None, header_prefixes=(),
+    max_header=10):
+    # preview records of lines_per_record lines of text files, after leading
+    # header lines that start with header_prefixes
+    args = _parse_genomics_options(prog, style)
+    if args is None:
+        return
+    from itertools import chain, islice
+    header = []
+    with _open_text(filename) as text:
+        first = []
+        n_header = 0
+        for line in text:
+            if not header_prefixes or not line.startswith(header_prefixes):
+                first.append(line)
+                break
+            n_header += 1
+            if n_header <= max_header:
+                header.append(_truncate(line.rstrip('\n')))
+        if n_header > max_header:
+            header.append(f'... {n_header} header lines')
+        lines = list(islice(chain(first, text), None if args.limit is None else lines_per_record * (args.limit + 1)))
+        records = [lines[i:i + lines_per_record] for i in range(0, len(lines), lines_per_record)]
+        count = _record_count(filename, (x for i, x in enumerate(text) if i % lines_per_record == 0),
+            len(records), args, kernel)
+    records = [describe(x) if describe else _truncate(x[0].rstrip('\n')) for x in records]
+    return _format_preview(header, records, args.limit, count)
+
+def preview_bed(filename, kernel=None, style=None):
+    return _preview_lines(filename, kernel, style, '%preview *.bed', header_prefixes=('track', 'browser', '#'))
+
+def _describe_read(lines):
+    name = lines[0].rstrip('\n')
+    seq = lines[1].strip() if len(lines) > 1 else ''
+    return f'{_truncate(name, 80)}\t{len(seq)} bp\t{_truncate(seq, 60)}'
+
+def preview_fastq(filename, kernel=None, style=None):
+    return _preview_lines(filename, kernel, style, '%preview *.fastq', 4, _describe_read)
+
+def _read_bam_records(bam, refs):
+    # iterate through alignments of a bam file as SAM-like lines
+    import struct
+    while True:
+        size = bam.read(4)
+        if len(size) < 4:
+            return
+        block = bam.read(struct.unpack('<i', size)[0])
+        ref_id, pos, l_read_name, mapq, _, n_cigar_op, flag, l_seq, next_ref_id, next_pos, tlen = \
+            struct.unpack_from('<iiBBHHHiiii', block)
+        offset = 32
+        read_name = block[offset:offset + l_read_name - 1].decode(errors='replace')
+        offset += l_read_name
+        cigar = ''.join(f'{x >> 4}{"MIDNSHP=X"[x & 0xf]}' for x in
+            struct.unpack_from(f'<{n_cigar_op}I', block, offset)) or '*'
+        offset += 4 * n_cigar_op
+        seq = ''.join('=ACMGRSVTWYHKDBN'[(block[offset + i // 2] >> (4 * (1 - i % 2))) & 0xf]
+            for i in range(min(l_seq, 60))) + ('...' if l_seq > 60 else '')
+        ref = refs[ref_id] if 0 <= ref_id < len(refs) else '*'
+        next_ref = '=' if next_ref_id == ref_id and ref_id >= 0 else \
+            refs[next_ref_id] if 0 <= next_ref_id < len(refs) else '*'
+        yield '\t'.join([read_name, str(flag), ref, str(pos + 1), str(mapq), cigar,
+            next_ref, str(next_pos + 1), str(tlen), seq or '*'])
+
+def preview_bam(filename, kernel=None, style=None):
+    args = _parse_genomics_options('%preview *.bam', style)
+    if args is None:
+        return
+    import gzip
+    import struct
+    from itertools import islice
+    with gzip.open(filename, 'rb') as bam:
+        if bam.read(4) != b'BAM\x01':
+            return 'Not a BAM file'
+        l_text, = struct.unpack('<i', bam.read(4))
+        text = bam.read(l_text).decode(errors='replace').rstrip('\x00\n')
+        n_ref, = struct.unpack('<i', bam.read(4))
+        refs = []
+        for _ in range(n_ref):
+            l_name, = struct.unpack('<i', bam.read(4))
+            refs.append(bam.read(l_name).rstrip(b'\x00').decode(errors='replace'))
+            bam.read(4)
+        header = [x for x in text.split('\n') if x.startswith('@HD')]
+        header.append(f'{len(text.splitlines())} header lines, {n_ref} references')
+        alignments = _read_bam_records(bam, refs)
+        records = list(islice(alignments, None if args.limit is None else args.limit + 1))
+        count = _record_count(filename, alignments, len(records), args, kernel)
+    return _format_preview(header, records, args.limit, count)
+
 def preview_md(filename, kernel=None, style=None):
     import markdown
     with open(filename) as fin:
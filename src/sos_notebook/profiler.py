@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (sos), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import time
+from functools import wraps
+
+#
+# Profiling of phases of cell execution. Phases are recorded only for cells
+# that are executed while profiling is enabled (%profile on). Otherwise
+# phase() returns a shared no-op context manager so the instrumented
+# functions pay only for a global lookup.
+#
+
+# profile of the cell that is being executed, if profiling is enabled
+_active = None
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+class _Phase(object):
+    __slots__ = ('_profile', '_name', '_wall', '_cpu')
+
+    def __init__(self, profile, name):
+        self._profile = profile
+        self._name = name
+
+    def __enter__(self):
+        if self._name in self._profile.running:
+            # recursive calls (e.g. _do_execute of stacked magics) are counted
+            # by the outermost call
+            self._name = None
+        else:
+            self._profile.running.add(self._name)
+            self._wall = time.perf_counter()
+            self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._name is not None:
+            self._profile.running.discard(self._name)
+            self._profile.add(self._name, time.perf_counter() - self._wall,
+                time.process_time() - self._cpu)
+        return False
+
+class CellProfile(object):
+    '''Number of calls, wall and CPU time of phases of the execution of a cell'''
+    def __init__(self, cell):
+        self.cell = cell
+        # phase -> [calls, wall time, cpu time]
+        self.phases = {}
+        self.running = set()
+        self.start_time = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self.wall = None
+        self.cpu = None
+
+    def add(self, name, wall, cpu):
+        stat = self.phases.setdefault(name, [0, 0.0, 0.0])
+        stat[0] += 1
+        stat[1] += wall
+        stat[2] += cpu
+
+    def finish(self):
+        self.wall = time.perf_counter() - self._wall
+        self.cpu = time.process_time() - self._cpu
+
+    def to_dict(self):
+        return {
+            'cell': self.cell,
+            'time': self.start_time,
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'phases': {name: {'calls': calls, 'wall': wall, 'cpu': cpu}
+                for name, (calls, wall, cpu) in self.phases.items()}
+        }
+
+class CellProfiler(object):
+    '''Profiler of the SoS kernel that collects profiles of executed cells
+    and aggregates them over the session.'''
+    def __init__(self, enabled=False, log_file=None):
+        self.enabled = enabled
+        # file to which the profile of each cell is appended as a json line
+        self.log_file = log_file
+        self.reset()
+
+    def reset(self):
+        self.last = None
+        self.cells = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        # phase -> [cells, calls, wall time, cpu time]
+        self.totals = {}
+
+    def start_cell(self, cell):
+        global _active
+        _active = CellProfile(cell) if self.enabled else None
+
+    def end_cell(self):
+        global _active
+        profile = _active
+        if profile is None:
+            return
+        _active = None
+        profile.finish()
+        self.last = profile
+        self.cells += 1
+        self.wall += profile.wall
+        self.cpu += profile.cpu
+        for name, (calls, wall, cpu) in profile.phases.items():
+            total = self.totals.setdefault(name, [0, 0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += calls
+            total[2] += wall
+            total[3] += cpu
+        if self.log_file:
+            with open(self.log_file, 'a') as log:
+                log.write(json.dumps(profile.to_dict()) + '\n')
+
+    def summary(self, aggregate=False):
+        '''Text table of the profile of the last profiled cell, or of all
+        profiled cells if aggregate is True.'''
+        if aggregate:
+            if not self.cells:
+                return None
+            rows = [(name, calls, wall, cpu) for name, (_, calls, wall, cpu) in self.totals.items()]
+            title = f'Profile of {self.cells} cell{"s" if self.cells > 1 else ""}'
+            wall, cpu = self.wall, self.cpu
+        else:
+            if self.last is None:
+                return None
+            rows = [(name, calls, wall, cpu) for name, (calls, wall, cpu) in self.last.phases.items()]
+            title = f'Profile of cell {self.last.cell}'
+            wall, cpu = self.last.wall, self.last.cpu
+        rows.sort(key=lambda x: -x[2])
+        lines = [title, f'{"phase":<12}{"calls":>8}{"wall (s)":>12}{"cpu (s)":>12}']
+        lines.extend(f'{name:<12}{calls:>8}{w:>12.4f}{c:>12.4f}' for name, calls, w, c in rows)
+        lines.append(f'{"total":<12}{"":>8}{wall:>12.4f}{cpu:>12.4f}')
+        return '\n'.join(lines) + '\n'
+
+def phase(name):
+    '''Context manager that records wall and CPU time of phase name of the
+    cell that is being executed.'''
+    if _active is None:
+        return _NULL_PHASE
+    return _Phase(_active, name)
+
+def profiled(name):
+    '''Decorator that records calls to the decorated function as phase name'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            with _Phase(_active, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
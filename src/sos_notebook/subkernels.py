@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (sos), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import queue
+import time
+import threading
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import Future
+
+from sos.utils import env
+
+# definition of a subkernel, which is sent to the frontend as a list
+#
+# 1. displayed name
+# 2. kernel name
+# 3. language name
+# 4. color
+# 5. options of the language module
+KernelInfo = namedtuple('KernelInfo', ['name', 'kernel', 'language', 'color', 'options'])
+
+class SubkernelRegistry(object):
+    '''Definitions of subkernels, indexed by displayed name, kernel name, and
+    language.'''
+    def __init__(self):
+        self._by_name = {}
+        # kernel name -> displayed names, language -> displayed names
+        self._by_kernel = defaultdict(set)
+        self._by_language = defaultdict(set)
+        self._sorted = None
+
+    def add(self, kinfo):
+        '''Add or replace (by displayed name) definition kinfo'''
+        kinfo = KernelInfo(*kinfo)
+        old = self._by_name.get(kinfo.name, None)
+        if old is not None:
+            self._by_kernel[old.kernel].discard(old.name)
+            self._by_language[old.language].discard(old.name)
+        self._by_name[kinfo.name] = kinfo
+        self._by_kernel[kinfo.kernel].add(kinfo.name)
+        self._by_language[kinfo.language].add(kinfo.name)
+        self._sorted = None
+        return kinfo
+
+    def get(self, name):
+        return self._by_name.get(name, None)
+
+    def by_kernel(self, kernel):
+        '''Definition with kernel name kernel, the first by displayed name if
+        there are multiple instances of the kernel.'''
+        names = self._by_kernel.get(kernel, None)
+        return self._by_name[min(names)] if names else None
+
+    def by_language(self, language):
+        return [self._by_name[x] for x in sorted(self._by_language.get(language, []))]
+
+    def has_kernel(self, kernel):
+        return bool(self._by_kernel.get(kernel, None))
+
+    def sorted(self):
+        # sorted by name to avoid unnecessary change of .ipynb files
+        if self._sorted is None:
+            self._sorted = [self._by_name[x] for x in sorted(self._by_name)]
+        return self._sorted
+
+
+class _StderrCollector(object):
+    '''Forward standard error of a subkernel to the standard error of the SoS
+    kernel, keeping the last few lines so that the reason of a failed start
+    can be reported.'''
+    def __init__(self, fd, max_lines=50):
+        self.lines = deque(maxlen=max_lines)
+        self._thread = threading.Thread(target=self._collect, args=(fd,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _collect(self, fd):
+        with os.fdopen(fd, 'rb') as err:
+            for line in err:
+                self.lines.append(line.decode(errors='replace'))
+                try:
+                    sys.__stderr__.write(self.lines[-1])
+                    sys.__stderr__.flush()
+                except Exception:
+                    pass
+
+    def message(self, timeout=1):
+        # wait for the pipe to be closed by the terminated kernel
+        self._thread.join(timeout)
+        return ''.join(self.lines)
+
+
+def start_subkernel(kernel_name, cwd=None, startup_timeout=60):
+    '''Start a subkernel with specified kernel name and return its kernel
+    manager and (started) client. If the kernel fails to start, a RuntimeError
+    with standard error of the kernel is raised so that the kernel does not
+    have to be started again to find out what went wrong.'''
+    from jupyter_client import manager
+    km = manager.KernelManager(kernel_name=kernel_name)
+    err_read, err_write = os.pipe()
+    try:
+        km.start_kernel(cwd=cwd, stderr=err_write)
+    except Exception as e:
+        os.close(err_read)
+        raise RuntimeError(str(e))
+    finally:
+        os.close(err_write)
+    collector = _StderrCollector(err_read)
+    kc = km.client()
+    kc.start_channels()
+    try:
+        kc.wait_for_ready(timeout=startup_timeout)
+    except RuntimeError as e:
+        kc.stop_channels()
+        km.shutdown_kernel()
+        raise RuntimeError(f'{e}\nError Message:\n{collector.message()}')
+    return km, kc
+
+
+class WarmKernel(object):
+    '''A subkernel started by the kernel pool, with language for which the
+    initialization statements have been executed, and the working directory
+    the kernel was started with.'''
+    __slots__ = ('km', 'kc', 'language', 'cwd')
+
+    def __init__(self, km, kc, language, cwd):
+        self.km = km
+        self.kc = kc
+        self.language = language
+        self.cwd = cwd
+
+
+class SubkernelPool(object):
+    '''A pool that keeps a number of initialized subkernels for specified
+    kernels (kernelspec names) so that %use and %with can use them without
+    waiting for the kernels to start. Kernels are started in background threads
+    and the pool is refilled after a kernel is taken from it.'''
+    def __init__(self, startup_timeout=60):
+        self.startup_timeout = startup_timeout
+        # kernel_name -> number of kernels to keep
+        self._sizes = {}
+        # kernel_name -> (language, init_statements)
+        self._init = {}
+        self._ready = defaultdict(list)
+        self._starting = defaultdict(int)
+        # error message of the last failed start
+        self._errors = {}
+        # subkernel name -> Future of kernels started for specific subkernels
+        self._reserved = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def configure(self, kernel_name, size, language=None, init_statements=None):
+        with self._lock:
+            self._sizes[kernel_name] = size
+            self._init[kernel_name] = (language, init_statements)
+
+    def fill(self, kernel_name=None):
+        '''Start kernels in background until there are enough ready or starting
+        kernels for kernel_name (or all configured kernels).'''
+        cwd = os.getcwd()
+        with self._lock:
+            if self._closed:
+                return
+            for name in ([kernel_name] if kernel_name else list(self._sizes.keys())):
+                missing = self._sizes.get(name, 0) - len(self._ready[name]) - self._starting[name]
+                for _ in range(max(missing, 0)):
+                    self._starting[name] += 1
+                    thread = threading.Thread(target=self._start, args=(name, cwd))
+                    thread.daemon = True
+                    thread.start()
+
+    def _start_kernel(self, kernel_name, cwd, init_statements):
+        km, kc = start_subkernel(kernel_name, cwd=cwd, startup_timeout=self.startup_timeout)
+        if init_statements:
+            try:
+                run_silently(kc, init_statements, timeout=self.startup_timeout)
+            except Exception as e:
+                _shutdown(km, kc)
+                raise RuntimeError(f'Failed to execute initialization statements: {e}')
+        return km, kc
+
+    def _start(self, kernel_name, cwd):
+        language, init_statements = self._init.get(kernel_name, (None, None))
+        try:
+            km, kc = self._start_kernel(kernel_name, cwd, init_statements)
+        except Exception as e:
+            env.logger.debug(f'Failed to start kernel {kernel_name} in kernel pool: {e}')
+            with self._lock:
+                self._starting[kernel_name] -= 1
+                self._errors[kernel_name] = str(e)
+            return
+        with self._lock:
+            self._starting[kernel_name] -= 1
+            if self._closed:
+                shutdown = True
+            else:
+                shutdown = False
+                self._errors.pop(kernel_name, None)
+                self._ready[kernel_name].append(WarmKernel(km, kc, language, cwd))
+        if shutdown:
+            _shutdown(km, kc)
+
+    def acquire(self, kernel_name):
+        '''Return a started kernel for kernel_name started in the current working
+        directory, or None if no such kernel is ready, for example because the
+        pool failed to start the kernel.'''
+        cwd = os.getcwd()
+        acquired = None
+        stale = []
+        with self._lock:
+            if kernel_name not in self._sizes:
+                return None
+            while self._ready[kernel_name]:
+                warm = self._ready[kernel_name].pop(0)
+                if warm.cwd == cwd and warm.km.is_alive():
+                    acquired = warm
+                    break
+                stale.append(warm)
+            error = self._errors.pop(kernel_name, None)
+        for warm in stale:
+            _shutdown(warm.km, warm.kc)
+        self.fill(kernel_name)
+        if acquired is None and error is not None:
+            env.logger.warning(f'Failed to start kernel {kernel_name} in kernel pool: {error}')
+        return acquired
+
+    def reserve(self, name, kernel_name, language=None, init_statements=None, on_ready=None):
+        '''Start a kernel for subkernel name in a background thread, which can
+        be claimed by claim(name). on_ready(name, error) is called after the
+        kernel is started (error is None) or failed to start.'''
+        cwd = os.getcwd()
+        with self._lock:
+            if self._closed or name in self._reserved:
+                return
+            future = Future()
+            self._reserved[name] = future
+
+        def start():
+            try:
+                km, kc = self._start_kernel(kernel_name, cwd, init_statements)
+            except Exception as e:
+                future.set_exception(e)
+                if on_ready is not None:
+                    on_ready(name, str(e))
+                return
+            warm = WarmKernel(km, kc, language, cwd)
+            with self._lock:
+                closed = self._closed
+            if closed:
+                _shutdown(km, kc)
+                future.set_exception(RuntimeError('Kernel pool is closed'))
+                return
+            future.set_result(warm)
+            if on_ready is not None:
+                on_ready(name, None)
+
+        thread = threading.Thread(target=start)
+        thread.daemon = True
+        thread.start()
+
+    def claim(self, name, timeout=None):
+        '''Wait for and return the kernel reserved for subkernel name, or None
+        if no kernel has been reserved, if the kernel failed to start or did
+        not start within timeout seconds, or if the kernel was started in
+        another working directory.'''
+        with self._lock:
+            future = self._reserved.pop(name, None)
+        if future is None:
+            return None
+        try:
+            warm = future.result(timeout)
+        except Exception as e:
+            if not future.done():
+                # the kernel is no longer reachable from the pool and is shut
+                # down once it is started
+                future.add_done_callback(_shutdown_reserved)
+                e = f'No kernel after {timeout} seconds'
+            env.logger.warning(f'Failed to start kernel for {name} in background: {e}')
+            return None
+        if warm.cwd != os.getcwd() or not warm.km.is_alive():
+            _shutdown(warm.km, warm.kc)
+            return None
+        return warm
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            warm_kernels = sum(self._ready.values(), [])
+            self._ready.clear()
+            reserved = list(self._reserved.values())
+            self._reserved.clear()
+        for future in reserved:
+            if future.done() and future.exception() is None:
+                warm_kernels.append(future.result())
+        for warm in warm_kernels:
+            _shutdown(warm.km, warm.kc)
+
+
+def _shutdown(km, kc):
+    try:
+        kc.stop_channels()
+        km.shutdown_kernel(now=True)
+    except Exception as e:
+        env.logger.debug(f'Failed to shutdown kernel: {e}')
+
+
+def _shutdown_reserved(future):
+    if future.exception() is None:
+        _shutdown(future.result().km, future.result().kc)
+
+
+def shell_request(kc, msg_id, timeout):
+    '''Wait at most timeout seconds for the shell reply to request msg_id of a
+    kernel (client kc) and return its content, or None if the kernel does not
+    reply in time. Replies to other requests are discarded.'''
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        try:
+            reply = kc.get_shell_msg(timeout=remaining)
+        except queue.Empty:
+            return None
+        if reply['parent_header'].get('msg_id', None) == msg_id:
+            return reply['content']
+
+
+def run_silently(kc, code, timeout=60):
+    '''Execute code silently in a kernel (client kc) and wait for the reply.
+    A RuntimeError is raised if the code fails or if the kernel does not
+    reply within timeout seconds.'''
+    msg_id = kc.execute(code, silent=True, store_history=False)
+    reply = shell_request(kc, msg_id, timeout)
+    if reply is None:
+        raise RuntimeError(f'No reply after {timeout} seconds')
+    if reply.get('status', None) != 'ok':
+        raise RuntimeError(f'{reply.get("ename", "Error")}: {reply.get("evalue", "")}')
+    return reply
@@ -51,22 +51,49 @@ class Visualizer:
         if self.kernel:
             self.kernel.warn(msg)
 
-    def preview(self, df):
+    def preview(self, df, total_rows=None):
+        '''Preview data frame df, which can be the first records of a larger
+        data set with total_rows records. total_rows can also be a description
+        such as "about 10000".'''
         if self.style == 'table':
-            return self._handle_table(df)
+            return self._handle_table(df, total_rows)
         elif self.style == 'scatterplot':
-            return self._handle_scatterplot(df)
+            return self._handle_scatterplot(df, total_rows)
         else:
             raise ValueError(f'Unknown style {self.style}')
 
+    def get_limit(self):
+        '''Return the maximum number of records that will be previewed, or
+        None if all records will be previewed, so that callers can read only
+        the records that are needed.'''
+        parser = argparse.ArgumentParser(add_help=False)
+        parser.add_argument('-l', '--limit', type=int, default=200 if self.style == 'table' else 2000)
+        parser.error = lambda msg: None
+        try:
+            args, _ = parser.parse_known_args(self.options)
+        except SystemExit:
+            return None
+        return None if args.limit is None or args.limit < 0 else args.limit
+
+    def _total_rows(self, df, total_rows):
+        if total_rows is None:
+            return df.shape[0], f'the {df.shape[0]}'
+        elif isinstance(total_rows, str):
+            return float('inf'), total_rows
+        else:
+            return total_rows, f'the {total_rows}'
+
     def get_tid(self, vis_type):
         if not self.kernel:
             import random
             return random.randint(0, 1000000)
+        # ids start from a random number so that previews cached by earlier
+        # sessions do not share ids with new ones
+        import random
         if not hasattr(self.kernel, '_tid'):
-            self.kernel._tid = { vis_type: 1 }
+            self.kernel._tid = { vis_type: random.randint(1, 1000000) }
         elif vis_type not in self.kernel._tid:
-            self.kernel._tid[vis_type] = 1
+            self.kernel._tid[vis_type] = random.randint(1, 1000000)
         else:
             self.kernel._tid[vis_type] += 1
         return self.kernel._tid[vis_type]
@@ -91,7 +118,7 @@ class Visualizer:
             # this includes Pandas category type
             return False
 
-    def _handle_table(self, df):
+    def _handle_table(self, df, total_rows=None):
         parser = self._get_table_parser()
         try:
             args = parser.parse_args(self.options)
@@ -103,10 +130,11 @@ class Visualizer:
 
         tid = self.get_tid('table')
 
+        nrows, desc = self._total_rows(df, total_rows)
         # if the user already specified a value other than 200, we do not display the warning
-        if args.limit >= 0 and df.shape[0] > args.limit and args.limit == 200 and self.kernel:
+        if args.limit >= 0 and nrows > args.limit and args.limit == 200 and self.kernel:
                 self.kernel.warn(
-                    f"Only the first {args.limit} of the {df.shape[0]} records are previewed. Use option --limit to set a new limit.")
+                    f"Only the first {args.limit} of {desc} records are previewed. Use option --limit to set a new limit.")
         if args.limit >= 0:
             code = df.head(args.limit).to_html(index=True).replace('class="',
                                                                    f'id="dataframe_{tid}" class="sos_dataframe ', 1)
@@ -150,7 +178,7 @@ class Visualizer:
             sorted.''')
         parser.add_argument('-t', '--tooltip', nargs='*', help='''Fields to be shown in tooltip, in addition to
             the row index and point values that would be shown by default.''')
-        parser.add_argument('-l', '--limit', default=2000, help='''Maximum number
+        parser.add_argument('-l', '--limit', type=int, default=2000, help='''Maximum number
             of records to plot.''')
         parser.error = self._parse_error
         return parser
@@ -172,7 +200,7 @@ class Visualizer:
             return None
         return list(10**x for x in range(logl, logh + 1))
 
-    def _handle_scatterplot(self, df):
+    def _handle_scatterplot(self, df, total_rows=None):
         parser = self._get_scatterplot_parser()
         try:
             args = parser.parse_args(self.options)
@@ -184,9 +212,10 @@ class Visualizer:
 
         tid = str(self.get_tid('scatterplot'))
 
-        if df.shape[0] > args.limit and self.kernel:
+        nrows, desc = self._total_rows(df, total_rows)
+        if nrows > args.limit and self.kernel:
             self.kernel.warn(
-                f"Only the first {args.limit} of the {df.shape[0]} records are plotted. Use option --limit to set a new limit.")
+                f"Only the first {args.limit} of {desc} records are plotted. Use option --limit to set a new limit.")
 
         # replacing ' ' with &nbsp and '-' with unicode hyphen will disallow webpage to separate words
         # into lines
@@ -36,6 +36,7 @@ from sos.syntax import SOS_SECTION_HEADER
 from sos.targets import file_target, UnknownTarget, RemovedTarget, UnavailableLock
 from sos.step_executor import PendingTasks
 from .step_executor import Interactive_Step_Executor
+from .profiler import phase
 
 
 class Interactive_Executor(Base_Executor):
@@ -115,7 +116,8 @@ class Interactive_Executor(Base_Executor):
         # process step of the pipelinp
         if isinstance(targets, str):
             targets = [targets]
-        dag = self.initialize_dag(targets=targets)
+        with phase('dag'):
+            dag = self.initialize_dag(targets=targets)
         #
         # if targets are specified and there are only signatures for them, we need
         # to remove the signature and really generate them
@@ -329,30 +331,31 @@ def runfile(script=None, raw_args='', wdir='.', code=None, kernel=None, **kwargs
         env.sos_dict.pop(k, None)
 
     try:
-        if script is None:
-            if not code.strip():
-                return
-            if kernel is None:
-                script = SoS_Script(content=code)
-            else:
-                if kernel._workflow_mode:
-                    # in workflow mode, the content is sent by magics %run and %sosrun
+        with phase('parse'):
+            if script is None:
+                if not code.strip():
+                    return
+                if kernel is None:
                     script = SoS_Script(content=code)
                 else:
-                    # this is a scratch step...
-                    # if there is no section header, add a header so that the block
-                    # appears to be a SoS script with one section
-                    if not any([SOS_SECTION_HEADER.match(line) or line.startswith('%from') or line.startswith('%include') for line in code.splitlines()]):
-                        code = '[scratch_0]\n' + code
+                    if kernel._workflow_mode:
+                        # in workflow mode, the content is sent by magics %run and %sosrun
                         script = SoS_Script(content=code)
                     else:
-                        if kernel.cell_idx == -1:
-                            kernel.send_frontend_msg('stream',
-                                {'name': 'stdout', 'text': 'Workflow can only be executed with magic %run or %sosrun.'})
-                        return
-        else:
-            script = SoS_Script(filename=script)
-        workflow = script.workflow(args.workflow)
+                        # this is a scratch step...
+                        # if there is no section header, add a header so that the block
+                        # appears to be a SoS script with one section
+                        if not any([SOS_SECTION_HEADER.match(line) or line.startswith('%from') or line.startswith('%include') for line in code.splitlines()]):
+                            code = '[scratch_0]\n' + code
+                            script = SoS_Script(content=code)
+                        else:
+                            if kernel.cell_idx == -1:
+                                kernel.send_frontend_msg('stream',
+                                    {'name': 'stdout', 'text': 'Workflow can only be executed with magic %run or %sosrun.'})
+                            return
+            else:
+                script = SoS_Script(filename=script)
+            workflow = script.workflow(args.workflow)
         executor = Interactive_Executor(workflow, args=workflow_args, config={
             'config_file': args.__config__,
             'output_dag': args.__dag__,
@@ -374,7 +377,8 @@ def runfile(script=None, raw_args='', wdir='.', code=None, kernel=None, **kwargs
             'bin_dirs': args.__bin_dirs__,
             'workflow_args': workflow_args
         })
-        return executor.run(args.__targets__)
+        with phase('workflow'):
+            return executor.run(args.__targets__)
     except PendingTasks:
         raise
     except SystemExit:
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (SoS), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import array
+import collections
+import datetime
+import decimal
+import pathlib
+import unittest
+from sos_notebook.budget import PreviewBudget, Summary
+
+
+class HugeContainer(object):
+    '''A container whose repr should never be called'''
+    def __len__(self):
+        return 10 ** 9
+
+    def __repr__(self):
+        raise AssertionError('repr of HugeContainer is called')
+
+
+class LargeRepr(object):
+    '''An object with a large repr and no length, which counts calls of repr'''
+    calls = 0
+
+    def __repr__(self):
+        LargeRepr.calls += 1
+        return 'x' * 10000000
+
+
+class TestPreviewBudget(unittest.TestCase):
+    def testEstimate(self):
+        '''Test estimate of the length of repr of objects'''
+        budget = PreviewBudget(max_bytes=1000)
+        self.assertEqual(budget.estimate('abc'), 6)
+        self.assertLess(budget.estimate(list(range(10))), 100)
+        self.assertGreater(budget.estimate(list(range(10000))), 1000)
+        self.assertGreater(budget.estimate({x: 'a' * 100 for x in range(100)}), 1000)
+
+    def testEstimateOtherTypes(self):
+        '''Test that objects of other types are estimated without full repr'''
+        budget = PreviewBudget(max_bytes=1000)
+        self.assertGreater(budget.estimate(array.array('d', range(10000))), 1000)
+        self.assertGreater(budget.estimate(collections.deque(range(10000))), 1000)
+        self.assertGreater(budget.estimate(collections.deque(['a' * 10000])), 1000)
+        self.assertGreater(budget.estimate(HugeContainer()), 1000)
+        self.assertFalse(budget.fits(HugeContainer()))
+
+    def testUnknownTypes(self):
+        '''Test that objects of unknown types are summarized without calling repr'''
+        budget = PreviewBudget(max_bytes=1000)
+        LargeRepr.calls = 0
+        self.assertGreater(budget.estimate(LargeRepr()), 1000)
+        self.assertFalse(budget.fits(LargeRepr()))
+        summary = budget.limit(LargeRepr())
+        self.assertTrue(isinstance(summary, Summary))
+        self.assertTrue(repr(summary).startswith('LargeRepr\n<'), repr(summary))
+        summary = budget.limit([LargeRepr(), 1])
+        self.assertTrue(isinstance(summary, Summary))
+        self.assertLess(len(repr(summary)), 1000)
+        self.assertEqual(LargeRepr.calls, 0)
+        # objects of types with short reprs fit in the budget
+        for obj in (datetime.datetime.now(), decimal.Decimal('1.5'), pathlib.Path('a.txt'), range(10), None):
+            self.assertTrue(budget.fits(obj), obj)
+            self.assertIs(budget.limit(obj), obj)
+        # bytes are truncated in summaries
+        self.assertLess(len(repr(budget.limit(b'x' * 100000))), 1000)
+
+    def testLimit(self):
+        '''Test that large objects are replaced by their summaries'''
+        budget = PreviewBudget(max_bytes=1000)
+        self.assertEqual(budget.limit([1, 2, 3]), [1, 2, 3])
+        summary = repr(budget.limit(list(range(10000))))
+        self.assertTrue('list of length 10000' in summary, summary)
+
+    def testDpi(self):
+        '''Test resolution of rasterised pages within the budget'''
+        budget = PreviewBudget(max_bytes=100000)
+        # a letter size page
+        self.assertEqual(budget.dpi(8.5, 11), 103)
+        # more pages are rasterised at lower resolution, down to min_dpi
+        self.assertLess(budget.dpi(8.5, 11, pages=2), budget.dpi(8.5, 11))
+        self.assertEqual(budget.dpi(8.5, 11, pages=100), 72)
+        self.assertEqual(budget.dpi(8.5, 11, pages=100, min_dpi=10), 10)
+        # small or empty pages are rasterised at max_dpi
+        self.assertEqual(budget.dpi(1, 1), 150)
+        self.assertEqual(budget.dpi(0, 0), 150)
+        self.assertEqual(budget.dpi(1, 1, max_dpi=300), 300)
+
+
+if __name__ == '__main__':
+    unittest.main()
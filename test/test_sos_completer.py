@@ -67,5 +67,34 @@ class TestKernel(unittest.TestCase):
             execute(kc=kc, code='%use SoS')
             wait_for_idle(kc)
 
+    def testCompleteChangedVariables(self):
+        with sos_kernel() as kc:
+            execute(kc=kc, code='beta_value = 5')
+            wait_for_idle(kc)
+            self.assertTrue('beta_value' in get_completions(kc, 'beta_')['matches'])
+            self.assertTrue('beta_value' in get_completions(kc, '%get beta')['matches'])
+            execute(kc=kc, code='del beta_value')
+            wait_for_idle(kc)
+            self.assertEqual(len(get_completions(kc, 'beta_')['matches']), 0)
+            self.assertEqual(len(get_completions(kc, '%get beta')['matches']), 0)
+
+    def testSubkernelCompleter(self):
+        with sos_kernel() as kc:
+            execute(kc=kc, code='%use Python3')
+            wait_for_idle(kc)
+            execute(kc=kc, code='zeta_in_python = 5')
+            wait_for_idle(kc)
+            # names of the subkernel are completed by the subkernel
+            self.assertTrue('zeta_in_python' in get_completions(kc, 'zeta_')['matches'])
+            # repeated request, served from cache
+            self.assertTrue('zeta_in_python' in get_completions(kc, 'zeta_')['matches'])
+            # leading magics are not sent to the subkernel
+            self.assertTrue('zeta_in_python' in get_completions(kc, '%expand\nzeta_')['matches'])
+            # magics are still completed by SoS
+            self.assertTrue('%get ' in get_completions(kc, '%g')['matches'])
+            wait_for_idle(kc)
+            execute(kc=kc, code='%use SoS')
+            wait_for_idle(kc)
+
 if __name__ == '__main__':
     unittest.main()
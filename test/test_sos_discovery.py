@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (SoS), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+from sos_notebook import discovery
+
+
+class TestDiscoveryCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        # a directory on sys.path with an installed distribution
+        self.site_dir = os.path.join(self.temp_dir, 'site-packages')
+        self.dist_dir = os.path.join(self.site_dir, 'mypkg-1.0.dist-info')
+        os.makedirs(self.dist_dir)
+        self.write_entry_points('[sos_languages]\nR = sos_r.kernel:sos_R\n')
+        # the working directory of the kernel and another directory on sys.path
+        self.work_dir = os.path.join(self.temp_dir, 'notebooks')
+        self.src_dir = os.path.join(self.temp_dir, 'src')
+        os.makedirs(self.work_dir)
+        os.makedirs(self.src_dir)
+        self.olddir = os.getcwd()
+        os.chdir(self.work_dir)
+        self.scans = 0
+        self.patches = [
+            mock.patch.object(discovery, 'CACHE_FILE', os.path.join(self.temp_dir, 'cache.json')),
+            mock.patch.object(discovery, '_discovered', None),
+            mock.patch.object(discovery, '_kernel_dirs', lambda: []),
+            mock.patch.object(discovery, '_scan_entry_points', self.scan_entry_points),
+            mock.patch.object(discovery, '_scan_kernel_specs', lambda: {'ir': '/path/to/ir'}),
+            mock.patch.object(sys, 'path', [self.work_dir, self.site_dir, self.src_dir]),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        os.chdir(self.olddir)
+        shutil.rmtree(self.temp_dir)
+
+    def write_entry_points(self, content):
+        with open(os.path.join(self.dist_dir, 'entry_points.txt'), 'w') as ep:
+            ep.write(content)
+
+    def scan_entry_points(self):
+        self.scans += 1
+        return {'sos_languages': [['R', 'sos_r.kernel:sos_R']]}
+
+    def discover(self, refresh=False):
+        # discovery in a new kernel, which does not have the result in memory
+        discovery._discovered = None
+        return discovery.get_discovered(refresh)
+
+    def testCacheHit(self):
+        '''Test that a saved discovery is reused by a new kernel'''
+        data = self.discover()
+        self.assertEqual(self.scans, 1)
+        self.assertEqual(data['kernelspecs'], {'ir': '/path/to/ir'})
+        self.assertTrue(os.path.isfile(discovery.CACHE_FILE))
+        self.assertEqual(self.discover()['entry_points'], data['entry_points'])
+        self.assertEqual(self.scans, 1)
+        self.assertEqual([x.name for x in discovery.iter_entry_points('sos_languages')], ['R'])
+        # refresh
+        self.discover(refresh=True)
+        self.assertEqual(self.scans, 2)
+
+    def testNewDistribution(self):
+        '''Test that installing a distribution invalidates the cache'''
+        self.discover()
+        # make sure that the mtime of the directory changes
+        time.sleep(0.01)
+        os.makedirs(os.path.join(self.site_dir, 'otherpkg-1.0.dist-info'))
+        os.utime(self.site_dir, (time.time() + 10, time.time() + 10))
+        self.discover()
+        self.assertEqual(self.scans, 2)
+
+    def testReinstalledDistribution(self):
+        '''Test that rewriting entry_points.txt in place invalidates the cache'''
+        self.discover()
+        site_mtime = os.stat(self.site_dir).st_mtime
+        self.write_entry_points('[sos_languages]\nR = sos_r.kernel:sos_R\nJulia = sos_julia.kernel:sos_Julia\n')
+        ep_file = os.path.join(self.dist_dir, 'entry_points.txt')
+        os.utime(ep_file, (time.time() + 10, time.time() + 10))
+        self.assertEqual(os.stat(self.site_dir).st_mtime, site_mtime)
+        self.discover()
+        self.assertEqual(self.scans, 2)
+
+    def testOtherDirectories(self):
+        '''Test that changes to the working and other directories keep the cache'''
+        self.discover()
+        for directory in (self.work_dir, self.src_dir):
+            with open(os.path.join(directory, 'a.py'), 'w') as f:
+                f.write('a = 1\n')
+            os.utime(directory, (time.time() + 10, time.time() + 10))
+        self.discover()
+        self.assertEqual(self.scans, 1)
+        # the cache is shared by kernels in different directories
+        os.chdir(self.src_dir)
+        self.discover()
+        self.assertEqual(self.scans, 1)
+        # the working directory is excluded even if it has distributions
+        os.chdir(self.work_dir)
+        os.makedirs(os.path.join(self.work_dir, 'otherpkg-1.0.dist-info'))
+        self.discover()
+        self.assertEqual(self.scans, 1)
+
+    def testCorruptedCache(self):
+        '''Test that a corrupted cache is rescanned'''
+        self.discover()
+        with open(discovery.CACHE_FILE, 'w') as cache:
+            cache.write('{')
+        self.discover()
+        self.assertEqual(self.scans, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
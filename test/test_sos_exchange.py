@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (SoS), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+from sos_notebook.exchange import SharedVariableTracker
+
+
+class TestSharedVariableTracker(unittest.TestCase):
+    def testChanged(self):
+        '''Test that only changed variables are sent again'''
+        tracker = SharedVariableTracker()
+        changed, fingerprints = tracker.changed('R', {'sos_a': 1, 'sos_b': [1, 2]})
+        self.assertEqual(sorted(changed), ['sos_a', 'sos_b'])
+        tracker.record('R', fingerprints)
+        self.assertEqual(tracker.changed('R', {'sos_a': 1, 'sos_b': [1, 2, 3]})[0], ['sos_b'])
+        # variables are tracked per kernel
+        self.assertEqual(tracker.changed('Python3', {'sos_a': 1})[0], ['sos_a'])
+        # values that cannot be fingerprinted are always sent
+        self.assertEqual(tracker.changed('R', {'sos_c': lambda x: x})[0], ['sos_c'])
+
+    def testRetain(self):
+        '''Test that variables removed from the subkernel are sent again'''
+        tracker = SharedVariableTracker()
+        tracker.record('R', tracker.changed('R', {'sos_a': 1, 'sos_b': 2})[1])
+        tracker.record('Python3', tracker.changed('Python3', {'sos_a': 1})[1])
+        tracker.retain('R', {'sos_b'})
+        self.assertEqual(tracker.changed('R', {'sos_a': 1, 'sos_b': 2})[0], ['sos_a'])
+        self.assertEqual(tracker.changed('Python3', {'sos_a': 1})[0], [])
+        tracker.forget('Python3')
+        self.assertEqual(tracker.changed('Python3', {'sos_a': 1})[0], ['sos_a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
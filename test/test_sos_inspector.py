@@ -24,9 +24,9 @@ import unittest
 from ipykernel.tests.utils import execute, wait_for_idle
 from sos_notebook.test_utils import sos_kernel, flush_channels
 
-def inspect(kc, name, pos=0):
+def inspect(kc, name, pos=0, detail_level=0):
     flush_channels()
-    kc.inspect(name, pos)
+    kc.inspect(name, pos, detail_level)
     reply = kc.get_shell_msg(timeout=2)
     return reply['content']
 
@@ -71,6 +71,22 @@ class TestSoSCompleter(unittest.TestCase):
             execute(kc=kc, code='%use SoS')
             wait_for_idle(kc)
 
+    def testInspectDetail(self):
+        with sos_kernel() as kc:
+            # documentation in HTML is only rendered for detailed inspection
+            ins_run = inspect(kc, 'run:')['data']
+            self.assertTrue('sos.actions' in ins_run['text/plain'], 'Returned: {}'.format(ins_run))
+            self.assertFalse('text/html' in ins_run)
+            ins_run = inspect(kc, 'run:', detail_level=1)['data']
+            self.assertTrue('text/html' in ins_run)
+            # cached preview is refreshed after the variable is changed
+            execute(kc=kc, code='beta=5')
+            wait_for_idle(kc)
+            self.assertTrue('5' in inspect(kc, 'beta')['data']['text/plain'])
+            execute(kc=kc, code='beta=7')
+            wait_for_idle(kc)
+            self.assertTrue('7' in inspect(kc, 'beta')['data']['text/plain'])
+
     def testIsComplete(self):
         with sos_kernel() as kc:
             # match magics
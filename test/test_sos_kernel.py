@@ -65,6 +65,49 @@ class TestSoSKernel(unittest.TestCase):
             for key in ('run', 'expand_pattern'):
                 self.assertTrue(key in res)
 
+    def testMagicDictLargeVariable(self):
+        '''Test summary of variables that are too large to display'''
+        with sos_kernel() as kc:
+            iopub = kc.iopub_channel
+            execute(kc=kc, code="big = list(range(10000000))\nsmall = 5")
+            wait_for_idle(kc)
+            execute(kc=kc, code="%dict big small")
+            res = get_display_data(iopub)
+            self.assertTrue('list of length 10000000' in res, 'Got {}'.format(res))
+            self.assertTrue("'small': 5" in res, 'Got {}'.format(res))
+
+    def testSubkernelOutputRelay(self):
+        '''Test that output of a busy subkernel is relayed in order'''
+        with sos_kernel() as kc:
+            iopub = kc.iopub_channel
+            execute(kc=kc, code="%use Python3")
+            wait_for_idle(kc)
+            execute(kc=kc, code='''
+import time
+for i in range(5):
+    print(i, flush=True)
+    time.sleep(0.5)
+''')
+            stdout, stderr = get_std_output(iopub)
+            self.assertEqual(stdout.split(), ['0', '1', '2', '3', '4'], 'Got {}'.format(stderr))
+            # the subkernel can be used after the busy cell
+            execute(kc=kc, code="print('done')")
+            stdout, _ = get_std_output(iopub)
+            self.assertEqual(stdout.strip(), 'done')
+            execute(kc=kc, code="%use SoS")
+            wait_for_idle(kc)
+
+    def testLazyImports(self):
+        '''Test that modules preloaded after start are not imported with the kernel'''
+        import subprocess
+        from sos_notebook.kernel import SoS_Kernel
+        loaded = subprocess.check_output([sys.executable, '-c',
+            'import sys, sos_notebook.kernel; print(" ".join(sys.modules))']).decode().split()
+        for module in SoS_Kernel.PRELOAD_MODULES:
+            self.assertFalse(module in loaded, f'{module} is imported with the kernel')
+        for module in ('sos_notebook.preview', 'sos_notebook.visualize'):
+            self.assertFalse(module in loaded, f'{module} is imported with the kernel')
+
     def testShell(self):
         with sos_kernel() as kc:
             iopub = kc.iopub_channel
@@ -33,7 +33,7 @@ class TestSoSMagics(unittest.TestCase):
             # create a data frame
             execute(kc=kc, code='\n'.join('%{} -h'.format(magic) for magic in (
                 'cd', 'debug', 'dict', 'get', 'matplotlib', 'paste', 'preview',
-                'put', 'render', 'rerun', 'run', 'save', 'sandbox', 'set',
+                'profile', 'put', 'render', 'rerun', 'run', 'save', 'sandbox', 'set',
                 'sessioninfo', 'sosrun', 'sossave', 'shutdown', 'taskinfo', 'tasks',
                 'toc', 'use', 'with', 'pull', 'push')))
             wait_for_idle(kc)
@@ -221,6 +221,41 @@ graph graphname {
             res = get_display_data(iopub, 'image/png')
             self.assertGreater(len(res), 1000, 'Expect a image {}'.format(res))
 
+    def testMagicPreviewLargeTSV(self):
+        with sos_kernel() as kc:
+            iopub = kc.iopub_channel
+            # only the first records are read, the rest are counted
+            execute(kc=kc, code='''
+%preview -n a.tsv.gz
+import gzip
+with gzip.open('a.tsv.gz', 'wt') as tsv:
+    tsv.write('a\\tb\\n')
+    for i in range(1000):
+        tsv.write(f'{i}\\t{i}\\n')
+''')
+            _, stderr = get_std_output(iopub)
+            self.assertTrue('of 1000 records' in stderr, 'Expect record count {}'.format(stderr))
+            # cached preview is displayed with the same warning
+            execute(kc=kc, code='%preview -n a.tsv.gz')
+            _, stderr = get_std_output(iopub)
+            self.assertTrue('of 1000 records' in stderr, 'Expect record count {}'.format(stderr))
+
+    def testMagicPreviewVCF(self):
+        with sos_kernel() as kc:
+            iopub = kc.iopub_channel
+            execute(kc=kc, code='''
+%preview -n a.vcf.gz --count
+import gzip
+with gzip.open('a.vcf.gz', 'wt') as vcf:
+    vcf.write('##fileformat=VCFv4.2\\n')
+    vcf.write('#CHROM\\tPOS\\tID\\tREF\\tALT\\tQUAL\\tFILTER\\tINFO\\n')
+    for i in range(100):
+        vcf.write(f'1\\t{i + 1}\\t.\\tA\\tG\\t50\\tPASS\\t.\\n')
+''')
+            stdout, stderr = get_std_output(iopub)
+            self.assertEqual(stderr, '')
+            self.assertTrue('VCFv4.2' in stdout and '100 records' in stdout, 'Expect preview {}'.format(stdout))
+
     def testMagicSet(self):
         # test preview of remote file
         with sos_kernel() as kc:
@@ -297,5 +332,60 @@ with open('test_blah.txt', 'w') as tb:
 ''')
             wait_for_idle(kc)
 
+    def testMagicGetFromSubkernel(self):
+        '''Test passing variables between two subkernels'''
+        with sos_kernel() as kc:
+            iopub = kc.iopub_channel
+            execute(kc=kc, code='%use Python3\nfrom_py = 100')
+            wait_for_idle(kc)
+            execute(kc=kc, code='%use py2 -k python3 -l Python3\n%get from_py --from Python3\nprint(from_py)')
+            stdout, _ = get_std_output(iopub)
+            self.assertEqual(stdout.strip(), '100', f'Got {stdout}')
+            execute(kc=kc, code='to_py = 200')
+            wait_for_idle(kc)
+            execute(kc=kc, code='%put to_py --to Python3')
+            wait_for_idle(kc)
+            execute(kc=kc, code='%use Python3\nprint(to_py)')
+            stdout, _ = get_std_output(iopub)
+            self.assertEqual(stdout.strip(), '200', f'Got {stdout}')
+            execute(kc=kc, code='%use SoS')
+            wait_for_idle(kc)
+
+    def testMagicUseSharedVariables(self):
+        '''Test resending of shared variables that were removed from the subkernel'''
+        with sos_kernel() as kc:
+            iopub = kc.iopub_channel
+            execute(kc=kc, code='sos_shared = 10')
+            wait_for_idle(kc)
+            execute(kc=kc, code='%use Python3\ndel sos_shared')
+            wait_for_idle(kc)
+            execute(kc=kc, code='%use SoS')
+            wait_for_idle(kc)
+            execute(kc=kc, code='%use Python3\nprint(sos_shared)')
+            stdout, _ = get_std_output(iopub)
+            self.assertEqual(stdout.strip(), '10', f'Got {stdout}')
+            execute(kc=kc, code='%use SoS')
+            wait_for_idle(kc)
+            # unchanged shared variables can be resent with option --force
+            execute(kc=kc, code='%use Python3 --force\nprint(sos_shared)')
+            stdout, _ = get_std_output(iopub)
+            self.assertEqual(stdout.strip(), '10', f'Got {stdout}')
+            execute(kc=kc, code='%use SoS')
+            wait_for_idle(kc)
+
+    def testMagicProfile(self):
+        with sos_kernel() as kc:
+            iopub = kc.iopub_channel
+            execute(kc=kc, code='%profile on')
+            wait_for_idle(kc)
+            execute(kc=kc, code='a = 1')
+            wait_for_idle(kc)
+            execute(kc=kc, code='%profile')
+            stdout, _ = get_std_output(iopub)
+            self.assertTrue('Profile of cell' in stdout and 'workflow' in stdout, f'Got {stdout}')
+            execute(kc=kc, code='%profile off\n%profile --all')
+            stdout, _ = get_std_output(iopub)
+            self.assertTrue('Profile of 2 cells' in stdout, f'Got {stdout}')
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (SoS), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+from sos.utils import WorkflowDict
+from sos_notebook.namespace import NameIndex, NamespaceSync, TrackedWorkflowDict
+
+
+class MockShell(object):
+    def __init__(self):
+        self.user_ns = {}
+
+
+class TestNameIndex(unittest.TestCase):
+    def testPrefix(self):
+        '''Test prefix search of names'''
+        index = NameIndex(['sos_b', 'a', 'sos_a', 'sos', 'so', 'b\U0010ffff', 'b\U0010ffffa'])
+        self.assertEqual(index.prefix('sos'), ['sos', 'sos_a', 'sos_b'])
+        self.assertEqual(index.prefix('sos_'), ['sos_a', 'sos_b'])
+        self.assertEqual(index.prefix('so'), ['so', 'sos', 'sos_a', 'sos_b'])
+        self.assertEqual(index.prefix('c'), [])
+        self.assertEqual(index.prefix(''), list(index))
+        self.assertEqual(index.prefix('b\U0010ffff'), ['b\U0010ffff', 'b\U0010ffffa'])
+
+    def testUpdate(self):
+        '''Test adding and removing names'''
+        index = NameIndex(['b', 'd'])
+        index.update(added=['c', 'a', 'b'], removed=['d', 'e'])
+        self.assertEqual(list(index), ['a', 'b', 'c'])
+        # many changes
+        index.update(added=[f'x{i}' for i in range(200)], removed=['a'])
+        self.assertEqual(len(index), 202)
+        self.assertEqual(index.prefix('x19'), sorted(['x19'] + [f'x19{i}' for i in range(10)]))
+        index.reset(['z'])
+        self.assertEqual(list(index), ['z'])
+
+
+class TestNamespaceSync(unittest.TestCase):
+    def setUp(self):
+        self.shell = MockShell()
+        self.sync = NamespaceSync(self.shell)
+        self.sos_dict = TrackedWorkflowDict({'a': 1, 'b': 2})
+        self.sync.sync(self.sos_dict)
+
+    def testFullSync(self):
+        '''Test that the dictionary is copied on the first synchronization'''
+        self.assertEqual(self.shell.user_ns, {'a': 1, 'b': 2})
+        self.assertEqual(list(self.sync.names), ['a', 'b'])
+        self.assertEqual(self.sync.generation, 1)
+
+    def testTrackedChanges(self):
+        '''Test that keys set or popped through the dictionary are synchronized'''
+        self.sos_dict.set('c', 3)
+        self.sos_dict['a'] = 10
+        self.sos_dict.update({'d': 4})
+        self.sos_dict.quick_update({'e': 5})
+        self.sos_dict.pop('b')
+        self.assertEqual(self.sos_dict.changed, {'a', 'b', 'c', 'd', 'e'})
+        # values that are not tracked are not pushed
+        self.sos_dict._dict['untracked'] = 0
+        self.sync.sync(self.sos_dict)
+        self.assertEqual(self.shell.user_ns, {'a': 10, 'c': 3, 'd': 4, 'e': 5})
+        self.assertEqual(list(self.sync.names), ['a', 'c', 'd', 'e'])
+        self.assertEqual(self.sos_dict.changed, set())
+        self.assertEqual(self.sync.generation, 2)
+
+    def testExecutedCode(self):
+        '''Test that names in code executed in the dictionary are synchronized'''
+        code = 'c = a + 1\ndel b'
+        self.sync.add_code(code)
+        exec(code, self.sos_dict._dict)
+        self.sync.sync(self.sos_dict)
+        self.assertEqual(self.shell.user_ns, {'a': 1, 'c': 2})
+        self.assertEqual(list(self.sync.names), ['a', 'c'])
+        # deletion from user_ns of a key that is not in the dictionary
+        self.sync.add_code('del c')
+        del self.sos_dict._dict['c']
+        self.sync.sync(self.sos_dict)
+        self.assertEqual(self.shell.user_ns, {'a': 1})
+        self.assertEqual(list(self.sync.names), ['a'])
+
+    def testDynamicBinding(self):
+        '''Test that code that binds names dynamically synchronizes the whole dictionary'''
+        for code in ('globals()["c"] = 3', 'exec("c = 3")', 'from os.path import *', 'sos_run("a")'):
+            self.sync.add_code(code)
+            self.sos_dict._dict['c'] = 3
+            self.sync.sync(self.sos_dict)
+            self.assertEqual(self.shell.user_ns['c'], 3, code)
+            del self.sos_dict._dict['c']
+            self.sync.invalidate()
+            self.sync.sync(self.sos_dict)
+            self.assertFalse('c' in self.shell.user_ns, code)
+        # names that only contain these words are tracked
+        self.sync.add_code('my_globals = 1')
+        self.sos_dict._dict['d'] = 4
+        self.sync.sync(self.sos_dict)
+        self.assertFalse('d' in self.shell.user_ns)
+
+    def testReplacedDict(self):
+        '''Test that variables of a replaced dictionary are removed'''
+        self.shell.user_ns['In'] = []
+        sos_dict = TrackedWorkflowDict({'a': 100, 'c': 3})
+        self.sync.sync(sos_dict)
+        self.assertEqual(self.shell.user_ns, {'In': [], 'a': 100, 'c': 3})
+        self.assertEqual(list(self.sync.names), ['a', 'c'])
+        # dictionaries that do not track changes are always copied
+        sos_dict = WorkflowDict({'d': 4})
+        self.sync.sync(sos_dict)
+        sos_dict.set('e', 5)
+        self.sync.sync(sos_dict)
+        self.assertEqual(self.shell.user_ns, {'In': [], 'd': 4, 'e': 5})
+
+
+if __name__ == '__main__':
+    unittest.main()
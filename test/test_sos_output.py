@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (SoS), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from sos_notebook.output import BoundedStream, StreamCoalescer
+
+
+class MockKernel(object):
+    '''Record messages sent by send_response'''
+    iopub_socket = None
+
+    def __init__(self):
+        self.messages = []
+
+    def send_response(self, socket, msg_type, content):
+        self.messages.append((msg_type, content))
+
+
+class TestStreamCoalescer(unittest.TestCase):
+    def testMergeMessages(self):
+        '''Test that consecutive messages are merged'''
+        kernel = MockKernel()
+        coalescer = StreamCoalescer(kernel, window=10)
+        for i in range(100):
+            coalescer.write('stdout', f'{i}\n')
+        self.assertEqual(kernel.messages, [])
+        coalescer.flush()
+        self.assertEqual(kernel.messages, [('stream',
+            {'name': 'stdout', 'text': ''.join(f'{i}\n' for i in range(100))})])
+        self.assertEqual((coalescer.messages_in, coalescer.messages_out), (100, 1))
+
+    def testKeepOrder(self):
+        '''Test that stdout and stderr are sent in order'''
+        kernel = MockKernel()
+        coalescer = StreamCoalescer(kernel, window=10)
+        coalescer.write('stdout', 'a')
+        coalescer.write('stdout', 'b')
+        coalescer.write('stderr', 'c')
+        coalescer.write('stdout', 'd')
+        coalescer.flush()
+        self.assertEqual([x[1] for x in kernel.messages], [
+            {'name': 'stdout', 'text': 'ab'},
+            {'name': 'stderr', 'text': 'c'},
+            {'name': 'stdout', 'text': 'd'}])
+
+    def testMaxSize(self):
+        '''Test that pending output is sent once it reaches max_size'''
+        kernel = MockKernel()
+        coalescer = StreamCoalescer(kernel, window=10, max_size=10)
+        coalescer.write('stdout', 'a' * 6)
+        self.assertEqual(kernel.messages, [])
+        coalescer.write('stdout', 'b' * 6)
+        self.assertEqual(len(kernel.messages), 1)
+        coalescer.flush()
+
+    def testWindow(self):
+        '''Test that pending output is sent after window seconds'''
+        kernel = MockKernel()
+        coalescer = StreamCoalescer(kernel, window=0.05)
+        coalescer.write('stdout', 'a')
+        time.sleep(0.5)
+        self.assertEqual(kernel.messages, [('stream', {'name': 'stdout', 'text': 'a'})])
+        # no window
+        kernel = MockKernel()
+        coalescer = StreamCoalescer(kernel, window=0)
+        coalescer.write('stdout', 'a')
+        coalescer.write('stdout', 'b')
+        self.assertEqual(len(kernel.messages), 2)
+
+
+class TestBoundedStream(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.notices = []
+
+    def bounded_stream(self, **kwargs):
+        return BoundedStream(lambda name, text: self.sent.append((name, text)),
+            lambda *args: self.notices.append(args), **kwargs)
+
+    def testHeadAndTail(self):
+        '''Test that head and tail lines are sent and the rest counted'''
+        stream = self.bounded_stream(head=3, tail=2)
+        stream.write('stdout', ''.join(f'{i}\n' for i in range(10)))
+        stream.close()
+        self.assertEqual(''.join(x[1] for x in self.sent), '0\n1\n2\n8\n9\n')
+        self.assertEqual(self.notices, [(5, 10, None)])
+
+    def testShortOutput(self):
+        '''Test that output within head is not truncated'''
+        stream = self.bounded_stream(head=3, tail=2)
+        stream.write('stdout', 'a\nb')
+        stream.write('stderr', 'c\n')
+        stream.close()
+        self.assertEqual(self.sent, [('stdout', 'a\nb'), ('stderr', 'c\n')])
+        self.assertEqual(self.notices, [])
+
+    def testProgressOutput(self):
+        '''Test that output updated by \\r is counted as lines'''
+        stream = self.bounded_stream(head=3, tail=1)
+        for i in range(100):
+            stream.write('stdout', f'{i}%\r')
+        stream.close()
+        self.assertEqual(''.join(x[1] for x in self.sent), '0%\r1%\r2%\r99%\r')
+        self.assertEqual(self.notices[0][0], 96)
+
+    def testHeadBytes(self):
+        '''Test that output without newline is limited by head_bytes'''
+        stream = self.bounded_stream(head=3, tail=1, head_bytes=10, max_line=5)
+        for i in range(100):
+            stream.write('stdout', '.')
+        stream.close()
+        self.assertEqual(''.join(x[1] for x in self.sent), '.' * 15)
+        self.assertEqual(self.notices, [(0, 85, None)])
+
+    def testSpill(self):
+        '''Test that the complete output is saved to spill_file'''
+        temp_dir = tempfile.mkdtemp()
+        try:
+            spill_file = os.path.join(temp_dir, '.sos', 'output.log')
+            stream = self.bounded_stream(head=3, tail=2, spill_file=spill_file)
+            text = ''.join(f'{i}\n' for i in range(10))
+            for line in text.splitlines(True):
+                stream.write('stdout', line)
+            stream.close()
+            with open(spill_file) as spill:
+                self.assertEqual(spill.read(), text)
+            self.assertEqual(self.notices, [(5, 10, spill_file)])
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (SoS), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import bz2
+import fnmatch
+import gzip
+import os
+import shutil
+import struct
+import tarfile
+import tempfile
+import unittest
+import zipfile
+import zlib
+from unittest import mock
+from sos_notebook import preview
+from sos_notebook.cache import DiskCache
+from sos_notebook.preview import (PreviewerDispatcher, _read_xls, _read_xlsx, count_lines,
+    get_previewers, index_record_count, make_thumbnail, pdf_page_info, preview_bed, preview_xls,
+    rasterize_pdf_pages)
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+try:
+    import xlrd
+    import xlwt
+except ImportError:
+    xlrd = xlwt = None
+
+try:
+    from wand.image import Image
+    # wand raises ImportError if ImageMagick is not installed
+    Image(width=1, height=1).close()
+except Exception:
+    Image = None
+
+
+class EntryPoint(object):
+    '''An entry point of a previewer, which loads to its name'''
+    def __init__(self, name):
+        self.name = name
+        self.loaded = 0
+
+    def load(self):
+        self.loaded += 1
+        return self.name
+
+    def __repr__(self):
+        return self.name
+
+
+def find_previewer(previewers, filename):
+    '''Find previewer of filename as the kernel did before PreviewerDispatcher'''
+    for x, y, _ in previewers:
+        if isinstance(x, str):
+            if fnmatch.fnmatch(os.path.basename(filename), x):
+                return y.load()
+        else:
+            try:
+                if x(filename):
+                    return y.load()
+            except Exception:
+                continue
+    return None
+
+
+class TestPreviewerDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.entrypoints = [EntryPoint(x) for x in (
+            '*.csv,1', '*.CSV,2', '*.txt,1', '*.gz,1', '*.tsv.gz,2', 'test_?.txt,3',
+            '*.xlsx,2', '*.[ct]sv,0', 'zipfile:is_zipfile,0', 'tarfile:is_tarfile,1',
+            'os.path:islink,2', '*,-1')]
+        self.patch = mock.patch.object(preview, 'iter_entry_points', lambda group: self.entrypoints)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        shutil.rmtree(self.temp_dir)
+
+    def create_files(self):
+        filenames = []
+        for name in ('a.csv', 'a.CSV', 'a.tsv', 'a.txt', 'test_1.txt', 'test_10.txt',
+            'a.tsv.gz', 'a.gz', 'README', 'a.bin'):
+            filenames.append(os.path.join(self.temp_dir, name))
+            with open(filenames[-1], 'w') as f:
+                f.write('some text\n')
+        # zip files, with or without extension
+        for name in ('a.xlsx', 'a.zip', 'archive'):
+            filenames.append(os.path.join(self.temp_dir, name))
+            with zipfile.ZipFile(filenames[-1], 'w') as zf:
+                zf.writestr('a.txt', 'some text')
+        filenames.append(os.path.join(self.temp_dir, 'a.tar'))
+        with tarfile.open(filenames[-1], 'w') as tf:
+            tf.add(filenames[0], arcname='a.csv')
+        return filenames
+
+    def testPriority(self):
+        '''Test that previewers are found as the kernel found them by fnmatch'''
+        previewers = get_previewers()
+        dispatcher = PreviewerDispatcher(previewers)
+        for filename in self.create_files():
+            self.assertEqual(dispatcher.find(filename), find_previewer(previewers, filename),
+                f'Previewer of {filename}')
+        for entrypoint in self.entrypoints:
+            entrypoint.loaded = 0
+        self.assertEqual(dispatcher.find(os.path.join(self.temp_dir, 'test_1.txt')), 'test_?.txt,3')
+        self.assertEqual(dispatcher.find(os.path.join(self.temp_dir, 'a.tsv.gz')), '*.tsv.gz,2')
+        self.assertEqual(dispatcher.find(os.path.join(self.temp_dir, 'a.xlsx')), '*.xlsx,2')
+        self.assertEqual(dispatcher.find(os.path.join(self.temp_dir, 'archive')), 'zipfile:is_zipfile,0')
+        self.assertEqual(dispatcher.find(os.path.join(self.temp_dir, 'a.tar')), 'tarfile:is_tarfile,1')
+        self.assertEqual(dispatcher.find(os.path.join(self.temp_dir, 'a.bin')), '*,-1')
+        self.assertEqual(dispatcher.find(os.path.join(self.temp_dir, 'a.bin')), '*,-1')
+        # previewers loaded by earlier calls are not loaded again
+        self.assertEqual(sum(x.loaded for x in self.entrypoints), 0)
+
+    def testNoFallback(self):
+        '''Test that None is returned if no previewer matches'''
+        self.entrypoints = [x for x in self.entrypoints if not x.name.startswith('*,')]
+        previewers = get_previewers()
+        dispatcher = PreviewerDispatcher(previewers)
+        for filename in self.create_files():
+            self.assertEqual(dispatcher.find(filename), find_previewer(previewers, filename),
+                f'Previewer of {filename}')
+        self.assertEqual(dispatcher.find(os.path.join(self.temp_dir, 'a.bin')), None)
+        self.assertEqual(PreviewerDispatcher([]).find(os.path.join(self.temp_dir, 'a.bin')), None)
+
+    def testDetectorErrors(self):
+        '''Test that errors of detectors and previewers are reported'''
+        def detector(filename):
+            raise ValueError('failed to detect')
+        failed = EntryPoint('failed')
+        failed.load = lambda: 1 / 0
+        errors = []
+        dispatcher = PreviewerDispatcher([(detector, EntryPoint('detector'), 2),
+            (os.path.isfile, failed, 1), (os.path.isfile, EntryPoint('isfile'), 0)])
+        filename = self.create_files()[0]
+        self.assertEqual(dispatcher.find(filename, on_error=errors.append), 'isfile')
+        self.assertEqual(len(errors), 2)
+        self.assertTrue('failed to detect' in errors[0], errors)
+        self.assertTrue('Failed to load previewer failed' in errors[1], errors)
+
+
+def write_pdf(filename, objects, root=1, updates=()):
+    '''Write a PDF file with objects (number -> dictionary) and a
+    cross-reference table, followed by incremental updates with objects
+    that replace objects with the same numbers.'''
+    content = b'%PDF-1.4\n'
+    prev = None
+    for objs in [objects] + list(updates):
+        offsets = {}
+        for num, obj in sorted(objs.items()):
+            offsets[num] = len(content)
+            content += f'{num} 0 obj\n{obj}\nendobj\n'.encode()
+        xref = len(content)
+        content += b'xref\n'
+        for num in sorted(offsets):
+            content += f'{num} 1\n{offsets[num]:010d} 00000 n \n'.encode()
+        size = max(offsets) + 1
+        content += f'trailer\n<< /Size {size} /Root {root} 0 R'.encode()
+        if prev is not None:
+            content += f' /Prev {prev}'.encode()
+        content += f' >>\nstartxref\n{xref}\n%%EOF\n'.encode()
+        prev = xref
+    with open(filename, 'wb') as pdf:
+        pdf.write(content)
+
+
+def write_compressed_pdf(filename, objects, root=1):
+    '''Write a PDF 1.5 file with objects (number -> dictionary) in an object
+    stream, and a cross-reference stream that is compressed with the PNG Up
+    predictor, as written by pdfTeX.'''
+    numbers = sorted(objects)
+    contents = [objects[x].encode() + b'\n' for x in numbers]
+    pairs = b' '.join(f'{x} {sum(len(y) for y in contents[:i])}'.encode() for i, x in enumerate(numbers)) + b'\n'
+    data = zlib.compress(pairs + b''.join(contents))
+    stream_num = max(numbers) + 1
+    xref_num = stream_num + 1
+    content = b'%PDF-1.5\n'
+    stream_offset = len(content)
+    content += (f'{stream_num} 0 obj\n<< /Type /ObjStm /N {len(numbers)} /First {len(pairs)} '
+        f'/Length {len(data)} /Filter /FlateDecode >>\nstream\n').encode() + data + b'\nendstream\nendobj\n'
+    xref_offset = len(content)
+    # entries of type, offset or object stream (3 bytes) and index
+    rows = [(0, 0, 0)] + [(2, stream_num, numbers.index(x)) if x in objects else (0, 0, 0)
+        for x in range(1, stream_num)] + [(1, stream_offset, 0), (1, xref_offset, 0)]
+    encoded = b''
+    prev = bytes(5)
+    for row in rows:
+        row = bytes([row[0]]) + row[1].to_bytes(3, 'big') + bytes([row[2]])
+        encoded += b'\x02' + bytes((x - y) & 0xff for x, y in zip(row, prev))
+        prev = row
+    data = zlib.compress(encoded)
+    content += (f'{xref_num} 0 obj\n<<\n/Type /XRef\n/Index [0 {xref_num + 1}]\n/Size {xref_num + 1}\n'
+        f'/W [1 3 1]\n/Root {root} 0 R\n/Length {len(data)}\n/Filter /FlateDecode\n'
+        f'/DecodeParms << /Columns 5 /Predictor 12 >>\n>>\nstream\n').encode() + data + \
+        f'\nendstream\nendobj\nstartxref\n{xref_offset}\n%%EOF\n'.encode()
+    with open(filename, 'wb') as pdf:
+        pdf.write(content)
+
+
+class TestPdfPageInfo(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, 'test.pdf')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def testPageInfo(self):
+        '''Test number of pages and size of the first page'''
+        write_pdf(self.filename, {
+            1: '<< /Type /Catalog /Pages 2 0 R >>',
+            2: '<< /Type /Pages /Kids [3 0 R 4 0 R] /Count 2 >>',
+            3: '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] >>',
+            4: '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 100 100] >>',
+        })
+        self.assertEqual(pdf_page_info(self.filename), (2, 612, 792))
+
+    def testNestedPageTree(self):
+        '''Test page size inherited from page tree and other counts and boxes'''
+        write_pdf(self.filename, {
+            # the root and pages are not the first objects of the file
+            1: '<< /Type /Pages /Kids [6 0 R] /Count 1 /MediaBox [0 0 10 10] >>',
+            2: '<< /Type /Page /Parent 1 0 R >>',
+            3: '<< /Type /Catalog /Pages 4 0 R >>',
+            4: '<< /Type /Pages /Kids [5 0 R 2 0 R] /Count 3 /MediaBox [0 0 595 842] >>',
+            5: '<< /Type /Pages /Parent 4 0 R /Kids [7 0 R 1 0 R] /Count 2 >>',
+            6: '<< /Type /Page /Parent 1 0 R >>',
+            7: '<< /Type /Page /Parent 5 0 R >>',
+        }, root=3)
+        self.assertEqual(pdf_page_info(self.filename), (3, 595, 842))
+
+    def testIncrementalUpdate(self):
+        '''Test that objects of incremental updates replace earlier objects'''
+        write_pdf(self.filename, {
+            1: '<< /Type /Catalog /Pages 2 0 R >>',
+            2: '<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+            3: '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] >>',
+        }, updates=[{
+            2: '<< /Type /Pages /Kids [4 0 R 3 0 R] /Count 2 >>',
+            4: '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 200 300] >>',
+        }])
+        self.assertEqual(pdf_page_info(self.filename), (2, 200, 300))
+
+    def testCompressedPdf(self):
+        '''Test page info of objects in object streams of PDF 1.5 files'''
+        write_compressed_pdf(self.filename, {
+            1: '<< /Type /Catalog /Pages 2 0 R >>',
+            2: '<< /Type /Pages /Kids [3 0 R 4 0 R 5 0 R] /Count 3 /MediaBox [0 0 595.28 841.89] >>',
+            3: '<< /Type /Page /Parent 2 0 R >>',
+            4: '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 100 100] >>',
+            5: '<< /Type /Page /Parent 2 0 R >>',
+        })
+        with mock.patch.object(preview, '_read_pdf_page_info', side_effect=AssertionError):
+            count, width, height = pdf_page_info(self.filename)
+        self.assertEqual((count, round(width, 2), round(height, 2)), (3, 595.28, 841.89))
+
+    def testUnknownPageInfo(self):
+        '''Test page info that cannot be found'''
+        with mock.patch.object(preview, '_read_pdf_page_info', side_effect=RuntimeError):
+            # missing page size
+            write_pdf(self.filename, {
+                1: '<< /Type /Catalog /Pages 2 0 R >>',
+                2: '<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+                3: '<< /Type /Page /Parent 2 0 R >>',
+            })
+            self.assertEqual(pdf_page_info(self.filename), (1, None, None))
+            # missing page tree
+            write_pdf(self.filename, {
+                1: '<< /Type /Catalog /Pages 5 0 R >>',
+            })
+            self.assertEqual(pdf_page_info(self.filename), (None, None, None))
+            # malformed cross-reference table
+            write_pdf(self.filename, {
+                1: '<< /Type /Catalog /Pages 2 0 R >>',
+            })
+            with open(self.filename, 'rb') as pdf:
+                content = pdf.read()
+            with open(self.filename, 'wb') as pdf:
+                pdf.write(content.replace(b'0000000009', b'XXXXXXXXXX'))
+            self.assertEqual(pdf_page_info(self.filename), (None, None, None))
+            # unsupported cross-reference stream
+            with open(self.filename, 'wb') as pdf:
+                pdf.write(b'%PDF-1.5\n1 0 obj\n<< /Type /XRef /Root 2 0 R >>\nstream\nendstream\nendobj\n'
+                    b'startxref\n9\n%%EOF\n')
+            self.assertEqual(pdf_page_info(self.filename), (None, None, None))
+            # not a pdf file
+            with open(self.filename, 'wb') as pdf:
+                pdf.write(b'not a pdf file')
+            self.assertEqual(pdf_page_info(self.filename), (None, None, None))
+
+    def testReadPageInfo(self):
+        '''Test page info read by pypdf or ImageMagick if it cannot be found'''
+        with open(self.filename, 'wb') as pdf:
+            pdf.write(b'not a pdf file')
+        with mock.patch.object(preview, '_read_pdf_page_info', return_value=(10, 612, 792)):
+            self.assertEqual(pdf_page_info(self.filename), (10, 612, 792))
+            # values that are found are kept
+            write_pdf(self.filename, {
+                1: '<< /Type /Catalog /Pages 2 0 R >>',
+                2: '<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+                3: '<< /Type /Page /Parent 2 0 R >>',
+            })
+            self.assertEqual(pdf_page_info(self.filename), (1, 612, 792))
+
+
+class TestRasterizePdf(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.olddir = os.getcwd()
+        os.chdir(self.temp_dir)
+        with open('test.pdf', 'wb') as pdf:
+            pdf.write(b'%PDF-1.4\n')
+        self.rasterized = []
+        self.patches = [
+            mock.patch.object(preview, 'preview_cache', DiskCache(os.path.join(self.temp_dir, 'cache'))),
+            mock.patch.object(preview, 'rasterize_pdf_page', self.rasterize_pdf_page),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        preview.shutdown_pdf_pool()
+        os.chdir(self.olddir)
+        shutil.rmtree(self.temp_dir)
+
+    def rasterize_pdf_page(self, filename, page, dpi):
+        self.rasterized.append((filename, page, dpi))
+        return f'{filename}:{page}'.encode()
+
+    def testAbsolutePath(self):
+        '''Test that pages are rasterised and cached by absolute path'''
+        from concurrent.futures import ThreadPoolExecutor
+        with mock.patch.object(preview, '_pdf_pool', ThreadPoolExecutor(2)):
+            images = rasterize_pdf_pages('test.pdf', [0, 1], 72)
+        filename = os.path.join(os.getcwd(), 'test.pdf')
+        self.assertEqual(images, [f'{filename}:0'.encode(), f'{filename}:1'.encode()])
+        self.assertEqual(sorted(self.rasterized), [(filename, 0, 72), (filename, 1, 72)])
+        # pages are read from the cache
+        self.assertEqual(rasterize_pdf_pages(filename, [1, 0], 72), images[::-1])
+        self.assertEqual(len(self.rasterized), 2)
+
+
+class TestCountLines(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def testExactCount(self):
+        '''Test exact number of lines of small files'''
+        filename = os.path.join(self.temp_dir, 'test.csv')
+        for content, lines in (('', 0), ('a', 1), ('a\n', 1), ('a\nb', 2), ('a\n\nb\n', 3)):
+            with open(filename, 'w') as f:
+                f.write(content)
+            self.assertEqual(count_lines(filename), (lines, True), f'Lines of {content!r}')
+
+    def testEstimatedCount(self):
+        '''Test number of lines of large files estimated from samples'''
+        filename = os.path.join(self.temp_dir, 'test.csv')
+        with open(filename, 'w') as f:
+            for i in range(10000):
+                f.write(f'{i % 100:>9}\n')
+        self.assertEqual(count_lines(filename), (10000, True))
+        self.assertEqual(count_lines(filename, exact_size=1000, sample_size=1000), (10000, False))
+        # samples that overlap or are larger than the file
+        self.assertEqual(count_lines(filename, exact_size=1000, sample_size=60000), (10000, False))
+
+    def testCompressedCount(self):
+        '''Test number of lines of compressed files'''
+        filename = os.path.join(self.temp_dir, 'test.csv.gz')
+        with gzip.open(filename, 'wt') as f:
+            for i in range(10000):
+                f.write(f'{i}\n')
+        self.assertEqual(count_lines(filename), (10000, True))
+        filename = os.path.join(self.temp_dir, 'test.csv.bz2')
+        with bz2.open(filename, 'wt') as f:
+            for i in range(10000):
+                f.write(f'{i}\n')
+        self.assertEqual(count_lines(filename), (10000, True))
+        # lines of large files are estimated from the first compressed bytes
+        filename = os.path.join(self.temp_dir, 'large.csv.gz')
+        with gzip.open(filename, 'wb', compresslevel=1) as f:
+            for _ in range(100):
+                f.write(b''.join(os.urandom(16).hex().encode() + b'\n' for _ in range(10000)))
+        lines, exact = count_lines(filename, sample_size=1024)
+        self.assertFalse(exact)
+        self.assertAlmostEqual(lines, 1000000, delta=100000)
+
+    def testZipFile(self):
+        '''Test that lines of zip files are not counted'''
+        filename = os.path.join(self.temp_dir, 'test.csv.zip')
+        with zipfile.ZipFile(filename, 'w') as zf:
+            zf.writestr('test.csv', 'a\nb\n')
+        self.assertRaises(ValueError, count_lines, filename)
+
+
+class TestReadExcel(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    @unittest.skipIf(openpyxl is None, 'openpyxl is not installed')
+    def testReadXlsx(self):
+        '''Test reading worksheets of xlsx files by name and index'''
+        filename = os.path.join(self.temp_dir, 'test.xlsx')
+        wb = openpyxl.Workbook()
+        wb.active.title = 'first'
+        wb.active.append(['a', 'b'])
+        ws = wb.create_sheet('second')
+        ws.append(['x', 'y'])
+        for i in range(10):
+            ws.append([i, i * 2])
+        wb.save(filename)
+        sheets, name, rows, max_row = _read_xlsx(filename, 0, 5)
+        self.assertEqual([x[0] for x in sheets], ['first', 'second'])
+        self.assertEqual((name, rows, max_row), ('first', [('a', 'b')], 1))
+        for sheet in (1, 'second'):
+            sheets, name, rows, max_row = _read_xlsx(filename, sheet, 5)
+            self.assertEqual(name, 'second')
+            # one more row than limit to tell if there are more rows
+            self.assertEqual(rows, [('x', 'y')] + [(i, i * 2) for i in range(5)])
+            self.assertEqual(max_row, 11)
+        self.assertEqual(len(_read_xlsx(filename, 'second', None)[2]), 11)
+        self.assertRaises(KeyError, _read_xlsx, filename, 'third', 5)
+        self.assertRaises(IndexError, _read_xlsx, filename, 2, 5)
+
+    @unittest.skipIf(openpyxl is None, 'openpyxl is not installed')
+    def testPreviewSheet(self):
+        '''Test preview of worksheets specified by option --sheet'''
+        filename = os.path.join(self.temp_dir, 'test.xlsx')
+        wb = openpyxl.Workbook()
+        wb.active.title = 'first'
+        wb.active.append(['a', 'b'])
+        wb.create_sheet('second').append(['x'])
+        wb.save(filename)
+        for sheet in ('1', 'second'):
+            result = preview_xls(filename, style={'style': None, 'options': ['--sheet', sheet]})
+            self.assertTrue('<b>second</b>' in result['text/html'], result)
+        self.assertRaisesRegex(ValueError, 'Worksheet third does not exist', preview_xls,
+            filename, style={'style': None, 'options': ['--sheet', 'third']})
+
+    @unittest.skipIf(xlwt is None, 'xlrd or xlwt is not installed')
+    def testReadXls(self):
+        '''Test reading worksheets of xls files by name and index'''
+        filename = os.path.join(self.temp_dir, 'test.xls')
+        wb = xlwt.Workbook()
+        wb.add_sheet('first').write(0, 0, 'a')
+        ws = wb.add_sheet('second')
+        ws.write(0, 0, 'x')
+        for i in range(10):
+            ws.write(i + 1, 0, i)
+        wb.save(filename)
+        sheets, name, rows, max_row = _read_xls(filename, 0, 5)
+        self.assertEqual(sheets, [('first', 1, 1), ('second', None, None)])
+        self.assertEqual((name, rows, max_row), ('first', [['a']], 1))
+        for sheet in (1, 'second'):
+            sheets, name, rows, max_row = _read_xls(filename, sheet, 5)
+            self.assertEqual(sheets, [('first', None, None), ('second', 11, 1)])
+            self.assertEqual(name, 'second')
+            self.assertEqual(rows, [['x']] + [[float(i)] for i in range(5)])
+            self.assertEqual(max_row, 11)
+        self.assertEqual(len(_read_xls(filename, 'second', None)[2]), 11)
+        self.assertRaises(KeyError, _read_xls, filename, 'third', 5)
+        self.assertRaises((KeyError, IndexError), _read_xls, filename, 2, 5)
+
+
+@unittest.skipIf(Image is None, 'wand or ImageMagick is not installed')
+class TestThumbnail(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        # noise does not compress well as png
+        self.filename = os.path.join(self.temp_dir, 'test.png')
+        with Image(width=600, height=400, pseudo='plasma:') as img:
+            img.save(filename=self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def testMaxSize(self):
+        '''Test that thumbnails are no larger than max_size pixels'''
+        image_type, image = make_thumbnail(self.filename, 300, 10 ** 8)
+        self.assertEqual(image_type, 'png')
+        with Image(blob=image) as img:
+            self.assertEqual((img.width, img.height), (300, 200))
+        # small images are not enlarged
+        with Image(blob=make_thumbnail(self.filename, 1000, 10 ** 8)[1]) as img:
+            self.assertEqual((img.width, img.height), (600, 400))
+
+    def testMaxBytes(self):
+        '''Test that thumbnails are reduced to max_bytes bytes'''
+        png = make_thumbnail(self.filename, 600, 10 ** 8)[1]
+        image_type, jpeg = make_thumbnail(self.filename, 600, len(png) // 2)
+        self.assertEqual(image_type, 'jpeg')
+        self.assertLessEqual(len(jpeg), len(png) // 2)
+        # dimensions are reduced if jpeg is still too large
+        image_type, image = make_thumbnail(self.filename, 600, len(jpeg) // 2)
+        self.assertEqual(image_type, 'jpeg')
+        self.assertLessEqual(len(image), len(jpeg) // 2)
+        with Image(blob=image) as img:
+            self.assertLess(img.width, 600)
+
+
+def index_refs(counts, unplaced=None):
+    '''Content of references of a bai or tbi index with records counts
+    (mapped, unmapped) of references'''
+    content = b''
+    for mapped, unmapped in counts:
+        content += struct.pack('<i', 2)
+        # a bin with a chunk and the pseudo bin
+        content += struct.pack('<IiQQ', 4681, 1, 0, 100)
+        content += struct.pack('<IiQQQQ', 37450, 2, 0, 100, mapped, unmapped)
+        # linear index
+        content += struct.pack('<iQ', 1, 0)
+    if unplaced is not None:
+        content += struct.pack('<Q', unplaced)
+    return content
+
+
+class TestGenomicsPreview(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def testBaiRecordCount(self):
+        '''Test number of records from a bai index'''
+        filename = os.path.join(self.temp_dir, 'test.bam')
+        with open(filename, 'wb') as bam:
+            bam.write(b'')
+        self.assertEqual(index_record_count(filename), None)
+        with open(filename + '.bai', 'wb') as bai:
+            bai.write(b'BAI\x01' + struct.pack('<i', 2) + index_refs([(10, 1), (20, 2)], 3))
+        self.assertEqual(index_record_count(filename), 36)
+        with open(filename + '.bai', 'wb') as bai:
+            bai.write(b'BAI\x01' + struct.pack('<i', 2) + index_refs([(10, 1), (20, 2)]))
+        self.assertEqual(index_record_count(filename), 33)
+        # a truncated index is ignored
+        with open(filename + '.bai', 'wb') as bai:
+            bai.write(b'BAI\x01' + struct.pack('<i', 3) + index_refs([(10, 1), (20, 2)]))
+        self.assertEqual(index_record_count(filename), None)
+
+    def testTbiRecordCount(self):
+        '''Test number of records from a compressed tbi index'''
+        filename = os.path.join(self.temp_dir, 'test.vcf.gz')
+        with open(filename, 'wb') as vcf:
+            vcf.write(b'')
+        names = b'chr1\x00chr2\x00'
+        with gzip.open(filename + '.tbi', 'wb') as tbi:
+            tbi.write(b'TBI\x01' + struct.pack('<iiiiiiii', 2, 2, 1, 2, 0, ord('#'), 0, len(names)) +
+                names + index_refs([(5, 0), (7, 0)]))
+        self.assertEqual(index_record_count(filename), 12)
+
+    def testBedHeader(self):
+        '''Test that track, browser and comment lines of bed files are previewed as header'''
+        filename = os.path.join(self.temp_dir, 'test.bed')
+        with open(filename, 'w') as bed:
+            bed.write('browser position chr1:1-1000\ntrack name=test\n# comment\n')
+            for i in range(10):
+                bed.write(f'chr1\t{i * 100}\t{i * 100 + 50}\n')
+        self.assertEqual(preview_bed(filename, style={'style': None, 'options': ['-l', '2']}),
+            'browser position chr1:1-1000\ntrack name=test\n# comment\n'
+            'chr1\t0\t50\nchr1\t100\t150\n...\n')
+        with open(filename, 'w') as bed:
+            for i in range(20):
+                bed.write(f'# comment {i}\n')
+            bed.write('chr1\t0\t50\n')
+        preview = preview_bed(filename).split('\n')
+        self.assertEqual(preview[10:], ['... 20 header lines', 'chr1\t0\t50', ''])
+
+
+if __name__ == '__main__':
+    unittest.main()
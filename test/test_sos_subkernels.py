@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+#
+# This file is part of Script of Scripts (SoS), a workflow system
+# for the execution of commands and scripts in different languages.
+# Please visit https://github.com/vatlab/SOS for more information.
+#
+# Copyright (C) 2016 Bo Peng (bpeng@mdanderson.org)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from sos_notebook.subkernels import KernelInfo, SubkernelPool, SubkernelRegistry, run_silently
+
+
+class MockKernelManager(object):
+    def __init__(self):
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def shutdown_kernel(self, now=False):
+        self.alive = False
+
+
+class MockKernelClient(object):
+    def __init__(self, replies=()):
+        self.replies = list(replies)
+
+    def execute(self, code, silent=False, store_history=True):
+        return 'msg_id'
+
+    def get_shell_msg(self, timeout=None):
+        if not self.replies:
+            raise queue.Empty()
+        return {'parent_header': {'msg_id': 'msg_id'}, 'content': self.replies.pop(0)}
+
+    def stop_channels(self):
+        pass
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestSubkernelRegistry(unittest.TestCase):
+    def testLookup(self):
+        '''Test lookup of subkernels by name, kernel and language'''
+        registry = SubkernelRegistry()
+        registry.add(['R', 'ir', 'R', '#FDEDEC', {}])
+        registry.add(['Python3', 'python3', 'Python3', '#EAFAF1', {}])
+        registry.add(['Py3', 'python3', 'Python3', '', {}])
+        self.assertEqual(registry.get('R'), KernelInfo('R', 'ir', 'R', '#FDEDEC', {}))
+        self.assertIsNone(registry.get('ir'))
+        # the first instance by displayed name
+        self.assertEqual(registry.by_kernel('python3').name, 'Py3')
+        self.assertIsNone(registry.by_kernel('julia'))
+        self.assertEqual([x.name for x in registry.by_language('Python3')], ['Py3', 'Python3'])
+        self.assertEqual(registry.by_language('Julia'), [])
+        self.assertTrue(registry.has_kernel('ir'))
+        self.assertFalse(registry.has_kernel('julia'))
+        self.assertEqual([x.name for x in registry.sorted()], ['Py3', 'Python3', 'R'])
+
+    def testReplace(self):
+        '''Test that definitions are replaced by displayed name'''
+        registry = SubkernelRegistry()
+        registry.add(['R', 'ir', 'R', '', {}])
+        self.assertEqual([x.name for x in registry.sorted()], ['R'])
+        registry.add(['R', 'ir-4', 'R', '#FDEDEC', {}])
+        self.assertEqual(registry.get('R').kernel, 'ir-4')
+        self.assertFalse(registry.has_kernel('ir'))
+        self.assertEqual(registry.by_kernel('ir-4').color, '#FDEDEC')
+        self.assertEqual(len(registry.by_language('R')), 1)
+        self.assertEqual([x.kernel for x in registry.sorted()], ['ir-4'])
+
+
+class TestSubkernelPool(unittest.TestCase):
+    def setUp(self):
+        self.olddir = os.getcwd()
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.chdir(self.olddir)
+        shutil.rmtree(self.temp_dir)
+
+    def testAcquireInOtherDirectory(self):
+        '''Test that kernels started in another directory are not acquired'''
+        pool = SubkernelPool()
+        started = []
+        pool._start_kernel = lambda name, cwd, init: started.append(cwd) or \
+            (MockKernelManager(), MockKernelClient())
+        pool.configure('python3', 1)
+        pool.fill()
+        self.assertTrue(wait_for(lambda: pool._ready['python3']))
+        stale = pool._ready['python3'][0]
+        os.chdir(self.temp_dir)
+        self.assertIsNone(pool.acquire('python3'))
+        self.assertFalse(stale.km.is_alive())
+        # the pool is refilled with a kernel in the new directory
+        self.assertTrue(wait_for(lambda: pool._ready['python3']))
+        warm = pool.acquire('python3')
+        self.assertEqual(warm.cwd, os.getcwd())
+        self.assertEqual(started[:2], [self.olddir, os.getcwd()])
+        pool.shutdown()
+
+    def testAcquireAfterFailedStart(self):
+        '''Test that None is returned if the pool failed to start the kernel'''
+        pool = SubkernelPool()
+        def fail(name, cwd, init):
+            raise RuntimeError('failed to start')
+        pool._start_kernel = fail
+        pool.configure('python3', 1)
+        pool.fill()
+        self.assertTrue(wait_for(lambda: 'python3' in pool._errors))
+        self.assertIsNone(pool.acquire('python3'))
+        pool.shutdown()
+
+    def testClaim(self):
+        '''Test that kernels reserved for subkernels are claimed'''
+        pool = SubkernelPool()
+        pool._start_kernel = lambda name, cwd, init: (MockKernelManager(), MockKernelClient())
+        ready = []
+        pool.reserve('Python3', 'python3', 'Python3', on_ready=lambda name, error: ready.append((name, error)))
+        warm = pool.claim('Python3', timeout=5)
+        self.assertEqual((warm.language, warm.cwd), ('Python3', os.getcwd()))
+        self.assertTrue(wait_for(lambda: ready == [('Python3', None)]))
+        # a kernel is claimed only once
+        self.assertIsNone(pool.claim('Python3'))
+        pool.shutdown()
+
+    def testClaimAfterFailedStart(self):
+        '''Test that None is returned if the reserved kernel failed to start'''
+        pool = SubkernelPool()
+        def fail(name, cwd, init):
+            raise RuntimeError('failed to start')
+        pool._start_kernel = fail
+        ready = []
+        pool.reserve('Python3', 'python3', on_ready=lambda name, error: ready.append((name, error)))
+        self.assertIsNone(pool.claim('Python3', timeout=5))
+        self.assertEqual(ready, [('Python3', 'failed to start')])
+        pool.shutdown()
+
+    def testClaimTimeout(self):
+        '''Test that a kernel that is started after claim times out is shut down'''
+        pool = SubkernelPool()
+        started = threading.Event()
+        km = MockKernelManager()
+        pool._start_kernel = lambda name, cwd, init: started.wait() and (km, MockKernelClient())
+        pool.reserve('Python3', 'python3')
+        self.assertIsNone(pool.claim('Python3', timeout=0.1))
+        self.assertTrue(km.is_alive())
+        started.set()
+        self.assertTrue(wait_for(lambda: not km.is_alive()))
+        pool.shutdown()
+
+    def testAcquireUnknownKernel(self):
+        '''Test that kernels that are not configured are not acquired'''
+        pool = SubkernelPool()
+        self.assertIsNone(pool.acquire('ir'))
+
+
+class TestRunSilently(unittest.TestCase):
+    def testReply(self):
+        '''Test that the reply of executed statements is returned'''
+        kc = MockKernelClient([{'status': 'ok'}])
+        self.assertEqual(run_silently(kc, 'a = 1'), {'status': 'ok'})
+
+    def testError(self):
+        '''Test that errors of executed statements are raised'''
+        kc = MockKernelClient([{'status': 'error', 'ename': 'NameError', 'evalue': 'a'}])
+        self.assertRaisesRegex(RuntimeError, 'NameError: a', run_silently, kc, 'a')
+
+    def testTimeout(self):
+        '''Test that a kernel that does not reply is reported'''
+        self.assertRaisesRegex(RuntimeError, 'No reply', run_silently, MockKernelClient(), 'a', 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()